@@ -0,0 +1,194 @@
+from typing import Any, Dict, List, Union
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import contextlib
+import platform
+import tempfile
+import multiprocessing
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from local_zone_server import LocalZoneServer  # noqa: E402
+
+
+# Synthetic datasets covering the dimensions that matter for the pipeline:
+# the number of chunks, the chunk size and the number of arrays.
+SCENARIOS: List[Dict[str, Any]] = [
+    {'name': 'many_small_chunks', 'num_arrays': 1, 'num_chunks': 4000, 'chunk_size': 16 * 1024},
+    {'name': 'medium_chunks', 'num_arrays': 4, 'num_chunks': 100, 'chunk_size': 512 * 1024},
+    {'name': 'few_large_chunks', 'num_arrays': 1, 'num_chunks': 12, 'chunk_size': 8 * 1024 * 1024},
+    {'name': 'many_arrays', 'num_arrays': 300, 'num_chunks': 8, 'chunk_size': 32 * 1024},
+    {'name': 'many_small_chunks_segments', 'num_arrays': 1, 'num_chunks': 4000, 'chunk_size': 16 * 1024, 'staging_mode': 'segments'},
+]
+
+
+def benchmark_pipeline(
+    scenarios: Union[List[Dict[str, Any]], None] = None,
+    *,
+    scale: float = 1.0,
+    output: Union[str, None] = None
+) -> dict:
+    # Runs each scenario (stage -> consolidate -> upload -> re-upload ->
+    # load) in a fresh process, against a local stand-in for the zone bucket
+    # and the upload api, and returns the metrics for each phase:
+    #   seconds, mb_per_sec (of array data), read/write syscalls (from
+    #   /proc/self/io, Linux only), peak_rss_mb (of the process so far) and
+    #   the requests made to the server, by kind.
+    if scenarios is None:
+        scenarios = SCENARIOS
+    server = LocalZoneServer()
+    server.start()
+    results = []
+    try:
+        ctx = multiprocessing.get_context('spawn')
+        for scenario in scenarios:
+            scenario = dict(scenario)
+            scenario['num_chunks'] = max(1, int(scenario['num_chunks'] * scale))
+            print(f"Running {scenario['name']}: {scenario}", file=sys.stderr)
+            with ctx.Pool(1) as pool:
+                phases = pool.apply(_run_scenario, (scenario, server.base_url, server.env()))
+            results.append({'scenario': scenario, 'phases': phases})
+    finally:
+        server.stop()
+    ret = {
+        'benchmark': 'pipeline',
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results
+    }
+    text = json.dumps(ret, indent=2)
+    if output is not None:
+        with open(output, 'w') as f:
+            f.write(text)
+    print(text)
+    return ret
+
+
+def _run_scenario(scenario: Dict[str, Any], server_url: str, env: Dict[str, str]) -> Dict[str, Any]:
+    os.environ.update(env)
+    # keep the progress output of lindi_cloud out of the JSON on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        return _run_scenario_phases(scenario, server_url, env)
+
+
+def _run_scenario_phases(scenario: Dict[str, Any], server_url: str, env: Dict[str, str]) -> Dict[str, Any]:
+    import zarr
+    import lindi_cloud
+
+    num_arrays = scenario['num_arrays']
+    num_chunks = scenario['num_chunks']
+    chunk_size = scenario['chunk_size']
+    total_bytes = num_arrays * num_chunks * chunk_size
+    url = f"{env['LINDI_CLOUD_ZONES_URL']}/benchmark/{scenario['name']}/f/{time.time_ns()}.zarr.json"
+    staging_dir = tempfile.mkdtemp(prefix='lindi_cloud_staging_')
+    phases: Dict[str, Any] = {}
+    try:
+        def measure(name: str, func, num_bytes: int):
+            before = _get_counters(server_url)
+            timer = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - timer
+            after = _get_counters(server_url)
+            phases[name] = {
+                'seconds': elapsed,
+                'mb_per_sec': num_bytes / 1e6 / elapsed if elapsed > 0 and num_bytes > 0 else None,
+                'read_syscalls': _diff(after['syscr'], before['syscr']),
+                'write_syscalls': _diff(after['syscw'], before['syscw']),
+                'peak_rss_mb': after['peak_rss_mb'],
+                'requests': _diff_requests(after['server']['requests'], before['server']['requests']),
+                'total_requests': after['server']['total_requests'] - before['server']['total_requests'],
+                'bytes_uploaded': after['server']['bytes_received'] - before['server']['bytes_received'],
+                'bytes_downloaded': after['server']['bytes_sent'] - before['server']['bytes_sent']
+            }
+
+        client = lindi_cloud.lindi_cloud_create(staging_dir=staging_dir, staging_mode=scenario.get('staging_mode', 'files'))
+        store = client._zarr_store
+        # every chunk is distinct (so nothing is deduplicated) but generating
+        # the data is kept out of the measurement
+        rng = np.random.default_rng(0)
+        base_chunk = rng.integers(0, 256, size=chunk_size, dtype=np.uint8)
+        chunks = []
+        for i in range(num_arrays):
+            for j in range(num_chunks):
+                x = base_chunk.copy()
+                x[:8] = np.frombuffer((i * num_chunks + j).to_bytes(8, 'little'), dtype=np.uint8)
+                chunks.append((f'arrays/a{i}/{j}', x.tobytes()))
+
+        def stage():
+            for i in range(num_arrays):
+                zarr.create(
+                    store=store,
+                    path=f'arrays/a{i}',
+                    shape=(num_chunks * chunk_size,),
+                    chunks=(chunk_size,),
+                    dtype='uint8',
+                    compressor=None
+                )
+            for key, data in chunks:
+                store[key] = data
+            store.flush()
+
+        measure('stage', stage, total_bytes)
+        chunks.clear()
+        measure('consolidate', lambda: lindi_cloud.lindi_cloud_consolidate_chunks(client), total_bytes)
+        measure('upload', lambda: lindi_cloud.lindi_cloud_upload(client, url, consolidate_chunks=False), total_bytes)
+        # nothing changed, so this should upload nothing but the .zarr.json
+        measure('reupload', lambda: lindi_cloud.lindi_cloud_upload(client, url, consolidate_chunks=False), 0)
+
+        def load():
+            client2 = lindi_cloud.lindi_cloud_load(url, staging_dir=None)
+            for i in range(num_arrays):
+                x = client2[f'arrays/a{i}'][:]
+                if x.nbytes != num_chunks * chunk_size:
+                    raise Exception(f'Unexpected size of arrays/a{i}: {x.nbytes}')
+
+        measure('load', load, total_bytes)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    return phases
+
+
+def _get_counters(server_url: str) -> Dict[str, Any]:
+    ret: Dict[str, Any] = {'syscr': None, 'syscw': None, 'peak_rss_mb': None}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                k, v = line.split(':')
+                if k in ['syscr', 'syscw']:
+                    ret[k] = int(v)
+    except OSError:
+        pass
+    try:
+        import resource
+        # kilobytes on Linux, bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        ret['peak_rss_mb'] = maxrss / 1024 if sys.platform != 'darwin' else maxrss / 1024 / 1024
+    except ImportError:
+        pass
+    ret['server'] = requests.get(f'{server_url}/_stats').json()
+    return ret
+
+
+def _diff(a: Union[int, None], b: Union[int, None]) -> Union[int, None]:
+    return a - b if a is not None and b is not None else None
+
+
+def _diff_requests(after: Dict[str, int], before: Dict[str, int]) -> Dict[str, int]:
+    return {k: v - before.get(k, 0) for k, v in after.items() if v - before.get(k, 0) > 0}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the stage -> consolidate -> upload -> load pipeline')
+    parser.add_argument('--scenario', action='append', help='Run only these scenarios (by name)')
+    parser.add_argument('--scale', type=float, default=1.0, help='Scale the number of chunks (e.g., 0.1 for a quick run)')
+    parser.add_argument('--output', help='Also write the JSON results to this file')
+    args = parser.parse_args()
+    selected = [s for s in SCENARIOS if args.scenario is None or s['name'] in args.scenario]
+    benchmark_pipeline(selected, scale=args.scale, output=args.output)
@@ -0,0 +1,45 @@
+import io
+import json
+import time
+import tracemalloc
+from lindi_cloud.rfs_json import load_rfs_json
+
+
+def benchmark_refs_memory(num_refs: int = 1_000_000, num_urls: int = 100):
+    # A synthetic reference file system similar to a large NWB file: many
+    # chunk references pointing into a modest number of blobs
+    print(f'Creating synthetic rfs with {num_refs} refs and {num_urls} urls')
+    sha1 = 'a' * 40
+    refs = {}
+    for i in range(num_refs):
+        url = f'https://lindi.neurosift.org/zones/user/zone/sha1/aa/aa/aa/{sha1[:-4]}{i % num_urls:04d}'
+        refs[f'acquisition/ElectricalSeries/data/{i}.0'] = [url, (i // num_urls) * 100000, 100000]
+    text = json.dumps({'refs': refs, 'version': 1}).encode('utf-8')
+    del refs
+
+    results = {}
+    for label, compact_refs in [('dict', False), ('compact', True)]:
+        tracemalloc.start()
+        timer = time.time()
+        rfs = load_rfs_json(io.BytesIO(text), compact_refs=compact_refs)
+        elapsed_load = time.time() - timer
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        timer = time.time()
+        for i in range(0, num_refs, 7):
+            rfs['refs'][f'acquisition/ElectricalSeries/data/{i}.0']
+        elapsed_lookup = time.time() - timer
+        results[label] = {
+            'bytes': current,
+            'peak_bytes': peak,
+            'bytes_per_ref': current / num_refs,
+            'load_sec': elapsed_load,
+            'lookup_sec': elapsed_lookup
+        }
+        del rfs
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_refs_memory()
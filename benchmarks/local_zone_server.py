@@ -0,0 +1,406 @@
+from typing import Dict, Union
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import datetime
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import formatdate
+from urllib.parse import urlparse, parse_qs, unquote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+
+class LocalZoneServer:
+    """
+    A local stand-in for the zone bucket and the upload api, for benchmarks
+
+    Serves /zones/... (GET with Range support, and HEAD) from a directory,
+    and implements the getUploadUrl, getUploadUrls, refreshBlob and
+    multipartUpload api endpoints under /api, with "signed" urls that PUT
+    directly to the directory. Every request is counted by kind, and the
+    counts can be read with GET /_stats.
+
+    Point lindi_cloud at it with the LINDI_CLOUD_ZONES_URL,
+    LINDI_CLOUD_API_URL and LINDI_CLOUD_GITHUB_ACCESS_TOKEN environment
+    variables (see env()).
+
+    The same directory is also served through a minimal S3 API at s3_url
+    (ListObjectsV2 with pagination, GetObject, HeadObject, PutObject and
+    DeleteObjects, path-style, any bucket name and no authentication), so
+    that tools that use the bucket directly (such as lindi_cloud_gc) can be
+    pointed at it with endpoint_url. Object keys are the url paths (e.g.,
+    zones/user/zone/sha1/...), and LastModified is the file mtime.
+    """
+    def __init__(self, root_dir: Union[str, None] = None):
+        self._own_root_dir = root_dir is None
+        self.root_dir = root_dir if root_dir is not None else tempfile.mkdtemp(prefix='lindi_cloud_zone_')
+        self.request_counts: Counter = Counter()
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._multipart_uploads: Dict[str, Dict[int, bytes]] = {}
+        server = self
+
+        class Handler(_Handler):
+            zone_server = server
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self._httpd.server_address[1]}'
+        self._thread: Union[threading.Thread, None] = None
+
+    @property
+    def zones_url(self) -> str:
+        return f'{self.base_url}/zones'
+
+    @property
+    def s3_url(self) -> str:
+        return f'{self.base_url}/s3'
+
+    def env(self) -> Dict[str, str]:
+        return {
+            'LINDI_CLOUD_ZONES_URL': self.zones_url,
+            'LINDI_CLOUD_API_URL': f'{self.base_url}/api',
+            'LINDI_CLOUD_GITHUB_ACCESS_TOKEN': 'benchmark'
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._own_root_dir:
+            shutil.rmtree(self.root_dir, ignore_errors=True)
+
+    def reset_counts(self):
+        with self._lock:
+            self.request_counts.clear()
+            self.bytes_received = 0
+            self.bytes_sent = 0
+
+    def get_counts(self) -> dict:
+        with self._lock:
+            return {
+                'requests': dict(self.request_counts),
+                'total_requests': sum(self.request_counts.values()),
+                'bytes_received': self.bytes_received,
+                'bytes_sent': self.bytes_sent
+            }
+
+    def _count(self, kind: str, *, received: int = 0, sent: int = 0):
+        with self._lock:
+            self.request_counts[kind] += 1
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def _path_for_key(self, key: str) -> str:
+        # key is the path after the host, e.g., zones/user/zone/f/a.zarr.json
+        path = os.path.normpath(os.path.join(self.root_dir, key))
+        if not path.startswith(self.root_dir + os.sep):
+            raise ValueError(f'Invalid key: {key}')
+        return path
+
+    def _key_for_url(self, url: str) -> str:
+        if not url.startswith(self.zones_url + '/'):
+            raise ValueError(f'Not a zone url: {url}')
+        return url[len(self.base_url) + 1:]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    zone_server: LocalZoneServer
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately, which with Nagle's
+    # algorithm (and delayed acks) adds ~40 ms to every keep-alive request
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        if urlparse(self.path).path.startswith('/s3/'):
+            self._handle_s3('HEAD')
+            return
+        self._serve_file(head=True)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/_stats':
+            # not counted; lets a benchmark in another process read the counts
+            self._send_json(self.zone_server.get_counts())
+            return
+        if urlparse(self.path).path.startswith('/s3/'):
+            self._handle_s3('GET')
+            return
+        self._serve_file(head=False)
+
+    def do_DELETE(self):
+        self._handle_s3('DELETE')
+
+    def do_PUT(self):
+        server = self.zone_server
+        parsed = urlparse(self.path)
+        if parsed.path.startswith('/s3/'):
+            self._handle_s3('PUT')
+            return
+        data = self._read_body()
+        if parsed.path.startswith('/upload-part/'):
+            query = parse_qs(parsed.query)
+            upload_id = query['uploadId'][0]
+            part_number = int(query['partNumber'][0])
+            with server._lock:
+                parts = server._multipart_uploads.get(upload_id, None)
+                if parts is not None:
+                    parts[part_number] = data
+            if parts is None:
+                self._send(404, b'No such upload')
+                return
+            server._count('PUT part', received=len(data))
+            self._send(200, b'', headers={'ETag': f'"{hashlib.md5(data).hexdigest()}"'})
+            return
+        if not parsed.path.startswith('/upload/zones/'):
+            self._send(404, b'Not found')
+            return
+        path = server._path_for_key(parsed.path[len('/upload/'):])
+        _write_file(path, data)
+        server._count('PUT', received=len(data))
+        self._send(200, b'')
+
+    def do_POST(self):
+        server = self.zone_server
+        parsed = urlparse(self.path)
+        if parsed.path.startswith('/s3/'):
+            self._handle_s3('POST')
+            return
+        body = json.loads(self._read_body())
+        endpoint = parsed.path[len('/api/'):] if parsed.path.startswith('/api/') else None
+        server._count(f'POST {endpoint}' if endpoint != 'multipartUpload' else f"POST {endpoint} {body.get('type')}")
+        if endpoint == 'getUploadUrl':
+            self._send_json({'signedUrl': self._signed_url(body['url'])})
+        elif endpoint == 'getUploadUrls':
+            results = []
+            for url in body['urls']:
+                path = server._path_for_key(server._key_for_url(url))
+                if os.path.exists(path):
+                    # like the real api, write a refresh marker next to a
+                    # blob that is reused (see lindi_cloud_gc)
+                    if '/sha1/' in url:
+                        _write_file(path + '.refreshed', b'')
+                    results.append({'url': url, 'exists': True})
+                else:
+                    results.append({'url': url, 'exists': False, 'signedUrl': self._signed_url(url)})
+            self._send_json({'results': results})
+        elif endpoint == 'refreshBlob':
+            path = server._path_for_key(server._key_for_url(body['url']))
+            exists = os.path.exists(path)
+            if exists:
+                _write_file(path + '.refreshed', b'')
+            self._send_json({'exists': exists})
+        elif endpoint == 'multipartUpload':
+            self._handle_multipart_upload(body)
+        else:
+            self._send(404, b'Not found')
+
+    def _handle_multipart_upload(self, body: dict):
+        server = self.zone_server
+        t = body['type']
+        upload_id = body.get('uploadId', None)
+        if t == 'initiateMultipartUpload':
+            upload_id = hashlib.sha1(os.urandom(16)).hexdigest()
+            with server._lock:
+                server._multipart_uploads[upload_id] = {}
+            self._send_json({'uploadId': upload_id})
+            return
+        with server._lock:
+            parts = server._multipart_uploads.get(upload_id, None)
+        if parts is None:
+            self._send(404, b'No such upload')
+        elif t == 'getUploadPartUrls':
+            self._send_json({'signedUrls': [
+                f'{server.base_url}/upload-part/?uploadId={upload_id}&partNumber={n}'
+                for n in body['partNumbers']
+            ]})
+        elif t == 'listUploadedParts':
+            self._send_json({'parts': [
+                {'partNumber': n, 'etag': f'"{hashlib.md5(data).hexdigest()}"', 'size': len(data)}
+                for n, data in sorted(parts.items())
+            ]})
+        elif t == 'completeMultipartUpload':
+            path = server._path_for_key(server._key_for_url(body['url']))
+            _write_file(path, b''.join(parts[p['partNumber']] for p in body['parts']))
+            with server._lock:
+                del server._multipart_uploads[upload_id]
+            self._send_json({'success': True})
+        elif t == 'abortMultipartUpload':
+            with server._lock:
+                del server._multipart_uploads[upload_id]
+            self._send_json({'success': True})
+        else:
+            self._send(400, b'Invalid request')
+
+    def _handle_s3(self, method: str):
+        server = self.zone_server
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query, keep_blank_values=True)
+        # /s3/<bucket>[/<key>]
+        parts = unquote(parsed.path).split('/', 3)
+        key = parts[3] if len(parts) > 3 else ''
+        if not key:
+            if method == 'GET' and query.get('list-type', [''])[0] == '2':
+                server._count('S3 ListObjectsV2')
+                self._send_s3_listing(query)
+            elif method == 'POST' and 'delete' in query:
+                server._count('S3 DeleteObjects')
+                self._send_s3_delete_result()
+            else:
+                self._send(400, b'Unsupported S3 request')
+            return
+        try:
+            path = server._path_for_key(key)
+        except ValueError:
+            self._send(400, b'Invalid key')
+            return
+        if method == 'PUT':
+            data = self._read_body()
+            _write_file(path, data)
+            server._count('S3 PutObject', received=len(data))
+            self._send(200, b'', headers={'ETag': f'"{hashlib.md5(data).hexdigest()}"'})
+        elif method == 'DELETE':
+            server._count('S3 DeleteObject')
+            if os.path.isfile(path):
+                os.remove(path)
+            self._send(204, b'')
+        elif method in ['GET', 'HEAD']:
+            if not os.path.isfile(path):
+                server._count(f'S3 {method}Object (not found)')
+                self._send(404, _s3_error('NoSuchKey', key), head=method == 'HEAD')
+                return
+            with open(path, 'rb') as f:
+                data = f.read() if method == 'GET' else b''
+            server._count(f'S3 {method}Object', sent=len(data))
+            headers = {
+                'Last-Modified': formatdate(os.path.getmtime(path), usegmt=True),
+                'ETag': f'"{hashlib.md5(data).hexdigest()}"' if method == 'GET' else '"0"'
+            }
+            self._send(200, data, headers=headers, head=method == 'HEAD', content_length=os.path.getsize(path))
+        else:
+            self._send(400, b'Unsupported S3 request')
+
+    def _send_s3_listing(self, query: dict):
+        server = self.zone_server
+        prefix = query.get('prefix', [''])[0]
+        max_keys = int(query.get('max-keys', ['1000'])[0])
+        # the continuation token is simply the last key of the previous page
+        after = query.get('continuation-token', [''])[0] or query.get('start-after', [''])[0]
+        keys = []
+        for root, dirs, files in os.walk(server.root_dir):
+            for fname in files:
+                if '.tmp.' in fname:
+                    continue
+                key = os.path.relpath(os.path.join(root, fname), server.root_dir).replace(os.sep, '/')
+                if key.startswith(prefix) and key > after:
+                    keys.append(key)
+        keys.sort()
+        page = keys[:max_keys]
+        is_truncated = len(keys) > max_keys
+        items = []
+        for key in page:
+            st = os.stat(server._path_for_key(key))
+            last_modified = datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            items.append(
+                f'<Contents><Key>{escape(key)}</Key><LastModified>{last_modified}</LastModified>'
+                f'<ETag>"0"</ETag><Size>{st.st_size}</Size><StorageClass>STANDARD</StorageClass></Contents>'
+            )
+        if is_truncated:
+            items.insert(0, f'<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>')
+        xml = (
+            f'<?xml version="1.0" encoding="UTF-8"?><ListBucketResult xmlns="{_s3_xmlns}">'
+            f'<Name>bucket</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>'
+            f'<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{"true" if is_truncated else "false"}</IsTruncated>'
+            f'{"".join(items)}</ListBucketResult>'
+        )
+        self._send(200, xml.encode('utf-8'), headers={'Content-Type': 'application/xml'})
+
+    def _send_s3_delete_result(self):
+        server = self.zone_server
+        root = ElementTree.fromstring(self._read_body())
+        deleted = []
+        for element in root.iter():
+            if element.tag.split('}')[-1] == 'Key' and element.text:
+                path = server._path_for_key(element.text)
+                if os.path.isfile(path):
+                    os.remove(path)
+                deleted.append(element.text)
+        items = ''.join(f'<Deleted><Key>{escape(key)}</Key></Deleted>' for key in deleted)
+        xml = f'<?xml version="1.0" encoding="UTF-8"?><DeleteResult xmlns="{_s3_xmlns}">{items}</DeleteResult>'
+        self._send(200, xml.encode('utf-8'), headers={'Content-Type': 'application/xml'})
+
+    def _signed_url(self, url: str) -> str:
+        server = self.zone_server
+        return f'{server.base_url}/upload/{server._key_for_url(url)}'
+
+    def _serve_file(self, *, head: bool):
+        server = self.zone_server
+        parsed = urlparse(self.path)
+        kind = 'HEAD' if head else 'GET'
+        try:
+            path = server._path_for_key(parsed.path[1:])
+        except ValueError:
+            path = None
+        if path is None or not parsed.path.startswith('/zones/') or not os.path.isfile(path):
+            server._count(f'{kind} (not found)')
+            self._send(404, b'Not found', head=head)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size
+        status = 200
+        range_header = self.headers.get('Range', None)
+        if range_header is not None and range_header.startswith('bytes='):
+            a, b = range_header[len('bytes='):].split('-')
+            start = int(a)
+            end = min(int(b) + 1, size) if b else size
+            status = 206
+        with open(path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start) if not head else b''
+        server._count(f'{kind} range' if status == 206 else kind, sent=len(data))
+        headers = {'Content-Range': f'bytes {start}-{end - 1}/{size}'} if status == 206 else {}
+        self._send(status, data, headers=headers, head=head, content_length=end - start)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length > 0 else b''
+
+    def _send_json(self, x: dict):
+        self._send(200, json.dumps(x).encode('utf-8'), headers={'Content-Type': 'application/json'})
+
+    def _send(self, status: int, data: bytes, *, headers: Union[dict, None] = None, head: bool = False, content_length: Union[int, None] = None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(content_length if content_length is not None else len(data)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+
+
+_s3_xmlns = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+def _s3_error(code: str, key: str) -> bytes:
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code>'
+        f'<Key>{escape(key)}</Key></Error>'
+    ).encode('utf-8')
+
+
+def _write_file(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp.{threading.get_ident()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -3,7 +3,7 @@ import uuid
 import numpy as np
 import lindi_cloud
 import h5py
-from helpers.compute_correlogram_data import compute_correlogram_data
+from helpers.compute_correlogram_data import compute_autocorrelograms
 
 
 def example_add_autocorrelograms():
@@ -26,40 +26,23 @@ def example_add_autocorrelograms():
     total_num_spikes = len(spike_times)
     print(f'Loaded {num_units} units with {total_num_spikes} total spikes')
 
-    # Compute autocorrelograms for all the units
+    # Compute autocorrelograms for all the units (together, across a pool of
+    # processes)
     print('Computing autocorrelograms')
-    auto_correlograms = []
-    p = 0
     timer = time.time()
-    for i in range(num_units):
-        spike_train = spike_times[p:spike_times_index[i]]
-        elapsed = time.time() - timer
-        if elapsed > 2:
-            print(f'Computing autocorrelogram for unit {i + 1} of {num_units} ({len(spike_train)} spikes)')
-            timer = time.time()
-        r = compute_correlogram_data(
-            spike_train_1=spike_train,
-            spike_train_2=None,
-            window_size_msec=100,
-            bin_size_msec=1
-        )
-        bin_edges_sec = r['bin_edges_sec']
-        bin_counts = r['bin_counts']
-        auto_correlograms.append({
-            'bin_edges_sec': bin_edges_sec,
-            'bin_counts': bin_counts
-        })
-        p = spike_times_index[i]
-    autocorrelograms_array = np.zeros(
-        (num_units, len(auto_correlograms[0]['bin_counts'])),
-        dtype=np.uint32
+    r = compute_autocorrelograms(
+        spike_times=spike_times,
+        spike_times_index=spike_times_index,
+        window_size_msec=100,
+        bin_size_msec=1
     )
-    for i, ac in enumerate(auto_correlograms):
-        autocorrelograms_array[i, :] = ac['bin_counts']
+    print(f'Computed autocorrelograms in {time.time() - timer:.1f} seconds')
+    bin_edges_sec = r['bin_edges_sec']
+    autocorrelograms_array = r['bin_counts'].astype(np.uint32)
 
     # Create a new dataset in the units group to store the autocorrelograms
     ds = units_group.create_dataset('autocorrelogram', data=autocorrelograms_array)
-    ds.attrs['bin_edges_sec'] = auto_correlograms[0]['bin_edges_sec'].tolist()
+    ds.attrs['bin_edges_sec'] = bin_edges_sec.tolist()
     ds.attrs['description'] = 'the autocorrelogram for each spike unit'
     ds.attrs['namespace'] = 'hdmf-common'
     ds.attrs['neurodata_type'] = 'VectorData'
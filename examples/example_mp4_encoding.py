@@ -1,5 +1,6 @@
 import numpy as np
-from lindi_cloud import lindi_cloud_create, lindi_cloud_upload
+import cv2
+from lindi_cloud import lindi_cloud_create, lindi_cloud_upload, lindi_cloud_write_stream
 from neurosift.codecs import MP4AVCCodec
 
 MP4AVCCodec.register_codec()
@@ -11,12 +12,6 @@ def example_mp4_encoding():
 
     mp4avc_codec = MP4AVCCodec(fps=30)  # note: I actually don't know the fps of the video
 
-    # Read the video into a huge numpy array
-    print('Decoding video...')
-    with open(fname, 'rb') as f:
-        buf = f.read()
-        big_array = mp4avc_codec.decode(buf)
-
     # Create a lindi cloud client
     print('Creating lindi cloud client...')
     client = lindi_cloud_create(staging_dir="staging")
@@ -28,16 +23,16 @@ def example_mp4_encoding():
     print('Creating test_video...')
     test_video_group = group1.create_group('test_video')
     chunk_size = 2000
-    test_video_group.create_dataset_with_zarr_compressor(
-        'data',
-        shape=big_array.shape,
-        dtype=np.uint8,
-        compressor=mp4avc_codec,
-        chunks=(chunk_size, big_array.shape[1], big_array.shape[2], big_array.shape[3])
+    # the frames are decoded one block at a time, so the whole video never
+    # needs to fit in memory, and the chunks are encoded in parallel across
+    # the available cores
+    lindi_cloud_write_stream(
+        client,
+        'group1/test_video/data',
+        iterate_video_frames(fname, block_size=100),
+        chunks=(chunk_size, None, None, None),
+        compressor=mp4avc_codec
     )
-    for ii in range(0, big_array.shape[0], chunk_size):
-        print(f'Writing chunk {ii}...')
-        test_video_group['data'][ii:ii + chunk_size] = big_array[ii:ii + chunk_size]
     test_video_group.attrs['neurodata_type'] = 'test_video'
 
     dest_url = "https://lindi.neurosift.org/zones/magland/test1/f/example_mp4_encoding.zarr.json"
@@ -47,5 +42,23 @@ def example_mp4_encoding():
     print(ns_url)
 
 
+def iterate_video_frames(fname: str, *, block_size: int):
+    cap = cv2.VideoCapture(fname)
+    try:
+        block = []
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            block.append(frame[:, :, ::-1])  # BGR -> RGB
+            if len(block) == block_size:
+                yield np.stack(block)
+                block = []
+        if block:
+            yield np.stack(block)
+    finally:
+        cap.release()
+
+
 if __name__ == "__main__":
     example_mp4_encoding()
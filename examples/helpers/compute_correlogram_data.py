@@ -1,4 +1,6 @@
 from typing import Union
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
 
@@ -9,36 +11,20 @@ def compute_correlogram_data(
     window_size_msec: float = 100,
     bin_size_msec: float = 1
 ):
-    times1 = spike_train_1
-    num_bins = int(window_size_msec / bin_size_msec)
-    if num_bins % 2 == 0:
-        num_bins = num_bins - 1  # odd number of bins
-    num_bins_half = int((num_bins + 1) / 2)
-    bin_edges_msec = np.array(
-        (np.arange(num_bins + 1) - num_bins / 2) * bin_size_msec, dtype=np.float32
-    )
-    bin_counts = np.zeros((num_bins,), dtype=np.int32)
+    bin_edges_msec = _get_bin_edges_msec(window_size_msec, bin_size_msec)
     if spike_train_2 is None:
         # autocorrelogram
-        offset = 1
-        while True:
-            if offset >= len(times1):
-                break
-            deltas_msec = (times1[offset:] - times1[:-offset]) * 1000
-            deltas_msec = deltas_msec[deltas_msec <= bin_edges_msec[-1]]
-            if len(deltas_msec) == 0:
-                break
-            for i in range(num_bins_half):
-                start_msec = bin_edges_msec[num_bins_half - 1 + i]
-                end_msec = bin_edges_msec[num_bins_half + i]
-                ct = len(
-                    deltas_msec[(start_msec <= deltas_msec) & (deltas_msec < end_msec)]
-                )
-                bin_counts[num_bins_half - 1 + i] += ct
-                bin_counts[num_bins_half - 1 - i] += ct
-            offset = offset + 1
+        times1 = spike_train_1
+        counts = _count_pair_deltas(
+            times1,
+            unit_ids=np.zeros(times1.shape, dtype=np.int64),
+            num_units=1,
+            bin_edges_msec=bin_edges_msec
+        )
+        bin_counts = _mirror_counts(counts[0], counts[0])
     else:
         # cross-correlogram
+        times1 = spike_train_1
         times2 = spike_train_2
         all_times = np.concatenate((times1, times2))
         all_labels = np.concatenate(
@@ -47,50 +33,155 @@ def compute_correlogram_data(
         sort_inds = np.argsort(all_times)
         all_times = all_times[sort_inds]
         all_labels = all_labels[sort_inds]
-        offset = 1
-        while True:
-            if offset >= len(all_times):
-                break
-            deltas_msec = (all_times[offset:] - all_times[:-offset]) * 1000
-
-            deltas12_msec = deltas_msec[
-                (all_labels[offset:] == 2) & (all_labels[:-offset] == 1)
-            ]
-            deltas21_msec = deltas_msec[
-                (all_labels[offset:] == 1) & (all_labels[:-offset] == 2)
-            ]
-            deltas11_msec = deltas_msec[
-                (all_labels[offset:] == 1) & (all_labels[:-offset] == 1)
-            ]
-            deltas22_msec = deltas_msec[
-                (all_labels[offset:] == 2) & (all_labels[:-offset] == 2)
-            ]
-
-            deltas12_msec = deltas12_msec[deltas12_msec <= bin_edges_msec[-1]]
-            deltas21_msec = deltas21_msec[deltas21_msec <= bin_edges_msec[-1]]
-            deltas11_msec = deltas11_msec[deltas11_msec <= bin_edges_msec[-1]]
-            deltas22_msec = deltas22_msec[deltas22_msec <= bin_edges_msec[-1]]
+        counts12, counts21 = _count_pair_deltas(
+            all_times,
+            unit_ids=np.zeros(all_times.shape, dtype=np.int64),
+            num_units=1,
+            bin_edges_msec=bin_edges_msec,
+            labels=all_labels
+        )
+        bin_counts = _mirror_counts(counts12[0], counts21[0])
+    return {
+        "bin_edges_sec": (bin_edges_msec / 1000).astype(np.float32),
+        "bin_counts": bin_counts.astype(np.int32),
+    }
 
-            if len(deltas12_msec) + len(deltas21_msec) + len(deltas11_msec) + len(deltas22_msec) == 0:
-                break
 
-            for i in range(num_bins_half):
-                start_msec = bin_edges_msec[num_bins_half - 1 + i]
-                end_msec = bin_edges_msec[num_bins_half + i]
-                ct12 = len(
-                    deltas12_msec[
-                        (start_msec <= deltas12_msec) & (deltas12_msec < end_msec)
-                    ]
-                )
-                ct21 = len(
-                    deltas21_msec[
-                        (start_msec <= deltas21_msec) & (deltas21_msec < end_msec)
-                    ]
-                )
-                bin_counts[num_bins_half - 1 + i] += ct12
-                bin_counts[num_bins_half - 1 - i] += ct21
-            offset = offset + 1
+def compute_autocorrelograms(
+    *,
+    spike_times: np.ndarray,
+    spike_times_index: np.ndarray,
+    window_size_msec: float = 100,
+    bin_size_msec: float = 1,
+    num_workers: Union[int, None] = None
+):
+    # The autocorrelograms of all the units of a units table (in the ragged
+    # spike_times / spike_times_index layout) at once. The result is the same
+    # as calling compute_correlogram_data for each unit, but the units are
+    # processed together, in groups spread across a pool of processes.
+    bin_edges_msec = _get_bin_edges_msec(window_size_msec, bin_size_msec)
+    spike_times_index = np.asarray(spike_times_index, dtype=np.int64)
+    num_units = len(spike_times_index)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    # groups of consecutive units with about the same number of spikes
+    num_groups = min(num_units, 4 * num_workers) if num_workers > 1 else 1
+    boundaries = np.unique(np.concatenate((
+        [0],
+        np.searchsorted(spike_times_index, np.linspace(0, len(spike_times), num_groups + 1)[1:-1]),
+        [num_units]
+    )))
+    args = []
+    for a, b in zip(boundaries[:-1], boundaries[1:]):
+        start = spike_times_index[a - 1] if a > 0 else 0
+        args.append((spike_times[start:spike_times_index[b - 1]], spike_times_index[a:b] - start, bin_edges_msec))
+    if num_workers > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(_compute_autocorrelograms_for_units, *zip(*args)))
+    else:
+        results = [_compute_autocorrelograms_for_units(*x) for x in args]
+    bin_counts = np.zeros((num_units, len(bin_edges_msec) - 1), dtype=np.int32)
+    for a, b, r in zip(boundaries[:-1], boundaries[1:], results):
+        bin_counts[a:b] = r
     return {
         "bin_edges_sec": (bin_edges_msec / 1000).astype(np.float32),
-        "bin_counts": bin_counts.astype(np.int32),
+        "bin_counts": bin_counts,
     }
+
+
+def _compute_autocorrelograms_for_units(spike_times: np.ndarray, spike_times_index: np.ndarray, bin_edges_msec: np.ndarray) -> np.ndarray:
+    num_units = len(spike_times_index)
+    unit_sizes = np.diff(np.concatenate(([0], spike_times_index)))
+    unit_ids = np.repeat(np.arange(num_units), unit_sizes)
+    counts = _count_pair_deltas(
+        spike_times,
+        unit_ids=unit_ids,
+        num_units=num_units,
+        bin_edges_msec=bin_edges_msec
+    )
+    return _mirror_counts(counts, counts).astype(np.int32)
+
+
+def _get_bin_edges_msec(window_size_msec: float, bin_size_msec: float) -> np.ndarray:
+    num_bins = int(window_size_msec / bin_size_msec)
+    if num_bins % 2 == 0:
+        num_bins = num_bins - 1  # odd number of bins
+    return np.array(
+        (np.arange(num_bins + 1) - num_bins / 2) * bin_size_msec, dtype=np.float32
+    )
+
+
+def _count_pair_deltas(
+    times: np.ndarray,
+    *,
+    unit_ids: np.ndarray,
+    num_units: int,
+    bin_edges_msec: np.ndarray,
+    labels: Union[np.ndarray, None] = None
+):
+    # Bins the time differences of the pairs of spikes (i, i + offset) of the
+    # same unit for offset = 1, 2, ..., until there is no pair within the
+    # window, into the non-negative half of the bins: bin i counts the
+    # deltas in [edge[num_bins_half - 1 + i], edge[num_bins_half + i]).
+    #
+    # The deltas are computed and compared exactly as in the original
+    # per-offset loop, so the counts are identical. When the spike times of a
+    # unit are sorted, a pair that is outside the window at some offset stays
+    # outside at all larger offsets, so only the pairs that were within the
+    # window are carried over to the next offset. Otherwise all the pairs of
+    # the unit are, as long as some pair is within the window.
+    #
+    # Without labels, returns the counts for each unit. With labels (1 or 2
+    # for each spike) returns the counts for the pairs where the earlier spike
+    # is 1 and the later is 2, and those where the earlier is 2 and the later
+    # is 1.
+    num_bins = len(bin_edges_msec) - 1
+    num_bins_half = int((num_bins + 1) / 2)
+    upper_edges = bin_edges_msec[num_bins_half - 1:].astype(np.float64)
+    max_delta_msec = bin_edges_msec[-1]
+    same_unit_as_next = unit_ids[1:] == unit_ids[:-1]
+    out_of_order = same_unit_as_next & ~(times[1:] >= times[:-1])
+    unit_is_sorted = np.bincount(unit_ids[1:][out_of_order], minlength=num_units) == 0
+    spike_is_sorted = unit_is_sorted[unit_ids]
+    counts_a = np.zeros(num_units * num_bins_half, dtype=np.int64)
+    counts_b = np.zeros(num_units * num_bins_half, dtype=np.int64) if labels is not None else counts_a
+    active = np.nonzero(same_unit_as_next)[0]
+    offset = 1
+    while len(active) > 0:
+        deltas_msec = (times[active + offset] - times[active]) * 1000
+        within = deltas_msec <= max_delta_msec
+        i1 = active[within]
+        d = deltas_msec[within]
+        bin_inds = np.searchsorted(upper_edges, d, side='right') - 1
+        ok = (bin_inds >= 0) & (bin_inds < num_bins_half)
+        flat_inds = unit_ids[i1] * num_bins_half + bin_inds
+        if labels is None:
+            counts_a += np.bincount(flat_inds[ok], minlength=len(counts_a))
+        else:
+            later = labels[i1 + offset]
+            earlier = labels[i1]
+            counts_a += np.bincount(flat_inds[ok & (earlier == 1) & (later == 2)], minlength=len(counts_a))
+            counts_b += np.bincount(flat_inds[ok & (earlier == 2) & (later == 1)], minlength=len(counts_b))
+        unit_is_alive = np.bincount(unit_ids[i1], minlength=num_units) > 0
+        keep = np.where(spike_is_sorted[active], within, unit_is_alive[unit_ids[active]])
+        active = active[keep]
+        offset = offset + 1
+        # the pair at the next offset must still be within the unit
+        active = active[active + offset < len(times)]
+        active = active[unit_ids[active + offset] == unit_ids[active]]
+    counts_a = counts_a.reshape((num_units, num_bins_half))
+    counts_b = counts_b.reshape((num_units, num_bins_half))
+    if labels is None:
+        return counts_a
+    return counts_a, counts_b
+
+
+def _mirror_counts(counts_forward: np.ndarray, counts_backward: np.ndarray) -> np.ndarray:
+    # counts_forward[i] goes to bin num_bins_half - 1 + i and
+    # counts_backward[i] to bin num_bins_half - 1 - i (both to the center bin
+    # for i = 0)
+    num_bins_half = counts_forward.shape[-1]
+    bin_counts = np.zeros(counts_forward.shape[:-1] + (2 * num_bins_half - 1,), dtype=np.int64)
+    bin_counts[..., num_bins_half - 1:] += counts_forward
+    bin_counts[..., num_bins_half - 1::-1] += counts_backward
+    return bin_counts
@@ -34,11 +34,40 @@ export default allowCors(async (req, res) => {
     return;
   }
   const { url } = rr;
+  const parsed = parseUploadUrl(url);
+  if ("error" in parsed) {
+    res.status(400).json({ error: parsed.error });
+    return;
+  }
+  const { userName } = parsed;
+
+  const accessToken = req.headers.authorization?.split(" ")[1]; // Extract the token
+
+  if (!accessToken) {
+    res.status(401).json({ error: "No access token provided" });
+    return;
+  }
+
+  const verifiedGithubUserId = await githubVerifyAccessToken(accessToken);
+  if (!verifiedGithubUserId) {
+    throw Error("No user id found for access token");
+  }
+  if (verifiedGithubUserId !== userName) {
+    res.status(401).json({ error: "Access token does not match zone user" });
+    return;
+  }
+
+  const signedUrl = await createSignedUploadUrl(url);
+  res.status(200).json({ signedUrl });
+});
+
+// Checks that the url is a valid zone url that can be uploaded to, and
+// returns the user name of the zone (or an error message)
+export const parseUploadUrl = (url: string): { userName: string } | { error: string } => {
   const parts = url.split("/");
 
   if (!url.startsWith("https://lindi.neurosift.org/zones/")) {
-    res.status(400).json({ error: "Invalid url in request *1*" });
-    return;
+    return { error: "Invalid url in request *1*" };
   }
 
   const userName = parts[4];
@@ -47,76 +76,50 @@ export default allowCors(async (req, res) => {
   const fileName = parts.slice(7).join("/");
 
   if (!userName || !zoneName || !fileBasePart || !fileName) {
-    res.status(400).json({ error: "Invalid url in request *2*" });
-    return;
+    return { error: "Invalid url in request *2*" };
   }
 
   if (fileBasePart === "sha1") {
     // fileName should be like 00/00/00/0000000....
     const pp = fileName.split("/");
     if (pp.length !== 4) {
-      res.status(400).json({ error: "Invalid url in request *3*" });
-      return;
+      return { error: "Invalid url in request *3*" };
     }
     if (pp[0].length !== 2 || pp[1].length !== 2 || pp[2].length !== 2) {
-      res.status(400).json({ error: "Invalid url in request *4*" });
-      return;
+      return { error: "Invalid url in request *4*" };
     }
     if (pp[3].length !== 40) {
-      res.status(400).json({ error: "Invalid url in request *5*" });
-      return;
+      return { error: "Invalid url in request *5*" };
     }
     if (pp[3].slice(0, 6) !== pp[0] + pp[1] + pp[2]) {
-      res.status(400).json({ error: "Invalid url in request *6*" });
-      return;
+      return { error: "Invalid url in request *6*" };
     }
   } else if (fileBasePart === "f") {
     if (fileName.length > 1000) {
-      res.status(400).json({ error: "Invalid url in request *7*" });
-      return;
+      return { error: "Invalid url in request *7*" };
     }
     const pp = fileName.split("/");
     // check for any . or .. in the path
     if (pp.some((x) => x === "." || x === "..")) {
-      res.status(400).json({ error: "Invalid url in request *8*" });
-      return;
+      return { error: "Invalid url in request *8*" };
     }
     // check for empty parts
     if (pp.some((x) => x === "")) {
-      res.status(400).json({ error: "Invalid url in request *9*" });
-      return;
+      return { error: "Invalid url in request *9*" };
     }
   } else {
-    res.status(400).json({ error: "Invalid url in request *10*" });
-    return;
-  }
-
-  const accessToken = req.headers.authorization?.split(" ")[1]; // Extract the token
-
-  if (!accessToken) {
-    res.status(401).json({ error: "No access token provided" });
-    return;
+    return { error: "Invalid url in request *10*" };
   }
 
-  const verifiedGithubUserId = await githubVerifyAccessToken(accessToken);
-  if (!verifiedGithubUserId) {
-    throw Error("No user id found for access token");
-  }
-  if (verifiedGithubUserId !== userName) {
-    res.status(401).json({ error: "Access token does not match zone user" });
-    return;
-  }
-
-  const signedUrl = await createSignedUploadUrl(url);
-  res.status(200).json({ signedUrl });
-});
+  return { userName };
+};
 
 export const bucket: Bucket = {
   uri: "r2://neurosift-lindi",
   credentials: BUCKET_CREDENTIALS,
 }
 
-const createSignedUploadUrl = async (url: string) => {
+export const createSignedUploadUrl = async (url: string) => {
   const pp = url.split("/");
   const keyInBucket = pp.slice(3).join("/");
   if (!keyInBucket.startsWith("zones/")) {
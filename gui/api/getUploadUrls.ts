@@ -0,0 +1,129 @@
+/* eslint-disable @typescript-eslint/no-explicit-any */
+import { isEqualTo, validateObject } from "@fi-sci/misc";
+import allowCors from "../apiHelpers/allowCors.js";
+import githubVerifyAccessToken from "../apiHelpers/githubVerifyAccessToken.js";
+import ObjectCache from "../apiHelpers/ObjectCache.js";
+import { objectExists, refreshObject } from "../apiHelpers/s3Helpers.js";
+import { bucket, createSignedUploadUrl, parseUploadUrl } from "./getUploadUrl.js";
+
+// Batch version of getUploadUrl: for each url, reports whether the object
+// already exists and, if not, returns a signed upload url. This way the
+// client does not need a HEAD request and a getUploadUrl request per blob.
+
+const MAX_URLS_PER_REQUEST = 1000;
+const NUM_PARALLEL_CHECKS = 50;
+
+// sha1 blobs are content addressed, so an existing blob is reused instead of
+// being uploaded again. It is refreshed (a marker object next to it is
+// written, see refreshObject) when it is reported to exist, so that the
+// garbage collector (lindi_cloud_gc), which only deletes blobs that were not
+// modified or refreshed within its grace period, does not delete it while
+// the upload that reuses it is in progress. A blob that was refreshed in the
+// last 10 minutes is reported without refreshing it again; this is much
+// shorter than the grace period, so the cache never reports a blob that was
+// garbage collected.
+const existingBlobCache = new ObjectCache<boolean>(1000 * 60 * 10);
+
+type GetUploadUrlsRequest = {
+  type: "getUploadUrls";
+  urls: string[];
+};
+
+type GetUploadUrlsResult = {
+  url: string;
+  exists: boolean;
+  signedUrl?: string;
+};
+
+const isArrayOfStrings = (x: any): x is string[] => {
+  return Array.isArray(x) && x.every((a) => typeof a === "string");
+};
+
+const isGetUploadUrlsRequest = (x: any): x is GetUploadUrlsRequest => {
+  return validateObject(x, {
+    type: isEqualTo("getUploadUrls"),
+    urls: isArrayOfStrings,
+  });
+};
+
+export default allowCors(async (req, res) => {
+  // check that it is a post request
+  if (req.method !== "POST") {
+    res.status(405).json({ error: "Method not allowed" });
+    return;
+  }
+  const rr = req.body;
+  if (!isGetUploadUrlsRequest(rr)) {
+    res.status(400).json({ error: "Invalid request" });
+    return;
+  }
+  const { urls } = rr;
+  if (urls.length > MAX_URLS_PER_REQUEST) {
+    res.status(400).json({ error: `Too many urls in request (max ${MAX_URLS_PER_REQUEST})` });
+    return;
+  }
+
+  const userNames = new Set<string>();
+  for (const url of urls) {
+    const parsed = parseUploadUrl(url);
+    if ("error" in parsed) {
+      res.status(400).json({ error: `${parsed.error}: ${url}` });
+      return;
+    }
+    userNames.add(parsed.userName);
+  }
+
+  const accessToken = req.headers.authorization?.split(" ")[1]; // Extract the token
+
+  if (!accessToken) {
+    res.status(401).json({ error: "No access token provided" });
+    return;
+  }
+
+  // this is cached, so a sequence of batch requests only verifies the token once
+  const verifiedGithubUserId = await githubVerifyAccessToken(accessToken);
+  if (!verifiedGithubUserId) {
+    throw Error("No user id found for access token");
+  }
+  for (const userName of userNames) {
+    if (verifiedGithubUserId !== userName) {
+      res.status(401).json({ error: "Access token does not match zone user" });
+      return;
+    }
+  }
+
+  const results: GetUploadUrlsResult[] = new Array(urls.length);
+  const processUrl = async (i: number) => {
+    const url = urls[i];
+    const exists = await checkExists(url);
+    if (exists) {
+      results[i] = { url, exists: true };
+    } else {
+      results[i] = { url, exists: false, signedUrl: await createSignedUploadUrl(url) };
+    }
+  };
+  for (let i = 0; i < urls.length; i += NUM_PARALLEL_CHECKS) {
+    const batch: Promise<void>[] = [];
+    for (let j = i; j < Math.min(i + NUM_PARALLEL_CHECKS, urls.length); j++) {
+      batch.push(processUrl(j));
+    }
+    await Promise.all(batch);
+  }
+  res.status(200).json({ results });
+});
+
+const checkExists = async (url: string): Promise<boolean> => {
+  const isBlob = url.split("/")[6] === "sha1";
+  const keyInBucket = url.split("/").slice(3).join("/");
+  if (!isBlob) {
+    return await objectExists(bucket, keyInBucket);
+  }
+  if (existingBlobCache.get(url)) {
+    return true;
+  }
+  const exists = await refreshObject(bucket, keyInBucket);
+  if (exists) {
+    existingBlobCache.set(url, true);
+  }
+  return exists;
+};
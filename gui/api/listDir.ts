@@ -1,16 +1,68 @@
 /* eslint-disable @typescript-eslint/no-explicit-any */
 import { isEqualTo, isString, validateObject } from "@fi-sci/misc";
 import allowCors from "../apiHelpers/allowCors.js";
-import getS3Client from "../apiHelpers/getS3Client.js";
+import ObjectCache from "../apiHelpers/ObjectCache.js";
+import { listObjects } from "../apiHelpers/s3Helpers.js";
 import { bucket } from "./getUploadUrl.js";
 
+// Lists the files and subdirectories of a directory one page at a time. A
+// page is filled from as many listObjectsV2 calls as needed (each returns at
+// most 1000 entries), and the returned cursor continues the listing.
+//
+// With includeTotals, the total size and number of the objects under the
+// directory (at any depth) are also returned. For a large directory these
+// cannot be counted within a single request, so the count proceeds for a
+// limited time per request and is resumed by the next one; totals.complete
+// tells whether it is done. Use maxItems: 0 to only advance the totals.
+//
+// Until the count is complete, totals.cursor holds where it stopped (the
+// listing position and the partial size and count), and the client passes it
+// back as totalsCursor, so that the next request can continue on any
+// instance. totalsCache only saves the work when the same instance is hit
+// again. The totals are only informative, so the cursor is not signed.
+
+const DEFAULT_MAX_ITEMS = 1000;
+const MAX_MAX_ITEMS = 5000;
+const MAX_KEYS_PER_CALL = 1000;
+const TOTALS_TIME_BUDGET_MSEC = 5000;
+
+type ListDirPage = {
+  files: { name: string; size: number; lastModified: number }[];
+  dirNames: string[];
+  cursor?: string;
+};
+
+type DirTotals = {
+  size: number;
+  count: number;
+  // where to resume counting, if not complete
+  continuationToken?: string;
+  complete: boolean;
+};
+
+// listings change whenever something is uploaded, so they are only cached
+// long enough to absorb repeated requests (e.g., browser refreshes)
+const listingCache = new ObjectCache<ListDirPage>(1000 * 60);
+const totalsCache = new ObjectCache<DirTotals>(1000 * 60 * 10);
+
 type ListDirRequest = {
   type: "listDir";
   url: string;
+  cursor?: string;
+  maxItems?: number;
+  includeTotals?: boolean;
+  totalsCursor?: string;
 };
 
 const isListDirRequest = (x: any): x is ListDirRequest => {
-  return validateObject(x, {
+  if (!x || typeof x !== "object") return false;
+  // the optional fields are checked here, the rest by validateObject
+  const { cursor, maxItems, includeTotals, totalsCursor, ...rest } = x;
+  if (cursor !== undefined && typeof cursor !== "string") return false;
+  if (maxItems !== undefined && typeof maxItems !== "number") return false;
+  if (includeTotals !== undefined && typeof includeTotals !== "boolean") return false;
+  if (totalsCursor !== undefined && typeof totalsCursor !== "string") return false;
+  return validateObject(rest, {
     type: isEqualTo("listDir"),
     url: isString,
   });
@@ -27,32 +79,115 @@ export default allowCors(async (req, res) => {
     res.status(400).json({ error: "Invalid request" });
     return;
   }
-  const { url } = rr;
+  const { url, cursor, includeTotals } = rr;
+  const maxItems = rr.maxItems !== undefined ? rr.maxItems : DEFAULT_MAX_ITEMS;
   const parts = url.split("/");
 
   if (!url.startsWith("https://lindi.neurosift.org/zones")) {
     res.status(400).json({ error: "Invalid url in request *1*" });
     return;
   }
+  if (!Number.isInteger(maxItems) || maxItems < 0 || maxItems > MAX_MAX_ITEMS) {
+    res.status(400).json({ error: `Invalid maxItems (must be between 0 and ${MAX_MAX_ITEMS})` });
+    return;
+  }
 
-  const s3 = getS3Client(bucket);
-  s3.listObjectsV2({
-    Bucket: 'neurosift-lindi',
-    Prefix: parts.slice(3).filter((x: string) => x).join('/') + '/',
-    Delimiter: '/',
-    ContinuationToken: undefined,
-    MaxKeys: 1000
-  }, (err, data) => {
-    if (err) {
-      res.status(400).json({ error: `Error listing objects: ${err.message}` });
-      return;
-    }
-    const files = data.Contents.map((x: any) => ({ 
-        name: x.Key.split('/').slice(-1)[0], 
-        size: x.Size, // Include the file size
-        lastModified: Math.floor(new Date(x.LastModified).getTime() / 1000) // Convert to seconds since epoch
-    }));
-    const dirNames = data.CommonPrefixes.map((x: any) => x.Prefix).map((x: string) => x.split('/').slice(-2, -1)[0]);
-    res.status(200).json({ files, dirNames });
-  });
+  const prefix = parts.slice(3).filter((x: string) => x).join("/") + "/";
+  const resumeFrom = rr.totalsCursor !== undefined ? decodeTotalsCursor(prefix, rr.totalsCursor) : undefined;
+  if (rr.totalsCursor !== undefined && !resumeFrom) {
+    res.status(400).json({ error: "Invalid totalsCursor" });
+    return;
+  }
+  try {
+    const page: ListDirPage = maxItems > 0 ? await listDirPage(prefix, cursor, maxItems) : { files: [], dirNames: [] };
+    const totals = includeTotals ? await advanceTotals(prefix, resumeFrom) : undefined;
+    res.status(200).json({
+      ...page,
+      totals: totals
+        ? {
+            size: totals.size,
+            count: totals.count,
+            complete: totals.complete,
+            cursor: totals.complete ? undefined : encodeTotalsCursor(prefix, totals),
+          }
+        : undefined,
+    });
+  } catch (err: any) {
+    res.status(400).json({ error: `Error listing objects: ${err.message}` });
+  }
 });
+
+const listDirPage = async (prefix: string, cursor: string | undefined, maxItems: number): Promise<ListDirPage> => {
+  const cacheKey = `${prefix}|${cursor || ""}|${maxItems}`;
+  const cached = listingCache.get(cacheKey);
+  if (cached) return cached;
+  const page: ListDirPage = { files: [], dirNames: [] };
+  let continuationToken = cursor;
+  // eslint-disable-next-line no-constant-condition
+  while (true) {
+    const remaining = maxItems - page.files.length - page.dirNames.length;
+    const data = await listObjects(bucket, prefix, {
+      continuationToken,
+      maxObjects: Math.min(remaining, MAX_KEYS_PER_CALL),
+      delimiter: "/",
+    });
+    for (const x of data.objects) {
+      page.files.push({
+        name: x.Key.split("/").slice(-1)[0],
+        size: x.Size,
+        lastModified: Math.floor(new Date(x.LastModified).getTime() / 1000), // Convert to seconds since epoch
+      });
+    }
+    for (const p of data.commonPrefixes) {
+      page.dirNames.push(p.split("/").slice(-2, -1)[0]);
+    }
+    continuationToken = data.continuationToken;
+    if (!continuationToken || page.files.length + page.dirNames.length >= maxItems) break;
+  }
+  page.cursor = continuationToken;
+  listingCache.set(cacheKey, page);
+  return page;
+};
+
+const advanceTotals = async (prefix: string, resumeFrom: DirTotals | undefined): Promise<DirTotals> => {
+  const cached = totalsCache.get(prefix);
+  if (cached && cached.complete) return cached;
+  // continue from whichever got further
+  const start = resumeFrom && (!cached || resumeFrom.count > cached.count) ? resumeFrom : cached;
+  const totals: DirTotals = start ? { ...start } : { size: 0, count: 0, complete: false };
+  const timer = Date.now();
+  while (Date.now() - timer < TOTALS_TIME_BUDGET_MSEC) {
+    const data = await listObjects(bucket, prefix, {
+      continuationToken: totals.continuationToken,
+      maxObjects: MAX_KEYS_PER_CALL,
+    });
+    for (const x of data.objects) {
+      totals.size += x.Size;
+      totals.count += 1;
+    }
+    totals.continuationToken = data.continuationToken;
+    if (!data.continuationToken) {
+      totals.complete = true;
+      break;
+    }
+  }
+  totalsCache.set(prefix, totals);
+  return totals;
+};
+
+const encodeTotalsCursor = (prefix: string, totals: DirTotals): string => {
+  const x = { prefix, size: totals.size, count: totals.count, continuationToken: totals.continuationToken };
+  return Buffer.from(JSON.stringify(x)).toString("base64url");
+};
+
+const decodeTotalsCursor = (prefix: string, totalsCursor: string): DirTotals | undefined => {
+  let x: any;
+  try {
+    x = JSON.parse(Buffer.from(totalsCursor, "base64url").toString("utf-8"));
+  } catch (err) {
+    return undefined;
+  }
+  if (!x || typeof x !== "object" || x.prefix !== prefix) return undefined;
+  if (!Number.isInteger(x.size) || !Number.isInteger(x.count) || typeof x.continuationToken !== "string") return undefined;
+  return { size: x.size, count: x.count, continuationToken: x.continuationToken, complete: false };
+};
@@ -0,0 +1,194 @@
+/* eslint-disable @typescript-eslint/no-explicit-any */
+import { isEqualTo, isString, validateObject } from "@fi-sci/misc";
+import allowCors from "../apiHelpers/allowCors.js";
+import githubVerifyAccessToken from "../apiHelpers/githubVerifyAccessToken.js";
+import {
+  abortMultipartUpload,
+  completeMultipartUpload,
+  createMultipartUpload,
+  getSignedUploadPartUrl,
+  listUploadedParts,
+} from "../apiHelpers/s3Helpers.js";
+import { bucket, parseUploadUrl } from "./getUploadUrl.js";
+
+// Multipart uploads for large blobs, so that an interrupted upload can be
+// resumed from the last completed part. The client initiates the upload,
+// gets signed urls for the parts (and PUTs them directly to the bucket),
+// and then completes the upload with the ETags of the parts.
+
+const MAX_PART_NUMBER = 10000;
+const MAX_PARTS_PER_REQUEST = 1000;
+
+type InitiateMultipartUploadRequest = {
+  type: "initiateMultipartUpload";
+  url: string;
+};
+
+type GetUploadPartUrlsRequest = {
+  type: "getUploadPartUrls";
+  url: string;
+  uploadId: string;
+  partNumbers: number[];
+};
+
+type ListUploadedPartsRequest = {
+  type: "listUploadedParts";
+  url: string;
+  uploadId: string;
+};
+
+type CompleteMultipartUploadRequest = {
+  type: "completeMultipartUpload";
+  url: string;
+  uploadId: string;
+  parts: { partNumber: number; etag: string }[];
+};
+
+type AbortMultipartUploadRequest = {
+  type: "abortMultipartUpload";
+  url: string;
+  uploadId: string;
+};
+
+const isPartNumber = (x: any): x is number => {
+  return Number.isInteger(x) && x >= 1 && x <= MAX_PART_NUMBER;
+};
+
+const isArrayOfPartNumbers = (x: any): x is number[] => {
+  return Array.isArray(x) && x.length <= MAX_PARTS_PER_REQUEST && x.every(isPartNumber);
+};
+
+const isArrayOfCompletedParts = (x: any): x is { partNumber: number; etag: string }[] => {
+  return (
+    Array.isArray(x) &&
+    x.length <= MAX_PART_NUMBER &&
+    x.every((p) =>
+      validateObject(p, {
+        partNumber: isPartNumber,
+        etag: isString,
+      })
+    )
+  );
+};
+
+const isInitiateMultipartUploadRequest = (x: any): x is InitiateMultipartUploadRequest => {
+  return validateObject(x, {
+    type: isEqualTo("initiateMultipartUpload"),
+    url: isString,
+  });
+};
+
+const isGetUploadPartUrlsRequest = (x: any): x is GetUploadPartUrlsRequest => {
+  return validateObject(x, {
+    type: isEqualTo("getUploadPartUrls"),
+    url: isString,
+    uploadId: isString,
+    partNumbers: isArrayOfPartNumbers,
+  });
+};
+
+const isListUploadedPartsRequest = (x: any): x is ListUploadedPartsRequest => {
+  return validateObject(x, {
+    type: isEqualTo("listUploadedParts"),
+    url: isString,
+    uploadId: isString,
+  });
+};
+
+const isCompleteMultipartUploadRequest = (x: any): x is CompleteMultipartUploadRequest => {
+  return validateObject(x, {
+    type: isEqualTo("completeMultipartUpload"),
+    url: isString,
+    uploadId: isString,
+    parts: isArrayOfCompletedParts,
+  });
+};
+
+const isAbortMultipartUploadRequest = (x: any): x is AbortMultipartUploadRequest => {
+  return validateObject(x, {
+    type: isEqualTo("abortMultipartUpload"),
+    url: isString,
+    uploadId: isString,
+  });
+};
+
+export default allowCors(async (req, res) => {
+  // check that it is a post request
+  if (req.method !== "POST") {
+    res.status(405).json({ error: "Method not allowed" });
+    return;
+  }
+  const rr = req.body;
+  if (
+    !isInitiateMultipartUploadRequest(rr) &&
+    !isGetUploadPartUrlsRequest(rr) &&
+    !isListUploadedPartsRequest(rr) &&
+    !isCompleteMultipartUploadRequest(rr) &&
+    !isAbortMultipartUploadRequest(rr)
+  ) {
+    res.status(400).json({ error: "Invalid request" });
+    return;
+  }
+  const { url } = rr;
+  const parsed = parseUploadUrl(url);
+  if ("error" in parsed) {
+    res.status(400).json({ error: parsed.error });
+    return;
+  }
+  const { userName } = parsed;
+
+  const accessToken = req.headers.authorization?.split(" ")[1]; // Extract the token
+
+  if (!accessToken) {
+    res.status(401).json({ error: "No access token provided" });
+    return;
+  }
+
+  const verifiedGithubUserId = await githubVerifyAccessToken(accessToken);
+  if (!verifiedGithubUserId) {
+    throw Error("No user id found for access token");
+  }
+  if (verifiedGithubUserId !== userName) {
+    res.status(401).json({ error: "Access token does not match zone user" });
+    return;
+  }
+
+  const keyInBucket = url.split("/").slice(3).join("/");
+  if (!keyInBucket.startsWith("zones/")) {
+    throw Error("Unexpected: Invalid key in bucket");
+  }
+
+  if (isInitiateMultipartUploadRequest(rr)) {
+    const uploadId = await createMultipartUpload(bucket, keyInBucket);
+    res.status(200).json({ uploadId });
+  } else if (isGetUploadPartUrlsRequest(rr)) {
+    const signedUrls = await Promise.all(
+      rr.partNumbers.map((partNumber) => getSignedUploadPartUrl(bucket, keyInBucket, rr.uploadId, partNumber))
+    );
+    res.status(200).json({ signedUrls });
+  } else if (isListUploadedPartsRequest(rr)) {
+    let parts: { PartNumber: number; ETag: string; Size: number }[];
+    try {
+      parts = await listUploadedParts(bucket, keyInBucket, rr.uploadId);
+    } catch (err: any) {
+      // most likely the upload was completed, aborted or expired
+      res.status(404).json({ error: `Unable to list parts: ${err.message}` });
+      return;
+    }
+    res.status(200).json({
+      parts: parts.map((p) => ({ partNumber: p.PartNumber, etag: p.ETag, size: p.Size })),
+    });
+  } else if (isCompleteMultipartUploadRequest(rr)) {
+    const parts = [...rr.parts].sort((a, b) => a.partNumber - b.partNumber);
+    await completeMultipartUpload(
+      bucket,
+      keyInBucket,
+      rr.uploadId,
+      parts.map((p) => ({ PartNumber: p.partNumber, ETag: p.etag }))
+    );
+    res.status(200).json({ success: true });
+  } else {
+    await abortMultipartUpload(bucket, keyInBucket, rr.uploadId);
+    res.status(200).json({ success: true });
+  }
+});
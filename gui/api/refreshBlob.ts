@@ -0,0 +1,66 @@
+/* eslint-disable @typescript-eslint/no-explicit-any */
+import { isEqualTo, isString, validateObject } from "@fi-sci/misc";
+import allowCors from "../apiHelpers/allowCors.js";
+import githubVerifyAccessToken from "../apiHelpers/githubVerifyAccessToken.js";
+import { refreshObject } from "../apiHelpers/s3Helpers.js";
+import { bucket, parseUploadUrl } from "./getUploadUrl.js";
+
+// Refreshes a single sha1 blob that an upload is going to reuse (see
+// refreshObject and lindi_cloud_gc), for clients that check whether blobs
+// exist with HEAD requests rather than with getUploadUrls.
+
+type RefreshBlobRequest = {
+  type: "refreshBlob";
+  url: string;
+};
+
+const isRefreshBlobRequest = (x: any): x is RefreshBlobRequest => {
+  return validateObject(x, {
+    type: isEqualTo("refreshBlob"),
+    url: isString,
+  });
+};
+
+export default allowCors(async (req, res) => {
+  // check that it is a post request
+  if (req.method !== "POST") {
+    res.status(405).json({ error: "Method not allowed" });
+    return;
+  }
+  const rr = req.body;
+  if (!isRefreshBlobRequest(rr)) {
+    res.status(400).json({ error: "Invalid request" });
+    return;
+  }
+  const { url } = rr;
+  const parsed = parseUploadUrl(url);
+  if ("error" in parsed) {
+    res.status(400).json({ error: parsed.error });
+    return;
+  }
+  if (url.split("/")[6] !== "sha1") {
+    res.status(400).json({ error: "Not a blob url" });
+    return;
+  }
+  const { userName } = parsed;
+
+  const accessToken = req.headers.authorization?.split(" ")[1]; // Extract the token
+
+  if (!accessToken) {
+    res.status(401).json({ error: "No access token provided" });
+    return;
+  }
+
+  const verifiedGithubUserId = await githubVerifyAccessToken(accessToken);
+  if (!verifiedGithubUserId) {
+    throw Error("No user id found for access token");
+  }
+  if (verifiedGithubUserId !== userName) {
+    res.status(401).json({ error: "Access token does not match zone user" });
+    return;
+  }
+
+  const keyInBucket = url.split("/").slice(3).join("/");
+  const exists = await refreshObject(bucket, keyInBucket);
+  res.status(200).json({ exists });
+});
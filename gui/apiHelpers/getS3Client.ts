@@ -33,6 +33,19 @@ interface GetSignedUrlParamsX {
     Bucket: any
     Key: any
     Expires: number
+    UploadId?: string
+    PartNumber?: number
+}
+
+interface MultipartUploadParamsX {
+    Bucket: string
+    Key: string
+    UploadId: string
+}
+
+export interface CompletedPartX {
+    PartNumber: number
+    ETag: string
 }
 
 export interface HeadObjectOutputX {
@@ -54,6 +67,10 @@ interface S3Client {
     listObjectsV2: (params: {Bucket: string, Prefix: string, Delimiter?: string, ContinuationToken?: string, MaxKeys?: number}, callback: (err?: any, data?: any) => void) => void
     copyObject: (params: {Bucket: string, CopySource: string, Key: string}, callback: (err?: any, data?: any) => void) => void
     putBucketCors: (params: PutBucketCorsParamsX, callback: (err?: any, data?: any) => void) => void
+    createMultipartUpload: (params: {Bucket: string, Key: string}, callback: (err?: any, data?: {UploadId?: string}) => void) => void
+    listParts: (params: MultipartUploadParamsX & {PartNumberMarker?: number}, callback: (err?: any, data?: any) => void) => void
+    completeMultipartUpload: (params: MultipartUploadParamsX & {MultipartUpload: {Parts: CompletedPartX[]}}, callback: (err?: any, data?: any) => void) => void
+    abortMultipartUpload: (params: MultipartUploadParamsX, callback: (err?: any, data?: any) => void) => void
 }
 
 const expirationMSec = 1000 * 60 * 10
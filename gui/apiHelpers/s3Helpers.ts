@@ -1,6 +1,6 @@
 /* eslint-disable @typescript-eslint/no-explicit-any */
 import { PutObjectRequest } from "aws-sdk/clients/s3";
-import getS3Client, { HeadObjectOutputX } from "./getS3Client.js";
+import getS3Client, { CompletedPartX, HeadObjectOutputX } from "./getS3Client.js";
 
 export type Bucket = {
     uri: string // e.g., wasabi://kachery-cloud?region=us-east-1
@@ -100,6 +100,25 @@ export const copyObject = async (bucket: Bucket, srcKey: string, dstKey: string)
     })
 }
 
+// The suffix of the (empty) marker object that refreshObject writes next to
+// an object. lindi_cloud_gc takes the LastModified of a sha1 blob to be the
+// later of its own and that of its marker.
+export const refreshMarkerSuffix = '.refreshed'
+
+// Marks an object as recently used without copying it (a blob can be large),
+// by writing a marker object next to it. Resolves to false if the object does
+// not exist.
+export const refreshObject = async (bucket: Bucket, key: string): Promise<boolean> => {
+    const exists = await objectExists(bucket, key)
+    if (!exists) return false
+    await putObject(bucket, {
+        Bucket: bucketNameFromUri(bucket.uri),
+        Key: `${key}${refreshMarkerSuffix}`,
+        Body: ''
+    })
+    return true
+}
+
 export const renameObject = async (bucket: Bucket, srcKey: string, dstKey: string): Promise<void> => {
     await copyObject(bucket, srcKey, dstKey)
     await deleteObject(bucket, srcKey)
@@ -214,13 +233,23 @@ export const formBucketObjectUrl = (bucket: Bucket, objectKey: string) => {
     return `${bucketBaseUrl}/${objectKey}`
 }
 
-export const listObjects = async (bucket: Bucket, prefix: string, o: {continuationToken?: string, maxObjects?: number}={}): Promise<{objects: {Key: string, Size: number}[], continuationToken: string | undefined}> => {
+export type ListedObject = {
+    Key: string
+    Size: number
+    LastModified: Date
+}
+
+// One page of a listing (at most 1000 entries, counting both objects and
+// common prefixes). With a delimiter, the keys below the next delimiter are
+// rolled up into commonPrefixes.
+export const listObjects = async (bucket: Bucket, prefix: string, o: {continuationToken?: string, maxObjects?: number, delimiter?: string}={}): Promise<{objects: ListedObject[], commonPrefixes: string[], continuationToken: string | undefined}> => {
     const {bucketName} = parseBucketUri(bucket.uri)
     return new Promise((resolve, reject) => {
         const s3Client = getS3Client(bucket)
         s3Client.listObjectsV2({
             Bucket: bucketName,
             Prefix: prefix,
+            Delimiter: o.delimiter,
             ContinuationToken: o.continuationToken,
             MaxKeys: o.maxObjects
         }, (err, data) => {
@@ -228,7 +257,118 @@ export const listObjects = async (bucket: Bucket, prefix: string, o: {continuati
                 reject(err)
                 return
             }
-            resolve({objects: data.Contents as {Key: string, Size: number}[], continuationToken: data.IsTruncated ? data.NextContinuationToken : undefined})
+            resolve({
+                objects: (data.Contents || []) as ListedObject[],
+                commonPrefixes: (data.CommonPrefixes || []).map((x: any) => x.Prefix as string),
+                continuationToken: data.IsTruncated ? data.NextContinuationToken : undefined
+            })
+        })
+    })
+}
+
+export const createMultipartUpload = async (bucket: Bucket, key: string): Promise<string> => {
+    return new Promise<string>((resolve, reject) => {
+        const s3 = getS3Client(bucket)
+        s3.createMultipartUpload({
+            Bucket: bucketNameFromUri(bucket.uri),
+            Key: key
+        }, (err, data) => {
+            if (err) {
+                reject(new Error(`Error creating multipart upload: ${err.message}`))
+                return
+            }
+            if (!data || !data.UploadId) {
+                reject(new Error('Unexpected, UploadId is undefined'))
+                return
+            }
+            resolve(data.UploadId)
+        })
+    })
+}
+
+export const getSignedUploadPartUrl = async (bucket: Bucket, key: string, uploadId: string, partNumber: number): Promise<string> => {
+    return new Promise<string>((resolve, reject) => {
+        const s3 = getS3Client(bucket)
+        s3.getSignedUrl('uploadPart', {
+            Bucket: bucketNameFromUri(bucket.uri),
+            Key: key,
+            UploadId: uploadId,
+            PartNumber: partNumber,
+            Expires: 60 * 30 // seconds
+        }, (err, url) => {
+            if (err) {
+                reject(new Error(`Error getting signed url: ${err.message}`))
+                return
+            }
+            if (!url) {
+                reject(new Error('Unexpected, url is undefined'))
+                return
+            }
+            resolve(url)
         })
     })
-}
\ No newline at end of file
+}
+
+export const listUploadedParts = async (bucket: Bucket, key: string, uploadId: string): Promise<{PartNumber: number, ETag: string, Size: number}[]> => {
+    const ret: {PartNumber: number, ETag: string, Size: number}[] = []
+    let partNumberMarker: number | undefined = undefined
+    // eslint-disable-next-line no-constant-condition
+    while (true) {
+        const data: any = await new Promise<any>((resolve, reject) => {
+            const s3 = getS3Client(bucket)
+            s3.listParts({
+                Bucket: bucketNameFromUri(bucket.uri),
+                Key: key,
+                UploadId: uploadId,
+                PartNumberMarker: partNumberMarker
+            }, (err, data) => {
+                if (err) {
+                    reject(new Error(`Error listing parts: ${err.message}`))
+                    return
+                }
+                resolve(data)
+            })
+        })
+        for (const p of data.Parts || []) {
+            ret.push({PartNumber: p.PartNumber, ETag: p.ETag, Size: p.Size})
+        }
+        if (!data.IsTruncated) break
+        partNumberMarker = data.NextPartNumberMarker
+    }
+    return ret
+}
+
+export const completeMultipartUpload = async (bucket: Bucket, key: string, uploadId: string, parts: CompletedPartX[]): Promise<void> => {
+    return new Promise<void>((resolve, reject) => {
+        const s3 = getS3Client(bucket)
+        s3.completeMultipartUpload({
+            Bucket: bucketNameFromUri(bucket.uri),
+            Key: key,
+            UploadId: uploadId,
+            MultipartUpload: {Parts: parts}
+        }, (err) => {
+            if (err) {
+                reject(new Error(`Error completing multipart upload: ${err.message}`))
+                return
+            }
+            resolve()
+        })
+    })
+}
+
+export const abortMultipartUpload = async (bucket: Bucket, key: string, uploadId: string): Promise<void> => {
+    return new Promise<void>((resolve, reject) => {
+        const s3 = getS3Client(bucket)
+        s3.abortMultipartUpload({
+            Bucket: bucketNameFromUri(bucket.uri),
+            Key: key,
+            UploadId: uploadId
+        }, (err) => {
+            if (err) {
+                reject(new Error(`Error aborting multipart upload: ${err.message}`))
+                return
+            }
+            resolve()
+        })
+    })
+}
@@ -1,5 +1,5 @@
 import { FunctionComponent, useCallback, useEffect, useMemo, useReducer } from "react";
-import FileBrowserTable, { FileBrowserTableFile } from "./FileBrowserTable/FileBrowserTable";
+import FileBrowserTable, { FileBrowserTableFile, FileBrowserTableFolderTotals } from "./FileBrowserTable/FileBrowserTable";
 import { selectedStringsReducer } from "./FileBrowserTable/expandedFoldersReducer";
 
 type FileBrowserProps = {
@@ -13,9 +13,18 @@ type FileItem = {
     timestampLastModified: number
 }
 
+type FolderTotals = {
+    size: number
+    count: number
+    complete: boolean
+    // passed back to the server to continue counting (until complete)
+    cursor?: string
+}
+
 type FileBrowserState = {
     expandedFolderPaths: string[]
     fileItems: FileItem[]
+    folderTotals: {[folderPath: string]: FolderTotals}
 }
 
 type FileBrowserAction = {
@@ -24,6 +33,10 @@ type FileBrowserAction = {
 } | {
     type: 'addItems'
     items: FileItem[]
+} | {
+    type: 'setFolderTotals'
+    folderPath: string
+    totals: FolderTotals
 }
 
 const fileBrowserReducer = (state: FileBrowserState, action: FileBrowserAction): FileBrowserState => {
@@ -45,20 +58,33 @@ const fileBrowserReducer = (state: FileBrowserState, action: FileBrowserAction):
                 ]
             }
         }
+        case 'setFolderTotals': {
+            return {
+                ...state,
+                folderTotals: {
+                    ...state.folderTotals,
+                    [action.folderPath]: action.totals
+                }
+            }
+        }
         default: {
             throw Error('Unexpected action type in fileBrowserReducer')
         }
     }
 }
 
-const doFetchDirectory = async (folderPath: string): Promise<{
+type DirectoryPage = {
     files: {
         name: string,
         size: number,
         lastModified: number
     }[],
     dirNames: string[]
-}> => {
+    cursor?: string
+    totals?: FolderTotals
+}
+
+const doFetchDirectoryPage = async (folderPath: string, o: {cursor?: string, maxItems?: number, includeTotals?: boolean, totalsCursor?: string}): Promise<DirectoryPage> => {
     // we need to hardcode the production API URL here because I can't get local dev to work (problem with imports and .js extension)
     const apiUrl = `https://lindi-cloud.vercel.app/api/listDir`
     const resp = await fetch(apiUrl, {
@@ -68,16 +94,23 @@ const doFetchDirectory = async (folderPath: string): Promise<{
         },
         body: JSON.stringify({
             type: 'listDir',
-            url: join(`https://lindi.neurosift.org/zones`, folderPath)
+            url: join(`https://lindi.neurosift.org/zones`, folderPath),
+            cursor: o.cursor,
+            maxItems: o.maxItems,
+            includeTotals: o.includeTotals,
+            totalsCursor: o.totalsCursor
         })
     })
     if (!resp.ok) {
         throw Error(`Error fetching directory: ${resp.statusText}`)
     }
-    const {files, dirNames} = await resp.json()
-    return {files, dirNames}
+    const {files, dirNames, cursor, totals} = await resp.json()
+    return {files, dirNames, cursor, totals}
 }
 
+// the server counts the totals of a large folder over several requests
+const maxTotalsRequests = 20
+
 const join = (a: string, b: string) => {
     if (!b) return a
     if (!a) return b
@@ -91,19 +124,41 @@ class DirectoryLister {
     async fetchDirectory(folderPath: string) {
         if (this.#fetchedDirectories.includes(folderPath)) return
         this.#fetchedDirectories.push(folderPath)
-        const {files, dirNames} = await doFetchDirectory(folderPath)
+        // the usage of zones (user/zone) and the folders inside them
+        const includeTotals = folderPath.split('/').length >= 2
+        let totals: FolderTotals | undefined = undefined
+        let cursor: string | undefined = undefined
+        // eslint-disable-next-line no-constant-condition
+        while (true) {
+            const page: DirectoryPage = await doFetchDirectoryPage(folderPath, {cursor, includeTotals: includeTotals && !totals?.complete, totalsCursor: totals?.cursor})
+            this.addPage(folderPath, page)
+            if (page.totals) {
+                totals = page.totals
+                this.dispatch({type: 'setFolderTotals', folderPath, totals})
+            }
+            if (!page.cursor) break
+            cursor = page.cursor
+        }
+        for (let i = 0; i < maxTotalsRequests && totals && !totals.complete; i++) {
+            const page: DirectoryPage = await doFetchDirectoryPage(folderPath, {maxItems: 0, includeTotals: true, totalsCursor: totals.cursor})
+            if (!page.totals) break
+            totals = page.totals
+            this.dispatch({type: 'setFolderTotals', folderPath, totals})
+        }
+    }
+    addPage(folderPath: string, page: DirectoryPage) {
         const fileString: 'file' | 'folder' = 'file'
         const folderString: 'file' | 'folder' = 'folder'
         this.dispatch({
             type: 'addItems',
             items: [
-                ...files.map(ff => ({
+                ...page.files.map(ff => ({
                     type: fileString,
                     path: join(folderPath, ff.name),
                     size: ff.size,
                     timestampLastModified: ff.lastModified
                 })),
-                ...dirNames.map(name => ({
+                ...page.dirNames.map(name => ({
                     type: folderString,
                     path: join(folderPath, name),
                     size: 0,
@@ -124,9 +179,10 @@ const FileBrowser: FunctionComponent<FileBrowserProps> = () => {
             path: '',
             size: 0,
             timestampLastModified: 0
-        }]
+        }],
+        folderTotals: {}
     })
-    const {fileItems, expandedFolderPaths} = state
+    const {fileItems, expandedFolderPaths, folderTotals} = state
     const lister = useMemo(() => new DirectoryLister(dispatch), [])
     useEffect(() => {
         for (const folderPath of expandedFolderPaths) {
@@ -160,6 +216,14 @@ const FileBrowser: FunctionComponent<FileBrowserProps> = () => {
         })
     }, [fileItems])
 
+    const fileBrowserTableFolderTotals: {[folderName: string]: FileBrowserTableFolderTotals} = useMemo(() => {
+        const ret: {[folderName: string]: FileBrowserTableFolderTotals} = {}
+        for (const folderPath in folderTotals) {
+            ret[`${rootName}/${folderPath}`] = folderTotals[folderPath]
+        }
+        return ret
+    }, [folderTotals])
+
     const handleOpenFile = useCallback((fileName: string) => {
         const fname = fileName.slice(`${rootName}/`.length)
         const url0 = `https://lindi.neurosift.org/zones/${fname}`
@@ -173,6 +237,7 @@ const FileBrowser: FunctionComponent<FileBrowserProps> = () => {
                 hideSizeColumn={false}
                 hideModifiedColumn={false}
                 files={fileBrowserTableFiles}
+                folderTotals={fileBrowserTableFolderTotals}
                 selectedFileNames={selectedFileNames}
                 selectedFileNamesDispatch={selectedFileNamesDispatch}
                 onOpenFile={handleOpenFile}
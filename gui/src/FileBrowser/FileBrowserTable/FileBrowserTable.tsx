@@ -32,6 +32,14 @@ export type FileBrowserTableFolder = {
     folderName: string
 }
 
+// the size and number of all the objects in a folder (at any depth); if not
+// complete, the counting is still in progress
+export type FileBrowserTableFolderTotals = {
+    size: number
+    count: number
+    complete: boolean
+}
+
 type TreeNode = {
     type: 'file' | 'folder'
     name: string
@@ -43,6 +51,7 @@ type FileBrowserTableProps = {
     hideSizeColumn?: boolean
     hideModifiedColumn?: boolean
     files: FileBrowserTableFile[]
+    folderTotals?: {[folderName: string]: FileBrowserTableFolderTotals}
     selectedFileNames: SelectedStrings
     selectedFileNamesDispatch: (a: SelectedStringsAction) => void
     onOpenFile: (fileName: string) => void
@@ -63,7 +72,7 @@ catch (err) {
 }
 
 // eslint-disable-next-line @typescript-eslint/no-unused-vars
-const FileBrowserTable: FunctionComponent<FileBrowserTableProps> = ({hideSizeColumn, hideModifiedColumn, files, selectedFileNames, selectedFileNamesDispatch, onOpenFile, multiSelect, onRetrieveFolder}) => {
+const FileBrowserTable: FunctionComponent<FileBrowserTableProps> = ({hideSizeColumn, hideModifiedColumn, files, folderTotals, selectedFileNames, selectedFileNamesDispatch, onOpenFile, multiSelect, onRetrieveFolder}) => {
     const [expandedFolders, expandedFoldersDispatch] = useReducer(expandedFoldersReducer, initialExpandedFolders)
     useEffect(() => {
         // don't include folders that no longer exist!
@@ -287,7 +296,11 @@ const FileBrowserTable: FunctionComponent<FileBrowserTableProps> = ({hideSizeCol
                                 ): ''}
                             </td>}
                             {!hideSizeColumn && (
-                                x.type === 'file' && x.size ? <td>{formatByteCount(x.size)}</td> : <td />
+                                x.type === 'file' && x.size ? <td>{formatByteCount(x.size)}</td> : (
+                                    x.type === 'folder' && folderTotals?.[x.name] ? (
+                                        <FolderTotalsCell totals={folderTotals[x.name]} />
+                                    ) : <td />
+                                )
                             )}
                         </tr>
                     ))
@@ -297,6 +310,18 @@ const FileBrowserTable: FunctionComponent<FileBrowserTableProps> = ({hideSizeCol
     )
 }
 
+const FolderTotalsCell: FunctionComponent<{totals: FileBrowserTableFolderTotals}> = ({totals}) => {
+    const suffix = totals.complete ? '' : '+'
+    return (
+        <td
+            style={{color: 'gray', whiteSpace: 'nowrap'}}
+            title={`${totals.count}${suffix} objects${totals.complete ? '' : ' (still counting)'}`}
+        >
+            {formatByteCount(totals.size)}{suffix}
+        </td>
+    )
+}
+
 export const Checkbox: FunctionComponent<{checked: boolean | null, onClick: () => void}> = ({checked, onClick}) => {
     // null means indeterminate
     return (
@@ -0,0 +1,93 @@
+from typing import Any, Dict, List, Tuple, Union
+import json
+
+
+class ChunkIndex:
+    """
+    A zone-level index from the SHA-1 of individual chunks to where they are
+    stored in the zone
+
+    Blobs are content addressed, but a consolidated blob contains many chunks
+    in an arbitrary order, so uploading the same data twice generally results
+    in different blobs. With this index, a chunk that is already stored in
+    some blob of the zone is referenced at its existing location (blob url,
+    offset and size) instead of being uploaded again.
+
+    The index is stored as gzipped JSON in the zone itself
+    (f/.lindi_cloud/chunk_index.json.gz) and is only a hint: a blob that no
+    longer exists is dropped from the index, and if two uploads update the
+    index at the same time, some entries may be lost (which only means that
+    those chunks are not deduplicated later).
+    """
+    index_path = '.lindi_cloud/chunk_index.json.gz'
+
+    def __init__(self, base_zone_url: str):
+        self._base_zone_url = base_zone_url
+        self._blob_urls: List[Union[str, None]] = []
+        self._blob_indices: Dict[str, int] = {}
+        # chunk sha1 -> (blob index, offset, size)
+        self._chunks: Dict[str, Tuple[int, int, int]] = {}
+        self._modified = False
+
+    @property
+    def url(self) -> str:
+        return f"{self._base_zone_url}/f/{ChunkIndex.index_path}"
+
+    @property
+    def modified(self) -> bool:
+        return self._modified
+
+    def read(self, f: Any):
+        # f is a (decompressed) binary stream
+        x = json.load(f)
+        self._blob_urls = x['blobs']
+        self._blob_indices = {url: i for i, url in enumerate(self._blob_urls)}
+        self._chunks = {k: (v[0], v[1], v[2]) for k, v in x['chunks'].items()}
+        self._modified = False
+
+    def write(self, f: Any):
+        # f is a text stream; blobs that were removed are left out
+        blob_urls: List[str] = []
+        new_indices: Dict[int, int] = {}
+        for i, url in enumerate(self._blob_urls):
+            if url is not None:
+                new_indices[i] = len(blob_urls)
+                blob_urls.append(url)
+        chunks = {
+            k: [new_indices[v[0]], v[1], v[2]]
+            for k, v in self._chunks.items()
+            if v[0] in new_indices
+        }
+        json.dump({'blobs': blob_urls, 'chunks': chunks}, f, separators=(',', ':'), sort_keys=True)
+
+    def lookup(self, chunk_sha1: str, size: int) -> Union[list, None]:
+        # returns [blob url, offset, size] or None
+        x = self._chunks.get(chunk_sha1, None)
+        if x is None or x[2] != size:
+            return None
+        url = self._blob_urls[x[0]]
+        if url is None:
+            return None
+        return [url, x[1], x[2]]
+
+    def add(self, chunk_sha1: str, ref: list):
+        url, offset, size = ref
+        if not url.startswith(f"{self._base_zone_url}/sha1/"):
+            # only content-addressed blobs of this zone can be indexed
+            return
+        if chunk_sha1 in self._chunks:
+            return
+        blob_index = self._blob_indices.get(url, None)
+        if blob_index is None:
+            blob_index = len(self._blob_urls)
+            self._blob_urls.append(url)
+            self._blob_indices[url] = blob_index
+        self._chunks[chunk_sha1] = (blob_index, offset, size)
+        self._modified = True
+
+    def remove_blob(self, url: str):
+        # for a blob that no longer exists (e.g., deleted by a garbage collection)
+        blob_index = self._blob_indices.pop(url, None)
+        if blob_index is not None:
+            self._blob_urls[blob_index] = None
+            self._modified = True
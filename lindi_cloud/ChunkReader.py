@@ -0,0 +1,336 @@
+from typing import Dict, List, Tuple, Union
+import os
+import mmap
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from .Metrics import _span, _count, _in_current_context
+
+
+class ChunkReader:
+    """
+    Reads the byte ranges referenced by a batch of chunks
+
+    Ranges of the same remote URL that are close to each other (at most
+    max_gap_bytes apart) are merged into a single request of at most
+    max_request_bytes, and the requests are made concurrently. The remote
+    chunks are kept in an LRU memory cache of at most memory_cache_bytes and,
+    if cache_dir is given, in a disk cache of at most disk_cache_bytes that is
+    shared between sessions.
+
+    Local files (the staging area) are never cached, since they can change.
+    They are read through a pool of at most max_mapped_files memory maps, and
+    the returned values are memoryview slices of the maps, so reading a chunk
+    of a large staged segment neither reopens the file nor copies the data.
+    A map is replaced when the file is replaced (LindiCloudStore replaces
+    rather than overwrites staged files) or has grown past the mapped size;
+    values already returned keep the old map alive.
+    """
+    def __init__(
+        self,
+        *,
+        max_gap_bytes: int = 256 * 1024,
+        max_request_bytes: int = 32 * 1024 * 1024,
+        num_parallel_requests: int = 8,
+        memory_cache_bytes: int = 256 * 1024 * 1024,
+        cache_dir: Union[str, None] = None,
+        disk_cache_bytes: int = 10 * 1024 * 1024 * 1024,
+        max_mapped_files: int = 32
+    ):
+        """
+        Parameters
+        ----------
+        max_gap_bytes : int
+            Ranges of the same URL that are at most this far apart are read
+            with a single request (the bytes in between are discarded).
+        max_request_bytes : int
+            The maximum size of a merged request.
+        num_parallel_requests : int
+            The number of requests made at the same time.
+        memory_cache_bytes : int
+            The size of the in-memory LRU cache of remote chunks (0 to disable).
+        cache_dir : str or None
+            A directory for a disk cache of remote chunks.
+        disk_cache_bytes : int
+            The maximum size of the disk cache.
+        max_mapped_files : int
+            The number of local files that are kept memory mapped.
+        """
+        if num_parallel_requests < 1:
+            raise ValueError('num_parallel_requests must be at least 1')
+        self._max_gap_bytes = max_gap_bytes
+        self._max_request_bytes = max_request_bytes
+        self._num_parallel_requests = num_parallel_requests
+        self._memory_cache = _MemoryCache(memory_cache_bytes)
+        self._disk_cache = _DiskCache(cache_dir, max_bytes=disk_cache_bytes) if cache_dir is not None else None
+        self._mmap_pool = _MmapPool(max_mapped_files)
+        self._executor: Union[ThreadPoolExecutor, None] = None
+        self._executor_lock = threading.Lock()
+        self._thread_local = threading.local()
+
+    def read_ranges(self, ranges: List[Tuple[str, int, int]]) -> List[Union[bytes, memoryview]]:
+        """
+        Takes a list of (url or absolute path, offset, size) and returns the
+        bytes of each (a read-only memoryview for local files), in the same
+        order.
+        """
+        with _span('chunk_reader.read_ranges', ranges=len(ranges)) as span:
+            ret = self._read_ranges(ranges)
+            span.set(bytes=sum(len(x) for x in ret))
+        return ret
+
+    def _read_ranges(self, ranges: List[Tuple[str, int, int]]) -> List[Union[bytes, memoryview]]:
+        ret: List[Union[bytes, memoryview, None]] = [None] * len(ranges)
+        remote_indices_by_url: Dict[str, List[int]] = {}
+        local_indices_by_path: Dict[str, List[int]] = {}
+        for i, (url, offset, size) in enumerate(ranges):
+            if url.startswith('http://') or url.startswith('https://'):
+                cached = self._get_cached(url, offset, size)
+                if cached is not None:
+                    ret[i] = cached
+                else:
+                    remote_indices_by_url.setdefault(url, []).append(i)
+            else:
+                local_indices_by_path.setdefault(url, []).append(i)
+        for path, indices in local_indices_by_path.items():
+            for i, data in zip(indices, self._mmap_pool.read_ranges(path, [ranges[i][1:] for i in indices])):
+                ret[i] = data
+        requests_to_make: List[Tuple[str, int, int, List[int]]] = []
+        for url, indices in remote_indices_by_url.items():
+            requests_to_make.extend(self._merge_ranges(url, indices, ranges))
+        if len(requests_to_make) == 1:
+            results = [self._fetch(*requests_to_make[0][:3])]
+        elif len(requests_to_make) > 1:
+            results = list(self._get_executor().map(_in_current_context(lambda r: self._fetch(*r[:3])), requests_to_make))
+        else:
+            results = []
+        for (url, start, _, indices), data in zip(requests_to_make, results):
+            for i in indices:
+                _, offset, size = ranges[i]
+                x = data[offset - start:offset - start + size]
+                if len(x) != size:
+                    raise Exception(f"Unexpected number of bytes read from {url}: {len(x)} != {size}")
+                self._put_cached(url, offset, size, x)
+                ret[i] = x
+        return ret  # type: ignore
+
+    def _release_local_files(self, path_prefix: str):
+        # Drops the memory maps of the local files under path_prefix, so that
+        # removed or replaced files do not keep their disk space
+        self._mmap_pool.release(path_prefix)
+
+    def _merge_ranges(self, url: str, indices: List[int], ranges: List[Tuple[str, int, int]]) -> List[Tuple[str, int, int, List[int]]]:
+        # returns (url, start, size, indices) for each merged request
+        ret: List[Tuple[str, int, int, List[int]]] = []
+        start = end = 0
+        current: List[int] = []
+        for i in sorted(indices, key=lambda i: ranges[i][1]):
+            _, offset, size = ranges[i]
+            if current and offset - end <= self._max_gap_bytes and max(end, offset + size) - start <= self._max_request_bytes:
+                end = max(end, offset + size)
+                current.append(i)
+                continue
+            if current:
+                ret.append((url, start, end - start, current))
+            start, end, current = offset, offset + size, [i]
+        if current:
+            ret.append((url, start, end - start, current))
+        return ret
+
+    def _fetch(self, url: str, offset: int, size: int) -> bytes:
+        from lindi.LindiRemfile.LindiRemfile import _resolve_url
+        session = getattr(self._thread_local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self._thread_local.session = session
+        num_retries = 8
+        for try_num in range(num_retries):
+            try:
+                url_resolved = _resolve_url(url)  # handle DANDI auth
+                headers = {
+                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3",
+                    "Range": f"bytes={offset}-{offset + size - 1}"
+                }
+                with _span('chunk_reader.fetch', bytes=size):
+                    response = session.get(url_resolved, headers=headers)
+                response.raise_for_status()
+                if response.status_code == 200:
+                    # the server ignored the range header
+                    return response.content[offset:offset + size]
+                return response.content
+            except Exception as e:
+                if try_num == num_retries - 1:
+                    raise e
+                delay = 0.1 * 2 ** try_num
+                print(f'Retry load data from {url} in {delay} seconds')
+                _count('chunk_reader.retries')
+                time.sleep(delay)
+        raise Exception(f"Failed to load data from {url}")
+
+    def _get_cached(self, url: str, offset: int, size: int) -> Union[bytes, None]:
+        key = _cache_key(url, offset, size)
+        x = self._memory_cache.get(key)
+        _count('chunk_reader.memory_cache.hits' if x is not None else 'chunk_reader.memory_cache.misses')
+        if x is None and self._disk_cache is not None:
+            x = self._disk_cache.get(key)
+            _count('chunk_reader.disk_cache.hits' if x is not None else 'chunk_reader.disk_cache.misses')
+            if x is not None:
+                self._memory_cache.put(key, x)
+        return x
+
+    def _put_cached(self, url: str, offset: int, size: int, data: bytes):
+        key = _cache_key(url, offset, size)
+        self._memory_cache.put(key, data)
+        if self._disk_cache is not None:
+            self._disk_cache.put(key, data)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._num_parallel_requests)
+            return self._executor
+
+
+class _MmapPool:
+    # An LRU pool of read-only memory maps of local files. Maps are never
+    # closed explicitly, because memoryviews of them may still be in use;
+    # they are released when the last reference goes away.
+    def __init__(self, max_files: int):
+        self._max_files = max_files
+        # path -> (st_dev, st_ino, mapped size, map)
+        self._maps: 'OrderedDict[str, Tuple[int, int, int, Union[mmap.mmap, None]]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read_ranges(self, path: str, ranges: List[Tuple[int, int]]) -> List[memoryview]:
+        end = max(offset + size for offset, size in ranges)
+        with self._lock:
+            st = os.stat(path)
+            x = self._maps.get(path, None)
+            if x is None or x[0] != st.st_dev or x[1] != st.st_ino or x[2] < end:
+                if st.st_size < end:
+                    raise Exception(f"Range is out of bounds in {path}: {end} > {st.st_size}")
+                x = (st.st_dev, st.st_ino, st.st_size, _map_file(path, st.st_size))
+                self._maps[path] = x
+                while len(self._maps) > self._max_files:
+                    self._maps.popitem(last=False)
+            self._maps.move_to_end(path)
+            mm = x[3]
+        if mm is None:
+            # an empty file cannot be mapped
+            return [memoryview(b'') for _ in ranges]
+        view = memoryview(mm)
+        return [view[offset:offset + size] for offset, size in ranges]
+
+    def release(self, path_prefix: str):
+        with self._lock:
+            for path in [p for p in self._maps.keys() if p.startswith(path_prefix)]:
+                del self._maps[path]
+
+
+def _map_file(path: str, size: int) -> Union[mmap.mmap, None]:
+    if size == 0:
+        return None
+    with open(path, "rb") as f:
+        # the map stays valid after the file is closed
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+
+class _MemoryCache:
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._entries: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Union[bytes, None]:
+        with self._lock:
+            x = self._entries.get(key, None)
+            if x is not None:
+                self._entries.move_to_end(key)
+            return x
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self._max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total_bytes -= len(old)
+            self._entries[key] = data
+            self._total_bytes += len(data)
+            while self._total_bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= len(evicted)
+
+
+class _DiskCache:
+    # One file per chunk, named by the hash of (url, offset, size). Files are
+    # written to a temporary file and renamed into place, so the cache can be
+    # shared between processes. The modification time is bumped on use and
+    # the least recently used files are evicted.
+    def __init__(self, cache_dir: str, *, max_bytes: int):
+        self._cache_dir = os.path.abspath(cache_dir)
+        self._max_bytes = max_bytes
+        os.makedirs(self._cache_dir, exist_ok=True)
+        self._bytes_since_evict = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Union[bytes, None]:
+        fname = self._fname(key)
+        try:
+            with open(fname, "rb") as f:
+                data = f.read()
+            os.utime(fname)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes):
+        fname = self._fname(key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(fname), prefix='.tmp.')
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_fname, fname)
+        with self._lock:
+            self._bytes_since_evict += len(data)
+            # scanning the cache is expensive, so it is only done after a
+            # tenth of the maximum size has been written
+            if self._bytes_since_evict < self._max_bytes / 10:
+                return
+            self._bytes_since_evict = 0
+        self.evict()
+
+    def evict(self):
+        files = []
+        for root, dirs, fnames in os.walk(self._cache_dir):
+            for fname in fnames:
+                if fname.startswith('.'):
+                    continue
+                path = f"{root}/{fname}"
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        total_size = sum(x[1] for x in files)
+        # least recently used first
+        for _, size, path in sorted(files):
+            if total_size <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def _fname(self, key: str) -> str:
+        return f"{self._cache_dir}/{key[:2]}/{key}"
+
+
+def _cache_key(url: str, offset: int, size: int) -> str:
+    return hashlib.sha1(f'{url}:{offset}:{size}'.encode('utf-8')).hexdigest()
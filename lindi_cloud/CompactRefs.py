@@ -0,0 +1,95 @@
+from typing import Any, Dict, List, Union
+from array import array
+from collections.abc import Mapping, MutableMapping
+
+
+class CompactRefs(MutableMapping):
+    """
+    A memory-efficient replacement for the rfs['refs'] dict
+
+    In a plain refs dict every reference is a Python list [url, offset, size]
+    and (when loaded from JSON) every one of them holds its own copy of a
+    long URL string, which adds up to hundreds of bytes per entry. Here the
+    URLs are interned in a string table and the url index, offset and size of
+    each reference are stored in array-backed columns. Inline values (strings
+    and dicts) are stored as is.
+
+    Reading a reference returns a new list [url, offset, size], so modifying
+    the returned list does not modify the table; assign a new list instead.
+    """
+    def __init__(self, refs: Union[Mapping, None] = None):
+        self._urls: List[str] = []
+        self._url_indices: Dict[str, int] = {}
+        # key -> row index (int) for references, or the inline value itself
+        # (never an int) otherwise
+        self._entries: Dict[str, Any] = {}
+        self._url_column = array('i')
+        self._offset_column = array('q')
+        self._size_column = array('q')
+        self._free_rows: List[int] = []
+        if refs is not None:
+            for k, v in refs.items():
+                self[k] = v
+
+    def __getitem__(self, key: str):
+        x = self._entries[key]
+        if isinstance(x, int):
+            return [self._urls[self._url_column[x]], self._offset_column[x], self._size_column[x]]
+        return x
+
+    def __setitem__(self, key: str, value: Any):
+        x = self._entries.get(key, None)
+        if _is_reference(value):
+            url, offset, size = value
+            url_index = self._url_indices.get(url, None)
+            if url_index is None:
+                url_index = len(self._urls)
+                self._urls.append(url)
+                self._url_indices[url] = url_index
+            if isinstance(x, int):
+                row = x
+            elif self._free_rows:
+                row = self._free_rows.pop()
+            else:
+                row = len(self._url_column)
+                self._url_column.append(0)
+                self._offset_column.append(0)
+                self._size_column.append(0)
+            self._url_column[row] = url_index
+            self._offset_column[row] = offset
+            self._size_column[row] = size
+            self._entries[key] = row
+        else:
+            if isinstance(x, int):
+                self._free_rows.append(x)
+            self._entries[key] = value
+
+    def __delitem__(self, key: str):
+        x = self._entries.pop(key)
+        if isinstance(x, int):
+            self._free_rows.append(x)
+
+    def __contains__(self, key: object):
+        return key in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: self[k] for k in self._entries}
+
+
+def _is_reference(value: Any) -> bool:
+    if not isinstance(value, list) or len(value) != 3:
+        return False
+    url, offset, size = value
+    if not isinstance(url, str):
+        return False
+    # note that bool is a subclass of int
+    for x in [offset, size]:
+        if not isinstance(x, int) or isinstance(x, bool):
+            return False
+    return True
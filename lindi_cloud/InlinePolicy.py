@@ -0,0 +1,119 @@
+from typing import Dict, Literal, Union
+import os
+
+
+InlineDecision = Literal['inline', 'pack', 'stage']
+
+
+class InlinePolicy:
+    """
+    Decides how each chunk written to a LindiCloudStore is stored
+
+    * 'inline': in the .zarr.json itself (base64 encoded). Costs no request
+      for readers but makes the .zarr.json bigger for everybody.
+    * 'pack': appended to a shared segment file for the array, so that
+      neighboring small chunks end up next to each other in one blob and can
+      be read together with a single range request.
+    * 'stage': staged on its own (or in a segment in segments mode) and
+      consolidated later.
+
+    The default reproduces the original rule: chunks smaller than 1000 bytes
+    are inlined and everything else is staged.
+
+    If request_overhead_bytes is given, a cost model is used instead of the
+    fixed inline threshold: a chunk is inlined when its base64 size (4/3 of
+    the raw size) is less than the cost of a separate range request,
+    expressed in bytes (roughly latency times bandwidth for a typical
+    reader). max_inline_total_bytes bounds the total size of the chunks
+    inlined in the store (including those of a loaded .zarr.json) so that
+    the .zarr.json cannot grow without limit; once it is reached chunks are
+    packed or staged instead.
+    """
+    def __init__(
+        self,
+        *,
+        inline_threshold: int = 1000,
+        pack_threshold: int = 0,
+        max_inline_total_bytes: Union[int, None] = None,
+        request_overhead_bytes: Union[int, None] = None
+    ):
+        """
+        Parameters
+        ----------
+        inline_threshold : int
+            Chunks smaller than this are inlined (unless request_overhead_bytes
+            is given).
+        pack_threshold : int
+            Chunks that are not inlined and are smaller than this are packed
+            into a shared segment file for their array.
+        max_inline_total_bytes : int or None
+            The maximum total (base64) size of inlined chunks.
+        request_overhead_bytes : int or None
+            The cost of a separate range request in bytes, for the cost model.
+        """
+        self._inline_threshold = inline_threshold
+        self._pack_threshold = pack_threshold
+        self._max_inline_total_bytes = max_inline_total_bytes
+        self._request_overhead_bytes = request_overhead_bytes
+        self._report: Dict[str, Dict[str, Dict[str, int]]] = {}
+
+    def decide(self, key: str, size: int, *, inline_total_bytes: int = 0) -> InlineDecision:
+        """
+        Parameters
+        ----------
+        key : str
+            The key of the chunk.
+        size : int
+            The size of the chunk in bytes.
+        inline_total_bytes : int
+            The total size of the other chunks that are currently inlined in
+            the store, for max_inline_total_bytes.
+        """
+        encoded_size = _base64_size(size)
+        if self._request_overhead_bytes is not None:
+            inline = encoded_size < self._request_overhead_bytes
+        else:
+            inline = size < self._inline_threshold
+        if inline and self._max_inline_total_bytes is not None:
+            if inline_total_bytes + encoded_size > self._max_inline_total_bytes:
+                inline = False
+        decision: InlineDecision
+        if inline:
+            decision = 'inline'
+        elif size < self._pack_threshold:
+            decision = 'pack'
+        else:
+            decision = 'stage'
+        self._record(key, decision, size, encoded_size if decision == 'inline' else size)
+        return decision
+
+    def get_report(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """
+        Returns the decisions made so far, by array:
+        {array_path: {decision: {'count', 'bytes', 'stored_bytes'}}}, where
+        stored_bytes is the size in the .zarr.json for inlined chunks.
+        """
+        return {
+            array_path: {decision: dict(x) for decision, x in a.items()}
+            for array_path, a in self._report.items()
+        }
+
+    def print_report(self):
+        for array_path, a in sorted(self._report.items()):
+            parts = [
+                f'{decision}: {x["count"]} chunks, {x["bytes"]} bytes'
+                for decision, x in sorted(a.items())
+            ]
+            print(f'{array_path or "/"}: {"; ".join(parts)}')
+
+    def _record(self, key: str, decision: InlineDecision, size: int, stored_size: int):
+        array_path = os.path.dirname(key)
+        a = self._report.setdefault(array_path, {})
+        x = a.setdefault(decision, {'count': 0, 'bytes': 0, 'stored_bytes': 0})
+        x['count'] += 1
+        x['bytes'] += size
+        x['stored_bytes'] += stored_size
+
+
+def _base64_size(size: int) -> int:
+    return 4 * ((size + 2) // 3) + len('base64:')
@@ -1,17 +1,123 @@
-from typing import Union
+from typing import Union, Any, Dict, List, Literal, Set, Tuple
 import random
 import string
 import os
+import base64
 import datetime
+import hashlib
+import json
+import errno
+import bisect
+import queue
+import threading
+import numpy as np
 from zarr.storage import Store as ZarrStore
 from lindi.LindiH5pyFile.LindiReferenceFileSystemStore import LindiReferenceFileSystemStore
+from .StagingManifest import StagingManifest
+from .CompactRefs import CompactRefs
+from .InlinePolicy import InlinePolicy
+from .PackingPlanner import PackingPlanner
+from .ChunkReader import ChunkReader
+from .Metrics import _span
 
 
 class LindiCloudStore(ZarrStore):
-    def __init__(self, *, rfs: dict, staging_dir: Union[str, None]):
+    def __init__(
+        self,
+        *,
+        rfs: dict,
+        staging_dir: Union[str, None],
+        staging_mode: Literal['files', 'segments'] = 'files',
+        max_segment_size: int = 1024 * 1024 * 1024,
+        write_behind: bool = False,
+        write_behind_max_bytes: int = 256 * 1024 * 1024,
+        compact_refs: bool = False,
+        inline_policy: Union[InlinePolicy, None] = None,
+        chunk_reader: Union[ChunkReader, None] = None,
+        staging_quota_bytes: Union[int, None] = None
+    ):
+        """
+        Parameters
+        ----------
+        rfs : dict
+            The reference file system.
+        staging_dir : str or None
+            The directory where non-inline chunks are staged before upload.
+            If None, the store cannot be written to.
+        staging_mode : 'files' or 'segments'
+            In 'files' mode, each staged chunk is written to its own file, and
+            these files are concatenated by consolidate_chunks(). In
+            'segments' mode, chunks are appended to size-capped segment files
+            (one sequence per array) as they are written, so no per-chunk
+            files are created and consolidation is not needed.
+        max_segment_size : int
+            The size at which a segment file is closed and a new one started
+            (segments mode only).
+        write_behind : bool
+            If True, staged chunks are written to disk by a background thread
+            so that the writing thread does not wait on disk I/O. Chunks that
+            are still queued are served from memory on read. Call flush() to
+            wait until everything has been written.
+        write_behind_max_bytes : int
+            The maximum number of bytes that can be queued for writing when
+            write_behind is True. Writers block when this is exceeded.
+        compact_refs : bool
+            If True, rfs['refs'] is replaced by a CompactRefs table, which
+            uses much less memory for files with many chunk references.
+        inline_policy : InlinePolicy or None
+            Decides which chunks are inlined in the .zarr.json, packed into
+            shared segment files, or staged individually. The default inlines
+            chunks smaller than 1000 bytes.
+        chunk_reader : ChunkReader or None
+            Reads the referenced chunks, merging nearby ranges of the same
+            URL into single requests and caching the results. The default
+            has a 256 MB memory cache and no disk cache.
+        staging_quota_bytes : int or None
+            A limit on the disk space used by the staging directory. When a
+            write would exceed it, the staging directory is first compacted
+            (see compact_staging), and if that does not free enough space
+            the write fails. None for no limit.
+        """
+        if staging_mode not in ['files', 'segments']:
+            raise ValueError(f"Invalid staging_mode: {staging_mode}")
         self._rfs = rfs
         self._staging_dir = staging_dir
+        self._staging_mode = staging_mode
+        self._max_segment_size = max_segment_size
+        self._chunk_reader = chunk_reader if chunk_reader is not None else ChunkReader()
+        self._staging_quota_bytes = staging_quota_bytes
+        # the size of the staged files, and how much of it is no longer
+        # referenced (an estimate between compactions)
+        self._staging_bytes = 0
+        self._dead_staging_bytes = 0
+        # array path -> size of an uncompressed chunk (see _pad_chunk_if_needed)
+        self._uncompressed_chunk_sizes: Dict[str, Union[int, None]] = {}
+        self._inline_policy = inline_policy if inline_policy is not None else InlinePolicy()
         self._rfs_store = LindiReferenceFileSystemStore(rfs, mode='r+')
+        # The reference store holds on to the same rfs dict, so it sees the
+        # replacement
+        if compact_refs and not isinstance(rfs.get('refs', None), CompactRefs):
+            rfs['refs'] = CompactRefs(rfs.get('refs', {}))
+        # the total size of the inlined chunks in the refs, for the inline
+        # policy (metadata such as .zarray is not counted)
+        self._inline_chunk_bytes = sum(
+            _inline_chunk_size(k, v) for k, v in rfs.get('refs', {}).items()
+        )
+        self._segment_id = _random_str(8)
+        self._segment_writers: Dict[str, _SegmentWriter] = {}
+        self._segment_counts: Dict[str, int] = {}
+
+        self._write_behind_max_bytes = write_behind_max_bytes
+        self._write_queue: Union[queue.Queue, None] = None
+        # key -> (submission number, value) of the queued chunk writes
+        self._pending: Dict[str, Tuple[int, bytes]] = {}
+        self._pending_seq = 0
+        self._pending_bytes = 0
+        self._pending_cond = threading.Condition()
+        self._write_behind_error: Union[Exception, None] = None
+        if write_behind:
+            self._write_queue = queue.Queue()
+            threading.Thread(target=self._write_behind_worker, daemon=True).start()
 
         # we are going to make a staging subdir unique to this memory instance
         # so that we can use the zarr structure (for human inspection) and also
@@ -20,40 +126,180 @@ class LindiCloudStore(ZarrStore):
             unique_id = _create_random_id()
             self._staging_subdir = f"{self._staging_dir}/{unique_id}"
             os.makedirs(self._staging_subdir)
+            self._manifest = StagingManifest(self._staging_subdir)
         else:
             self._staging_subdir = None
+            self._manifest = None
+
+        # rfs keys that were set or deleted since the last upload
+        self._changed_keys: Set[str] = set()
 
     def __getitem__(self, key: str):
+        with _span('store.get') as span:
+            value = self._get_value(key)
+            span.set(bytes=len(value))
+        return value
+
+    def _get_value(self, key: str):
+        if self._write_queue is not None:
+            # read-your-writes for chunks that are still queued
+            key_without_initial_slash = key if not key.startswith("/") else key[1:]
+            with self._pending_cond:
+                pending = self._pending.get(key_without_initial_slash, None)
+            if pending is not None:
+                return pending[1]
+        ref = self._get_readable_ref(key)
+        if ref is not None:
+            return self._pad_chunk_if_needed(key, self._chunk_reader.read_ranges([ref])[0])
+        x = self._rfs.get('refs', {}).get(key, None)
+        if isinstance(x, (str, dict)):
+            # an inline value (base64 or ascii, or a json object); the
+            # reference file system store would pad an inlined chunk to the
+            # full chunk size even if it is compressed
+            return self._pad_chunk_if_needed(key, _decode_inline_value(x))
         return self._rfs_store.__getitem__(key)
 
+    def __contains__(self, key):
+        if not isinstance(key, str):
+            return False
+        return self._is_pending(key) or self._rfs_store.__contains__(key)
+
+    def getitems(self, keys, *, contexts):
+        # Called by zarr with all the chunks needed for a selection, so that
+        # they can be read together (see ChunkReader)
+        ret = {}
+        keys_to_read = []
+        refs_to_read = []
+        with _span('store.getitems', keys=len(keys)) as span:
+            for key in keys:
+                ref = self._get_readable_ref(key)
+                if ref is None or self._is_pending(key):
+                    if key in self:
+                        ret[key] = self._get_value(key)
+                    continue
+                keys_to_read.append(key)
+                refs_to_read.append(ref)
+            for key, value in zip(keys_to_read, self._chunk_reader.read_ranges(refs_to_read)):
+                ret[key] = self._pad_chunk_if_needed(key, value)
+            span.set(bytes=sum(len(v) for v in ret.values()))
+        return ret
+
+    def _get_readable_ref(self, key: str):
+        # Returns (url or absolute path, offset, size) for a reference that
+        # the chunk reader can handle, or None (inline values, templates and
+        # relative paths are left to the reference file system store)
+        x = self._rfs.get('refs', {}).get(key, None)
+        if not isinstance(x, list) or len(x) != 3:
+            return None
+        url = x[0]
+        if '{{' in url or not (url.startswith('http://') or url.startswith('https://') or url.startswith('/')):
+            return None
+        return (url, x[1], x[2])
+
+    def _is_pending(self, key: str) -> bool:
+        if self._write_queue is None:
+            return False
+        key_without_initial_slash = key if not key.startswith("/") else key[1:]
+        with self._pending_cond:
+            return key_without_initial_slash in self._pending
+
+    def _pad_chunk_if_needed(self, key: str, value: Union[bytes, memoryview]) -> Union[bytes, memoryview]:
+        # Same as LindiReferenceFileSystemStore: the final chunk of a
+        # contiguous hdf5 dataset can be short and is padded with zeros. This
+        # only applies to uncompressed arrays; for the others, padding would
+        # mean copying a memory-mapped chunk for nothing.
+        key_without_initial_slash = key if not key.startswith("/") else key[1:]
+        array_path, chunk_name = os.path.split(key_without_initial_slash)
+        if not all(x.isdigit() for x in chunk_name.split('.')):
+            return value
+        expected_size = self._get_uncompressed_chunk_size(array_path)
+        if expected_size is not None and len(value) < expected_size:
+            value = bytes(value) + b'\0' * (expected_size - len(value))
+        return value
+
+    def _get_uncompressed_chunk_size(self, array_path: str) -> Union[int, None]:
+        # the size of a full chunk for uncompressed numeric arrays, else None
+        if array_path in self._uncompressed_chunk_sizes:
+            return self._uncompressed_chunk_sizes[array_path]
+        zarray_key = f'{array_path}/.zarray' if array_path else '.zarray'
+        size = None
+        if zarray_key in self._rfs_store:
+            zarray = json.loads(self._rfs_store[zarray_key])
+            if zarray.get('compressor', None) is None and not zarray.get('filters', None):
+                try:
+                    dtype = np.dtype(zarray['dtype'])
+                except TypeError:
+                    dtype = None
+                if dtype is not None and dtype.kind in ['i', 'u', 'f']:
+                    size = int(np.prod(zarray['chunks'])) * dtype.itemsize
+        self._uncompressed_chunk_sizes[array_path] = size
+        return size
+
     def __setitem__(self, key: str, value):
+        with _span('store.set', bytes=len(value)):
+            self._set_value(key, value)
+
+    def _set_value(self, key: str, value):
         if self._staging_subdir is None:
             raise Exception("Cannot write to store without a staging directory")
         key_parts = key.split("/")
         key_base_name = key_parts[-1]
+        key_without_initial_slash = key if not key.startswith("/") else key[1:]
+        self._changed_keys.add(key_without_initial_slash)
+        if key_base_name == '.zarray':
+            self._uncompressed_chunk_sizes.pop(os.path.dirname(key_without_initial_slash), None)
+        # the chunk being overwritten no longer counts toward the inline total
+        old_inline_size = self._get_inline_chunk_size(key_without_initial_slash)
         if key_base_name.startswith('.'):  # always inline .zattrs, .zgroup, .zarray
-            inline = True
+            decision = 'inline'
         else:
             # presumably it is a chunk of an array
             if not isinstance(value, bytes):
                 raise ValueError("Value must be bytes")
-            size = len(value)
-            inline = size < 1000
-        if inline:
+            decision = self._inline_policy.decide(
+                key_without_initial_slash,
+                len(value),
+                inline_total_bytes=self._inline_chunk_bytes - old_inline_size
+            )
+        if decision != 'inline' and self._staging_quota_bytes is not None:
+            self._enforce_staging_quota(len(value))
+        old_ref = self._get_staged_ref(key_without_initial_slash)
+        if decision == 'inline':
             # If inline, save in memory
-            return self._rfs_store.__setitem__(key, value)
+            self._discard_pending(key_without_initial_slash)
+            self._release_staged_ref(old_ref)
+            self._rfs_store.__setitem__(key, value)
+            self._inline_chunk_bytes += self._get_inline_chunk_size(key_without_initial_slash) - old_inline_size
+            return
+        self._inline_chunk_bytes -= old_inline_size
+        if self._staging_mode == 'segments' or decision == 'pack':
+            # If not inline, append it to the current segment file for this
+            # array. Small chunks are packed this way even in files mode, so
+            # that they are adjacent in a single blob.
+            staging_fname, offset = self._append_to_segment(key_without_initial_slash, value)
+            self._release_staged_ref(old_ref)
         else:
             # If not inline, save it as a file in the staging directory
-            key_without_initial_slash = key if not key.startswith("/") else key[1:]
             staging_fname = f"{self._staging_subdir}/{key_without_initial_slash}"
-            os.makedirs(os.path.dirname(staging_fname), exist_ok=True)
-            with open(staging_fname, "wb") as f:
-                f.write(value)
-            self._set_ref_reference(key_without_initial_slash, staging_fname, 0, len(value))
+            offset = 0
+            self._submit_write(
+                lambda: _write_file(staging_fname, value),
+                key=key_without_initial_slash,
+                value=value
+            )
+            self._release_staged_ref(old_ref, replaced_fname=staging_fname)
+        self._staging_bytes += len(value)
+        self._set_ref_reference(key_without_initial_slash, staging_fname, offset, len(value))
 
     def __delitem__(self, key: str):
         # We don't delete the file from the staging directory, because that
         # would be dangerous if the file was part of a consolidated file.
+        key_without_initial_slash = key if not key.startswith("/") else key[1:]
+        self._changed_keys.add(key_without_initial_slash)
+        self._uncompressed_chunk_sizes.pop(os.path.dirname(key_without_initial_slash), None)
+        self._discard_pending(key_without_initial_slash)
+        self._release_staged_ref(self._get_staged_ref(key_without_initial_slash))
+        self._inline_chunk_bytes -= self._get_inline_chunk_size(key_without_initial_slash)
         return self._rfs_store.__delitem__(key)
 
     def __iter__(self):
@@ -75,73 +321,532 @@ class LindiCloudStore(ZarrStore):
     def is_erasable(self):
         return False
 
+    def _get_staged_ref(self, key: str) -> Union[list, None]:
+        # the reference of the key if it is to a file in the staging directory
+        if self._staging_subdir is None:
+            return None
+        v = self._rfs.get('refs', {}).get(key, None)
+        if not isinstance(v, list) or len(v) != 3 or not v[0].startswith(self._staging_subdir + '/'):
+            return None
+        return v
+
+    def _get_inline_chunk_size(self, key: str) -> int:
+        return _inline_chunk_size(key, self._rfs.get('refs', {}).get(key, None))
+
+    def _release_staged_ref(self, old_ref: Union[list, None], *, replaced_fname: Union[str, None] = None):
+        # Accounts for a staged chunk that its key no longer refers to. The
+        # bytes stay on disk until compact_staging(), unless the chunk was in
+        # replaced_fname (a chunk file that was written again).
+        if old_ref is None:
+            return
+        if old_ref[0] == replaced_fname:
+            self._staging_bytes -= old_ref[2]
+        else:
+            self._dead_staging_bytes += old_ref[2]
+
+    def _enforce_staging_quota(self, size: int):
+        assert self._staging_quota_bytes is not None
+        if self._staging_bytes + size <= self._staging_quota_bytes:
+            return
+        if self._dead_staging_bytes > 0:
+            print(f'The staging directory would exceed its quota of {self._staging_quota_bytes} bytes; compacting')
+            self.compact_staging(min_dead_fraction=0)
+        if self._staging_bytes + size > self._staging_quota_bytes:
+            raise Exception(
+                f"Staging quota exceeded: {self._staging_bytes} bytes are staged and {size} more would exceed "
+                f"the quota of {self._staging_quota_bytes} bytes. Upload or consolidate to free space."
+            )
+
     def _set_ref_reference(self, key: str, filename: str, offset: int, size: int):
         if 'refs' not in self._rfs:
             self._rfs['refs'] = {}
+        # always assign a new list, since the refs may be a CompactRefs table
         self._rfs['refs'][key] = [
             filename,
             offset,
             size
         ]
 
-    def consolidate_chunks(self):
+    def flush(self):
+        """
+        Wait until all queued chunk writes (see write_behind) are on disk.
+
+        Raises the error from the background writer if a queued write failed.
+        """
+        if self._write_queue is not None:
+            self._write_queue.join()
+        self._raise_write_behind_error()
+
+    def _submit_write(self, fn, *, key: Union[str, None] = None, value: Union[bytes, None] = None):
+        # Runs fn now, or queues it for the background writer if write_behind
+        # is enabled. If key and value are given, value is served by
+        # __getitem__ until fn has completed.
+        if self._write_queue is None:
+            fn()
+            return
+        size = len(value) if value is not None else 0
+        with self._pending_cond:
+            # backpressure: wait for the writer to catch up, but always allow
+            # at least one item through so that a large chunk cannot block
+            # forever
+            while self._pending_bytes > 0 and self._pending_bytes + size > self._write_behind_max_bytes:
+                self._raise_write_behind_error()
+                self._pending_cond.wait()
+            self._raise_write_behind_error()
+            self._pending_bytes += size
+            # the same value may be submitted again for the same key (with a
+            # different offset in segments mode), so entries are told apart by
+            # submission number rather than by value
+            self._pending_seq += 1
+            seq = self._pending_seq
+            if key is not None and value is not None:
+                self._pending[key] = (seq, value)
+        self._write_queue.put((fn, key, value, seq))
+
+    def _discard_pending(self, key: str):
+        if self._write_queue is None:
+            return
+        with self._pending_cond:
+            self._pending.pop(key, None)
+
+    def _write_behind_worker(self):
+        assert self._write_queue is not None
+        while True:
+            fn, key, value, seq = self._write_queue.get()
+            try:
+                # after a failure we keep draining the queue (so that flush()
+                # returns) but do not attempt any more writes
+                if self._write_behind_error is None:
+                    fn()
+            except Exception as e:
+                self._write_behind_error = e
+            finally:
+                with self._pending_cond:
+                    if value is not None:
+                        self._pending_bytes -= len(value)
+                    # only remove the entry if it was not overwritten in the meantime
+                    pending = self._pending.get(key, None) if key is not None else None
+                    if pending is not None and pending[0] == seq:
+                        del self._pending[key]
+                    self._pending_cond.notify_all()
+                self._write_queue.task_done()
+
+    def _raise_write_behind_error(self):
+        if self._write_behind_error is not None:
+            raise Exception(f"Error in background write of staged chunk: {self._write_behind_error}") from self._write_behind_error
+
+    def _append_to_segment(self, key: str, value: bytes):
+        assert self._staging_subdir is not None
+        parent_path = os.path.dirname(key)
+        writer = self._segment_writers.get(parent_path, None)
+        if writer is not None and writer.size > 0 and writer.size + len(value) > self._max_segment_size:
+            self._seal_segment(parent_path)
+            writer = None
+        if writer is None:
+            segment_index = self._segment_counts.get(parent_path, 0)
+            self._segment_counts[parent_path] = segment_index + 1
+            segment_dir = f"{self._staging_subdir}/{parent_path}" if parent_path else self._staging_subdir
+            os.makedirs(segment_dir, exist_ok=True)
+            writer = _SegmentWriter(f"{segment_dir}/segment.{self._segment_id}.{segment_index}")
+            self._segment_writers[parent_path] = writer
+        # The offset is reserved now so that the ref can be set right away.
+        # Writes are done in order, so the data lands at the reserved offset.
+        offset = writer.reserve(len(value))
+        self._submit_write(lambda: writer.write(value), key=key, value=value)
+        return writer.fname, offset
+
+    def _seal_segment(self, parent_path: str):
+        assert self._manifest is not None
+        manifest = self._manifest
+        writer = self._segment_writers.pop(parent_path)
+
+        def seal():
+            writer.close()
+            manifest.set_sha1(writer.fname, writer.sha1.hexdigest())
+        self._submit_write(seal)
+
+    def _seal_segments(self):
+        # Closes all open segment files and records their hashes, which were
+        # computed as the chunks were appended. Subsequent writes go to new
+        # segment files.
+        if not self._segment_writers:
+            return
+        assert self._manifest is not None
+        for parent_path in list(self._segment_writers.keys()):
+            self._seal_segment(parent_path)
+        self.flush()
+        self._manifest.save()
+
+    def _hash_staged_chunks(self) -> Dict[str, str]:
+        # Returns the SHA-1 of each chunk that is in the staging directory, by
+        # rfs key. Only keys that changed since the last upload can refer to
+        # the staging directory.
+        assert self._staging_subdir is not None
+        self.flush()
+        self._seal_segments()
+        refs = self._rfs.get('refs', {})
+        ret: Dict[str, str] = {}
+        with _span('hash.chunks') as span:
+            num_bytes = 0
+            for key in sorted(self._changed_keys):
+                v = refs.get(key, None)
+                if not isinstance(v, list) or len(v) != 3 or not v[0].startswith(self._staging_subdir):
+                    continue
+                with open(v[0], "rb") as f:
+                    f.seek(v[1])
+                    ret[key] = hashlib.sha1(f.read(v[2])).hexdigest()
+                num_bytes += v[2]
+            span.set(bytes=num_bytes, chunks=len(ret))
+        return ret
+
+    def _replace_staged_refs(self, new_refs: Dict[str, list]):
+        # Points the given keys to the given references instead of to the
+        # staging directory, and removes the staged files that are no longer
+        # referenced, so that they are neither consolidated nor uploaded.
+        assert self._staging_subdir is not None
+        assert self._manifest is not None
+        self.flush()
+        self._seal_segments()
+        refs = self._rfs['refs']
+        old_fnames = set()
+        for key, ref in new_refs.items():
+            old_fnames.add(refs[key][0])
+            refs[key] = ref
+        live_fnames = set()
+        for key in self._changed_keys:
+            v = refs.get(key, None)
+            if isinstance(v, list) and len(v) == 3 and v[0].startswith(self._staging_subdir):
+                live_fnames.add(v[0])
+        for fname in old_fnames - live_fnames:
+            if os.path.exists(fname):
+                os.remove(fname)
+            self._manifest.remove(fname)
+        self._manifest.save()
+        self._recount_staging_usage()
+
+    def compact_staging(self, *, min_dead_fraction: float = 0.25) -> int:
+        """
+        Frees the disk space of staged chunks that are no longer referenced
+        (because they were overwritten, deleted or uploaded).
+
+        Staged files that no key refers to are removed, and segment and
+        consolidated files in which at least min_dead_fraction of the bytes
+        are unreferenced are rewritten with only the referenced ranges (the
+        refs are updated accordingly). Returns the number of bytes freed.
+        """
         if self._staging_subdir is None:
-            raise ValueError("Cannot consolidate chunks without a staging directory")
-        refs_keys_by_reference_parent_path = {}
-        for k, v in self._rfs['refs'].items():
-            if isinstance(v, list) and len(v) == 3:
-                url = v[0]
-                if not url.startswith(self._staging_subdir):
+            raise ValueError("Cannot compact the staging directory without a staging directory")
+        assert self._manifest is not None
+        self.flush()
+        self._seal_segments()
+        refs = self._rfs['refs']
+        live_ranges = self._get_live_staged_ranges()
+        bytes_before = self._staging_bytes
+        num_removed = 0
+        num_rewritten = 0
+        with _span('compact_staging') as span:
+            for fname in _list_staged_files(self._staging_subdir):
+                x = live_ranges.get(fname, None)
+                if x is None:
+                    os.remove(fname)
+                    self._manifest.remove(fname)
+                    num_removed += 1
                     continue
-                parent_path = os.path.dirname(url[len(self._staging_subdir):])
-                if parent_path not in refs_keys_by_reference_parent_path:
-                    refs_keys_by_reference_parent_path[parent_path] = []
-                refs_keys_by_reference_parent_path[parent_path].append(k)
-        for root, dirs, files1 in os.walk(self._staging_subdir):
-            files = [
-                f for f in files1
-                if not f.startswith('.') and not f.startswith('consolidated.')
-            ]
-            if len(files) <= 1:
-                continue
-            parent_path = root[len(self._staging_subdir):]
-            refs_keys_for_this_dir = refs_keys_by_reference_parent_path.get(parent_path, [])
-            if len(refs_keys_for_this_dir) <= 1:
+                keys, intervals = x
+                size = os.path.getsize(fname)
+                num_dead = size - sum(b - a for a, b in intervals)
+                if num_dead == 0 or num_dead < min_dead_fraction * size:
+                    continue
+                sha1, new_starts = _rewrite_ranges(fname, intervals)
+                starts = [a for a, _ in intervals]
+                for key in keys:
+                    _, offset, chunk_size = refs[key]
+                    i = bisect.bisect_right(starts, offset) - 1
+                    refs[key] = [fname, new_starts[i] + offset - starts[i], chunk_size]
+                # the old hash (and uploaded url) no longer apply
+                self._manifest.set_sha1(fname, sha1)
+                num_rewritten += 1
+            # memory maps of the removed and rewritten files would hold on
+            # to their disk space
+            self._chunk_reader._release_local_files(self._staging_subdir + '/')
+            self._manifest.save()
+            self._recount_staging_usage()
+            span.set(bytes=bytes_before - self._staging_bytes)
+        num_freed = bytes_before - self._staging_bytes
+        print(f'Compacted the staging directory: removed {num_removed} files and rewrote {num_rewritten}, freeing {num_freed} bytes')
+        return num_freed
+
+    def _get_live_staged_ranges(self) -> Dict[str, Tuple[List[str], List[Tuple[int, int]]]]:
+        # For each staged file that is referenced, the keys that refer to it
+        # and the merged (start, end) byte ranges that they cover. Only keys
+        # that changed since the last upload can refer to the staging
+        # directory.
+        ranges_by_fname: Dict[str, List[Tuple[int, int]]] = {}
+        keys_by_fname: Dict[str, List[str]] = {}
+        for key in self._changed_keys:
+            v = self._get_staged_ref(key)
+            if v is None:
                 continue
+            keys_by_fname.setdefault(v[0], []).append(key)
+            ranges_by_fname.setdefault(v[0], []).append((v[1], v[1] + v[2]))
+        return {
+            fname: (keys_by_fname[fname], _merge_ranges(ranges))
+            for fname, ranges in ranges_by_fname.items()
+        }
+
+    def _recount_staging_usage(self):
+        # Sets the staged and dead byte counts from the files on disk
+        if self._staging_subdir is None:
+            return
+        live_ranges = self._get_live_staged_ranges()
+        self._staging_bytes = 0
+        self._dead_staging_bytes = 0
+        for fname in _list_staged_files(self._staging_subdir):
+            size = os.path.getsize(fname)
+            x = live_ranges.get(fname, None)
+            num_live = sum(b - a for a, b in x[1]) if x is not None else 0
+            self._staging_bytes += size
+            self._dead_staging_bytes += max(size - num_live, 0)
 
-            print(f'Consolidating chunks in {root}: {files}')
+    def consolidate_chunks(self, *, compute_sha1: bool = True, packing_planner: Union[PackingPlanner, None] = None):
+        if self._staging_subdir is None:
+            raise ValueError("Cannot consolidate chunks without a staging directory")
+        assert self._manifest is not None
+        self.flush()
+        self._seal_segments()
+        if packing_planner is None:
+            packing_planner = PackingPlanner()
+        # The staged chunk files and the keys that refer to them. Segment files
+        # and files from an earlier consolidation are already packed, so they
+        # are left alone. Only keys that changed since the last upload can
+        # refer to the staging directory.
+        refs = self._rfs.get('refs', {})
+        keys_by_fname: Dict[str, List[str]] = {}
+        for key in sorted(self._changed_keys):
+            v = refs.get(key, None)
+            if not isinstance(v, list) or len(v) != 3 or not v[0].startswith(self._staging_subdir + '/'):
+                continue
+            basename = os.path.basename(v[0])
+            if basename.startswith('consolidated.') or basename.startswith('segment.'):
+                continue
+            keys_by_fname.setdefault(v[0], []).append(key)
+        files = [
+            (fname[len(self._staging_subdir) + 1:], os.path.getsize(fname))
+            for fname in keys_by_fname.keys()
+        ]
+        packs = packing_planner.plan(files)
+        # Names are derived from the plan rather than random, so that the
+        # output is the same for the same input
+        plan_id = hashlib.sha1(json.dumps([files, packs], sort_keys=True).encode('utf-8')).hexdigest()[:8]
+        for pack_index, pack in enumerate(packs):
+            pack_dirs = set(os.path.dirname(path) for path in pack)
+            # a file with chunks of a single array goes in the array directory
+            pack_dir = pack_dirs.pop() if len(pack_dirs) == 1 else ''
+            consolidated_dir = f"{self._staging_subdir}/{pack_dir}" if pack_dir else self._staging_subdir
+            consolidated_fname = f"{consolidated_dir}/consolidated.{plan_id}.{pack_index}"
+            print(f'Consolidating {len(pack)} chunks into {consolidated_fname}')
 
             offset = 0
             offset_maps = {}
-            consolidated_id = _random_str(8)
-            consolidated_index = 0
-            max_size_of_consolidated_file = 1024 * 1024 * 1024  # 1 GB, a good size for cloud bucket files
-            consolidated_fname = f"{root}/consolidated.{consolidated_id}.{consolidated_index}"
-            consolidated_f = open(consolidated_fname, "wb")
-            try:
-                for fname in files:
-                    full_fname = f"{root}/{fname}"
-                    with open(full_fname, "rb") as f2:
-                        consolidated_f.write(f2.read())
-                    offset_maps[full_fname] = (consolidated_fname, offset)
-                    offset += os.path.getsize(full_fname)
-                    if offset > max_size_of_consolidated_file:
-                        consolidated_f.close()
-                        consolidated_index += 1
-                        consolidated_fname = f"{root}/consolidated.{consolidated_id}.{consolidated_index}"
-                        consolidated_f = open(consolidated_fname, "wb")
-                        offset = 0
-            finally:
-                consolidated_f.close()
-            for key in refs_keys_for_this_dir:
-                filename, old_offset, old_size = self._rfs['refs'][key]
-                if filename not in offset_maps:
-                    continue
-                consolidated_fname, new_offset = offset_maps[filename]
-                self._rfs['refs'][key] = [consolidated_fname, new_offset + old_offset, old_size]
+            # unbuffered, so that kernel-side copies and our own writes share
+            # the same file position
+            with open(consolidated_fname, "wb", buffering=0) as consolidated_f, _span('consolidate', files=len(pack)) as span:
+                # hash while writing so that the upload does not need to read
+                # the consolidated file again to compute its content address
+                consolidated_sha1 = hashlib.sha1() if compute_sha1 else None
+                for path in pack:
+                    full_fname = f"{self._staging_subdir}/{path}"
+                    num_bytes = _copy_file_into(full_fname, consolidated_f, sha1=consolidated_sha1)
+                    offset_maps[full_fname] = offset
+                    offset += num_bytes
+                span.set(bytes=offset)
+            if consolidated_sha1 is not None:
+                self._manifest.set_sha1(consolidated_fname, consolidated_sha1.hexdigest())
+            for full_fname, new_offset in offset_maps.items():
+                for key in keys_by_fname[full_fname]:
+                    _, old_offset, old_size = refs[key]
+                    refs[key] = [consolidated_fname, new_offset + old_offset, old_size]
             # remove the old files
-            for fname in files:
-                os.remove(f"{root}/{fname}")
+            for full_fname in offset_maps.keys():
+                os.remove(full_fname)
+                self._manifest.remove(full_fname)
+        self._manifest.save()
+
+
+class _SegmentWriter:
+    # An append-only segment file that hashes its content as it is written.
+    # The file is unbuffered so that appended chunks can be read back
+    # immediately through their refs. Space is reserved by the writing thread
+    # (reserve) and the data may be written later by the background writer
+    # (write), in the same order.
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.size = 0
+        self.sha1 = hashlib.sha1()
+        self._f = open(fname, "wb", buffering=0)
+
+    def reserve(self, size: int) -> int:
+        offset = self.size
+        self.size += size
+        return offset
+
+    def write(self, data: bytes):
+        _write_all(self._f, memoryview(data))
+        self.sha1.update(data)
+
+    def close(self):
+        self._f.close()
+
+
+_copy_buffer_size = 4 * 1024 * 1024
+
+# errors that mean the kernel cannot do the copy for this pair of files, in
+# which case we fall back to a buffered copy
+_kernel_copy_unsupported_errnos = {
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF
+}
+
+
+def _copy_file_into(src_fname: str, dst_f: Any, *, sha1: Any = None) -> int:
+    # Appends the contents of src_fname to the unbuffered file dst_f and
+    # returns the number of bytes copied. If sha1 is None, the copy is done
+    # inside the kernel where possible (copy_file_range, which can also reflink
+    # on filesystems that support it, then sendfile). Otherwise the data must
+    # pass through user space to be hashed, so we use a fixed-size buffer and
+    # memory use does not depend on the size of the file.
+    size = os.path.getsize(src_fname)
+    with open(src_fname, "rb", buffering=0) as src_f:
+        if sha1 is None:
+            num_copied = _kernel_copy(src_f.fileno(), dst_f.fileno(), size)
+            if num_copied == size:
+                return size
+            # whatever the kernel did not copy is done below
+            src_f.seek(num_copied)
+        else:
+            num_copied = 0
+        buf = bytearray(min(_copy_buffer_size, max(size - num_copied, 1)))
+        view = memoryview(buf)
+        while True:
+            n = src_f.readinto(buf)
+            if not n:
+                break
+            if sha1 is not None:
+                sha1.update(view[:n])
+            _write_all(dst_f, view[:n])
+            num_copied += n
+    return num_copied
+
+
+def _kernel_copy(src_fd: int, dst_fd: int, size: int) -> int:
+    # Returns the number of bytes copied, which may be less than size if the
+    # kernel does not support copying between these files.
+    num_copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while num_copied < size:
+                n = os.copy_file_range(src_fd, dst_fd, size - num_copied)
+                if n == 0:
+                    break
+                num_copied += n
+        except OSError as e:
+            if e.errno not in _kernel_copy_unsupported_errnos:
+                raise
+    if num_copied < size and hasattr(os, 'sendfile'):
+        try:
+            while num_copied < size:
+                n = os.sendfile(dst_fd, src_fd, num_copied, size - num_copied)
+                if n == 0:
+                    break
+                num_copied += n
+        except OSError as e:
+            if e.errno not in _kernel_copy_unsupported_errnos:
+                raise
+    return num_copied
+
+
+def _list_staged_files(staging_subdir: str) -> List[str]:
+    # the staged blobs, leaving out hidden bookkeeping files and directories
+    # (the manifest, multipart journals and temporary files)
+    ret = []
+    for root, dirs, files in os.walk(staging_subdir):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for fname in files:
+            if not fname.startswith('.'):
+                ret.append(f"{root}/{fname}")
+    return ret
+
+
+def _merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    # sorted, non-overlapping (start, end) ranges covering the given ones
+    ret: List[Tuple[int, int]] = []
+    for a, b in sorted(ranges):
+        if ret and a <= ret[-1][1]:
+            ret[-1] = (ret[-1][0], max(ret[-1][1], b))
+        else:
+            ret.append((a, b))
+    return ret
+
+
+def _rewrite_ranges(fname: str, ranges: List[Tuple[int, int]]):
+    # Replaces the file with the concatenation of the given byte ranges and
+    # returns the SHA-1 of the new content and the new start of each range.
+    # As with _write_file, memory maps of the old file remain valid.
+    tmp_fname = f"{os.path.dirname(fname)}/.{os.path.basename(fname)}.tmp"
+    sha1 = hashlib.sha1()
+    new_starts = []
+    position = 0
+    buf = bytearray(min(_copy_buffer_size, max(max((b - a for a, b in ranges), default=0), 1)))
+    view = memoryview(buf)
+    with open(fname, "rb", buffering=0) as src_f, open(tmp_fname, "wb", buffering=0) as dst_f:
+        for a, b in ranges:
+            new_starts.append(position)
+            src_f.seek(a)
+            remaining = b - a
+            while remaining > 0:
+                n = src_f.readinto(view[:min(remaining, len(buf))])
+                if not n:
+                    raise Exception(f"Unexpected end of staged file: {fname}")
+                sha1.update(view[:n])
+                _write_all(dst_f, view[:n])
+                remaining -= n
+                position += n
+    os.replace(tmp_fname, fname)
+    return sha1.hexdigest(), new_starts
+
+
+def _write_file(fname: str, data: bytes):
+    # The file is replaced rather than overwritten in place, so that memory
+    # maps of the previous version (see ChunkReader) remain valid.
+    dirname = os.path.dirname(fname)
+    os.makedirs(dirname, exist_ok=True)
+    tmp_fname = f"{dirname}/.{os.path.basename(fname)}.tmp"
+    with open(tmp_fname, "wb") as f:
+        f.write(data)
+    os.replace(tmp_fname, fname)
+
+
+def _write_all(f: Any, data: memoryview):
+    # unbuffered writes may be partial
+    while len(data) > 0:
+        n = f.write(data)
+        data = data[n:]
+
+
+def _decode_inline_value(x: Union[str, dict]) -> bytes:
+    # as in LindiReferenceFileSystemStore
+    if isinstance(x, dict):
+        return json.dumps(x).encode('utf-8')
+    if x.startswith('base64:'):
+        return base64.b64decode(x[len('base64:'):])
+    return x.encode('utf-8')
+
+
+def _inline_chunk_size(key: str, value: Any) -> int:
+    # the size in the .zarr.json of an inlined chunk (a string, either base64
+    # or ascii), or 0 for references and metadata keys
+    if not isinstance(value, str) or os.path.basename(key).startswith('.'):
+        return 0
+    return len(value)
 
 
 def _create_random_id():
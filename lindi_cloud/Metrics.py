@@ -0,0 +1,190 @@
+from typing import Any, Callable, Dict, List, Tuple, Union
+import os
+import json
+import time
+import threading
+import contextvars
+
+
+class Metrics:
+    """
+    Collects timings, byte counts and counters from lindi_cloud operations
+
+    Use it as a context manager; while it is active, the store, the chunk
+    reader, consolidation and uploads record into it (including from their
+    worker threads):
+
+        with lindi_cloud.Metrics(trace_file='trace.json') as metrics:
+            lindi_cloud.lindi_cloud_upload(client, url)
+        metrics.print_summary()
+
+    Spans (e.g., 'upload.put', 'store.set', 'consolidate') are aggregated by
+    name into count, total and max seconds and bytes. Counters (e.g.,
+    'chunk_reader.memory_cache.hits', 'upload.retries') are summed. If
+    trace_file is given, every span is also written to it in the Chrome
+    trace event format (viewable in chrome://tracing or
+    https://ui.perfetto.dev), and if an exporter is given (see
+    OpenTelemetryExporter), every span is passed to it as it ends.
+
+    The active Metrics object is kept in a context variable, so each thread
+    (or asyncio task) has its own, and the lindi_cloud worker pools pass the
+    context of the code that submitted the work on to their workers. When no
+    Metrics object is active, the instrumentation does nothing but check for
+    one.
+    """
+    def __init__(self, *, trace_file: Union[str, None] = None, exporter: Any = None):
+        """
+        Parameters
+        ----------
+        trace_file : str or None
+            Where to write the JSON trace when the context exits.
+        exporter : object or None
+            An object with an export(name, start_time_ns, end_time_ns,
+            attributes) method that is called for each span.
+        """
+        self._trace_file = trace_file
+        self._exporter = exporter
+        self._lock = threading.Lock()
+        self._spans: Dict[str, Dict[str, Any]] = {}
+        self._counters: Dict[str, int] = {}
+        self._trace_events: List[dict] = []
+
+    def __enter__(self):
+        token = _active_metrics.set(self)
+        # the tokens are kept in the context too, so that contexts exiting
+        # in any order each restore their own previous Metrics
+        _active_metrics_tokens.set(_active_metrics_tokens.get() + (token,))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        tokens = _active_metrics_tokens.get()
+        _active_metrics_tokens.set(tokens[:-1])
+        _active_metrics.reset(tokens[-1])
+        if self._trace_file is not None:
+            self.write_trace(self._trace_file)
+
+    def span(self, name: str, **attributes) -> '_Span':
+        """
+        A context manager that times a block of code. Attributes (e.g.,
+        bytes=...) can also be set on the span before it ends.
+        """
+        return _Span(self, name, attributes)
+
+    def add(self, name: str, value: int = 1):
+        """Adds value to the counter with this name."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def get_stats(self) -> dict:
+        """
+        Returns {'spans': {name: {'count', 'total_sec', 'max_sec', 'bytes'}},
+        'counters': {name: value}}.
+        """
+        with self._lock:
+            return {
+                'spans': {k: dict(v) for k, v in self._spans.items()},
+                'counters': dict(self._counters)
+            }
+
+    def print_summary(self):
+        stats = self.get_stats()
+        for name, x in sorted(stats['spans'].items(), key=lambda a: -a[1]['total_sec']):
+            line = f'{name}: {x["count"]} in {x["total_sec"]:.3f} sec (max {x["max_sec"]:.3f} sec)'
+            if x['bytes'] > 0:
+                line += f', {x["bytes"]} bytes'
+            print(line)
+        for name, value in sorted(stats['counters'].items()):
+            print(f'{name}: {value}')
+
+    def write_trace(self, fname: str):
+        with self._lock:
+            events = list(self._trace_events)
+        with open(fname, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def _record_span(self, name: str, start_ns: int, end_ns: int, attributes: Dict[str, Any]):
+        elapsed = (end_ns - start_ns) / 1e9
+        num_bytes = attributes.get('bytes', 0) or 0
+        with self._lock:
+            x = self._spans.get(name, None)
+            if x is None:
+                x = {'count': 0, 'total_sec': 0.0, 'max_sec': 0.0, 'bytes': 0}
+                self._spans[name] = x
+            x['count'] += 1
+            x['total_sec'] += elapsed
+            x['max_sec'] = max(x['max_sec'], elapsed)
+            x['bytes'] += num_bytes
+            if self._trace_file is not None:
+                self._trace_events.append({
+                    'name': name,
+                    'ph': 'X',
+                    'ts': start_ns / 1000,
+                    'dur': (end_ns - start_ns) / 1000,
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                    'args': attributes
+                })
+        if self._exporter is not None:
+            self._exporter.export(name, start_ns, end_ns, attributes)
+
+
+class _Span:
+    def __init__(self, metrics: Metrics, name: str, attributes: Dict[str, Any]):
+        self._metrics = metrics
+        self._name = name
+        self._attributes = attributes
+        self._start_ns = 0
+
+    def set(self, **attributes):
+        self._attributes.update(attributes)
+
+    def __enter__(self):
+        self._start_ns = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self._attributes['error'] = exc_type.__name__
+        self._metrics._record_span(self._name, self._start_ns, time.time_ns(), self._attributes)
+
+
+class _NullSpan:
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_active_metrics: 'contextvars.ContextVar[Union[Metrics, None]]' = contextvars.ContextVar('lindi_cloud_active_metrics', default=None)
+_active_metrics_tokens: 'contextvars.ContextVar[Tuple[contextvars.Token, ...]]' = contextvars.ContextVar('lindi_cloud_active_metrics_tokens', default=())
+_null_span = _NullSpan()
+
+
+def _span(name: str, **attributes) -> Union[_Span, _NullSpan]:
+    # for instrumenting lindi_cloud code; a no-op unless a Metrics is active
+    metrics = _active_metrics.get()
+    if metrics is None:
+        return _null_span
+    return _Span(metrics, name, attributes)
+
+
+def _count(name: str, value: int = 1):
+    metrics = _active_metrics.get()
+    if metrics is not None:
+        metrics.add(name, value)
+
+
+def _in_current_context(fn: Callable) -> Callable:
+    # Wraps fn for a worker pool so that it runs in (a copy of) the context
+    # of the caller, and records into the caller's active Metrics. Each call
+    # gets its own copy, since a context can only be entered by one thread
+    # at a time.
+    ctx = contextvars.copy_context()
+
+    def wrapper(*args, **kwargs):
+        return ctx.copy().run(fn, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,35 @@
+from typing import Any, Dict
+
+
+class OpenTelemetryExporter:
+    """
+    Passes the spans recorded by a Metrics object to an OpenTelemetry tracer
+
+    Requires the opentelemetry-api package (and an SDK with an exporter
+    configured for the spans to go anywhere):
+
+        metrics = lindi_cloud.Metrics(exporter=lindi_cloud.OpenTelemetryExporter())
+    """
+    def __init__(self, tracer: Any = None):
+        """
+        Parameters
+        ----------
+        tracer : opentelemetry.trace.Tracer or None
+            The tracer to use. Defaults to the tracer named 'lindi_cloud' of
+            the global tracer provider.
+        """
+        if tracer is None:
+            try:
+                from opentelemetry import trace
+            except ImportError:
+                raise ImportError("The opentelemetry-api package is required for OpenTelemetryExporter")
+            tracer = trace.get_tracer('lindi_cloud')
+        self._tracer = tracer
+
+    def export(self, name: str, start_time_ns: int, end_time_ns: int, attributes: Dict[str, Any]):
+        span = self._tracer.start_span(
+            name,
+            start_time=start_time_ns,
+            attributes={k: v for k, v in attributes.items() if isinstance(v, (str, bool, int, float))}
+        )
+        span.end(end_time=end_time_ns)
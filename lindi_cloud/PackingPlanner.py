@@ -0,0 +1,112 @@
+from typing import Dict, List, Sequence, Tuple, Union
+import os
+
+
+class PackingPlanner:
+    """
+    Decides how staged chunk files are packed into consolidated files
+
+    Chunks are ordered by array path and then by zarr chunk index (row-major,
+    or following the axis order declared for the array in access_patterns),
+    so that chunks that are read together end up next to each other and
+    their byte ranges can be coalesced into fewer HTTP requests. The plan
+    only depends on the paths and sizes of the chunks, so identical input
+    gives byte-identical consolidated files.
+
+    The chunks of arrays smaller than small_array_size are packed together
+    into shared files, even across directories, rather than each array
+    getting its own small file. Larger arrays get files of their own. Files
+    are split when they would exceed target_segment_size.
+    """
+    def __init__(
+        self,
+        *,
+        target_segment_size: int = 1024 * 1024 * 1024,
+        small_array_size: int = 64 * 1024 * 1024,
+        access_patterns: Union[Dict[str, Sequence[int]], None] = None
+    ):
+        """
+        Parameters
+        ----------
+        target_segment_size : int
+            The maximum size of a consolidated file (unless a single chunk is
+            larger).
+        small_array_size : int
+            Arrays whose staged chunks add up to less than this share
+            consolidated files with other small arrays.
+        access_patterns : dict or None
+            For arrays that are not read in row-major order, the order of the
+            axes from slowest to fastest varying, by array path. For example,
+            {'acquisition/ElectricalSeries/data': [1, 0]} places the chunks
+            along axis 0 next to each other, for reading one channel at a
+            time.
+        """
+        if target_segment_size < 1:
+            raise ValueError('target_segment_size must be positive')
+        self._target_segment_size = target_segment_size
+        self._small_array_size = small_array_size
+        self._access_patterns = {
+            k.strip('/'): list(v) for k, v in (access_patterns or {}).items()
+        }
+
+    def plan(self, files: List[Tuple[str, int]]) -> List[List[str]]:
+        """
+        Takes the (relative path, size) of each staged chunk file and returns
+        the consolidated files to create, each as the list of the chunk files
+        to concatenate, in order. Chunk files that are not in the plan are
+        left as they are.
+        """
+        files_by_array_path: Dict[str, List[Tuple[str, int]]] = {}
+        for path, size in files:
+            files_by_array_path.setdefault(os.path.dirname(path), []).append((path, size))
+        packs: List[List[str]] = []
+        shared = _PackBuilder(self._target_segment_size, packs)
+        for array_path in sorted(files_by_array_path.keys()):
+            access_pattern = self._access_patterns.get(array_path, None)
+            chunk_files = sorted(
+                files_by_array_path[array_path],
+                key=lambda x: _chunk_sort_key(os.path.basename(x[0]), access_pattern)
+            )
+            total_size = sum(size for _, size in chunk_files)
+            if total_size < self._small_array_size:
+                for path, size in chunk_files:
+                    shared.add(path, size)
+            else:
+                own = _PackBuilder(self._target_segment_size, packs)
+                for path, size in chunk_files:
+                    own.add(path, size)
+                own.close()
+        shared.close()
+        # there is no point in copying a single chunk file
+        return [pack for pack in packs if len(pack) > 1]
+
+
+class _PackBuilder:
+    def __init__(self, target_size: int, packs: List[List[str]]):
+        self._target_size = target_size
+        self._packs = packs
+        self._current: List[str] = []
+        self._current_size = 0
+
+    def add(self, path: str, size: int):
+        if self._current and self._current_size + size > self._target_size:
+            self.close()
+        self._current.append(path)
+        self._current_size += size
+
+    def close(self):
+        if self._current:
+            self._packs.append(self._current)
+        self._current = []
+        self._current_size = 0
+
+
+def _chunk_sort_key(chunk_name: str, access_pattern: Union[List[int], None]) -> tuple:
+    # chunk names are like 3.0.1 (zarr v2); anything else sorts after them
+    try:
+        index = [int(x) for x in chunk_name.split('.')]
+    except ValueError:
+        return (1, chunk_name)
+    if access_pattern is not None and len(access_pattern) == len(index):
+        index = [index[axis] for axis in access_pattern]
+    return (0, tuple(index))
@@ -0,0 +1,108 @@
+from typing import Dict, List, Union
+import os
+import json
+
+
+class StagingManifest:
+    """
+    A sidecar file in a staging subdir that records the SHA-1 of staged files
+
+    The hash is recorded at the time the file is written (for example during
+    consolidation) so that the upload step does not need to read the file a
+    second time just to compute its content address. Each entry also records
+    the size and mtime of the file so that a stale hash is never used for a
+    file that has been modified since.
+
+    Once a file has been uploaded, its blob URL is recorded as well, so that
+    a later upload from the same staging subdir skips the file entirely (no
+    hashing and no request to check whether the blob exists). The manifest
+    also records which rfs keys changed in the last upload.
+
+    The manifest lives in the staging subdir of a store, so it only lasts as
+    long as that store (one session): a later lindi_cloud_load of the
+    uploaded .zarr.json gets a new staging subdir and starts without one.
+    That session does not need it, since the loaded file already refers to
+    the uploaded blobs and only the chunks written in the session are staged.
+    """
+    manifest_basename = '.lindi_cloud_manifest.json'
+
+    def __init__(self, staging_subdir: str):
+        self._staging_subdir = staging_subdir
+        self._fname = f"{staging_subdir}/{StagingManifest.manifest_basename}"
+        self._entries: Dict[str, dict] = {}
+        self._last_upload: Union[dict, None] = None
+        if os.path.exists(self._fname):
+            with open(self._fname, "r") as f:
+                x = json.load(f)
+            self._entries = x['files']
+            self._last_upload = x['last_upload']
+
+    def set_sha1(self, fname: str, sha1: str):
+        st = os.stat(fname)
+        self._entries[self._relative_path(fname)] = {
+            'sha1': sha1,
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns
+        }
+
+    def get_sha1(self, fname: str) -> Union[str, None]:
+        entry = self._get_entry(fname)
+        if entry is None:
+            return None
+        return entry['sha1']
+
+    def set_uploaded_url(self, fname: str, url: str):
+        entry = self._get_entry(fname)
+        if entry is None:
+            # the hash was not recorded (e.g., kachery computes its own)
+            st = os.stat(fname)
+            entry = {'sha1': None, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+            self._entries[self._relative_path(fname)] = entry
+        entry['url'] = url
+
+    def get_uploaded_url(self, fname: str, *, prefix: str) -> Union[str, None]:
+        # prefix is the zone base url (or 'sha1://' for kachery), so that a
+        # blob uploaded to a different zone is not mistaken for uploaded
+        entry = self._get_entry(fname)
+        if entry is None:
+            return None
+        url = entry.get('url', None)
+        if url is None or not url.startswith(prefix):
+            return None
+        return url
+
+    def record_upload(self, url: str, changed_keys: List[str]):
+        self._last_upload = {
+            'url': url,
+            'changed_keys': sorted(changed_keys)
+        }
+
+    def get_last_upload(self) -> Union[dict, None]:
+        return self._last_upload
+
+    def remove(self, fname: str):
+        self._entries.pop(self._relative_path(fname), None)
+
+    def save(self):
+        tmp_fname = f"{self._fname}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump({'files': self._entries, 'last_upload': self._last_upload}, f)
+        os.replace(tmp_fname, self._fname)
+
+    def _get_entry(self, fname: str) -> Union[dict, None]:
+        # returns None if there is no entry or if the file has been modified
+        entry = self._entries.get(self._relative_path(fname), None)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(fname)
+        except FileNotFoundError:
+            return None
+        if st.st_size != entry['size'] or st.st_mtime_ns != entry['mtime_ns']:
+            return None
+        return entry
+
+    def _relative_path(self, fname: str) -> str:
+        if not fname.startswith(self._staging_subdir + '/'):
+            raise ValueError(f"File is not in the staging subdir: {fname}")
+        return fname[len(self._staging_subdir) + 1:]
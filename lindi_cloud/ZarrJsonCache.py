@@ -0,0 +1,170 @@
+from typing import Any, Dict, List, Tuple, Union
+import os
+import json
+import hashlib
+import tempfile
+
+
+class ZarrJsonCache:
+    """
+    An on-disk cache of remote .zarr.json files, keyed by URL
+
+    The downloaded bytes are stored (as received, possibly compressed) under
+    their SHA-1, and for each URL a small entry file records the SHA-1
+    together with the ETag and Last-Modified headers so that the cached copy
+    can be revalidated with a conditional request.
+
+    The cache can be shared between processes: all files are written to a
+    temporary file and then atomically renamed into place, and a blob that
+    disappears (evicted by another process) is treated as a cache miss. The
+    modification time of a blob is bumped whenever it is used, and when the
+    total size of the blobs and entries exceeds max_bytes, the least recently
+    used blobs are evicted together with the entries that refer to them.
+    """
+    def __init__(self, cache_dir: str, *, max_bytes: int = 10 * 1024 * 1024 * 1024):
+        self._cache_dir = os.path.abspath(cache_dir)
+        self._max_bytes = max_bytes
+        self._blobs_dir = f"{self._cache_dir}/blobs"
+        self._entries_dir = f"{self._cache_dir}/entries"
+        os.makedirs(self._blobs_dir, exist_ok=True)
+        os.makedirs(self._entries_dir, exist_ok=True)
+
+    def lookup(self, url: str) -> Union[dict, None]:
+        entry_fname = self._entry_fname(url)
+        try:
+            with open(entry_fname, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if entry.get('url', None) != url or not os.path.exists(self._blob_fname(entry['sha1'])):
+            return None
+        return entry
+
+    def open_blob(self, entry: dict) -> Any:
+        # Raises FileNotFoundError if the blob was evicted in the meantime. Once
+        # opened, the file remains readable even if it is evicted.
+        blob_fname = self._blob_fname(entry['sha1'])
+        f = open(blob_fname, "rb")
+        _touch(blob_fname)
+        return f
+
+    def begin_download(self, url: str, stream: Any, headers: Any) -> '_CacheWriter':
+        return _CacheWriter(self, url, stream, headers)
+
+    def evict(self):
+        blobs: Dict[str, Tuple[float, int]] = {}  # sha1 -> (mtime, size)
+        for x in os.scandir(self._blobs_dir):
+            if x.name.startswith('.'):
+                continue  # in-progress download
+            try:
+                st = x.stat()
+            except FileNotFoundError:
+                continue
+            blobs[x.name] = (st.st_mtime, st.st_size)
+        # sha1 -> [(entry file, size)]
+        entries: Dict[str, List[Tuple[str, int]]] = {}
+        for x in os.scandir(self._entries_dir):
+            if x.name.startswith('.'):
+                continue  # being written
+            try:
+                st = x.stat()
+                with open(x.path, "r") as f:
+                    sha1 = json.load(f)['sha1']
+            except FileNotFoundError:
+                continue
+            except (json.JSONDecodeError, KeyError, TypeError):
+                _remove(x.path)
+                continue
+            if sha1 not in blobs and not os.path.exists(self._blob_fname(sha1)):
+                # the blob was evicted (possibly by another process)
+                _remove(x.path)
+                continue
+            entries.setdefault(sha1, []).append((x.path, st.st_size))
+        total_size = sum(size for _, size in blobs.values())
+        total_size += sum(size for ee in entries.values() for _, size in ee)
+        # blobs that no entry refers to first (their url was cached again with
+        # different content), then the least recently used
+        order = sorted(blobs.items(), key=lambda a: (a[0] in entries, a[1][0]))
+        for sha1, (_, size) in order:
+            if total_size <= self._max_bytes:
+                break
+            # the entries first, so that they never refer to a missing blob
+            for entry_fname, entry_size in entries.get(sha1, []):
+                _remove(entry_fname)
+                total_size -= entry_size
+            _remove(self._blob_fname(sha1))
+            total_size -= size
+
+    def _add(self, url: str, sha1: str, size: int, headers: Any, tmp_fname: str):
+        blob_fname = self._blob_fname(sha1)
+        os.replace(tmp_fname, blob_fname)
+        entry = {
+            'url': url,
+            'sha1': sha1,
+            'size': size,
+            'etag': headers.get('ETag', None),
+            'last_modified': headers.get('Last-Modified', None),
+            'content_encoding': headers.get('Content-Encoding', None)
+        }
+        _write_json_atomically(self._entry_fname(url), entry, dir=self._entries_dir)
+        self.evict()
+
+    def _entry_fname(self, url: str) -> str:
+        return f"{self._entries_dir}/{hashlib.sha1(url.encode('utf-8')).hexdigest()}.json"
+
+    def _blob_fname(self, sha1: str) -> str:
+        return f"{self._blobs_dir}/{sha1}"
+
+
+class _CacheWriter:
+    # A stream that passes data through from the HTTP response while also
+    # writing it to a temporary file in the cache. Call finish() once the
+    # consumer is done to add the file to the cache.
+    def __init__(self, cache: ZarrJsonCache, url: str, stream: Any, headers: Any):
+        self._cache = cache
+        self._url = url
+        self._stream = stream
+        self._headers = headers
+        self._sha1 = hashlib.sha1()
+        self._size = 0
+        fd, self._tmp_fname = tempfile.mkstemp(dir=cache._blobs_dir, prefix='.download.')
+        self._f = os.fdopen(fd, "wb")
+
+    def read(self, n: int = -1) -> bytes:
+        data = self._stream.read(n)
+        self._f.write(data)
+        self._sha1.update(data)
+        self._size += len(data)
+        return data
+
+    def finish(self):
+        # the parser may stop before the end of the stream (trailing whitespace)
+        while self.read(1024 * 1024):
+            pass
+        self._f.close()
+        self._cache._add(self._url, self._sha1.hexdigest(), self._size, self._headers, self._tmp_fname)
+
+    def abort(self):
+        self._f.close()
+        _remove(self._tmp_fname)
+
+
+def _remove(fname: str):
+    try:
+        os.remove(fname)
+    except FileNotFoundError:
+        pass
+
+
+def _touch(fname: str):
+    try:
+        os.utime(fname)
+    except FileNotFoundError:
+        pass
+
+
+def _write_json_atomically(fname: str, obj: Any, *, dir: str):
+    fd, tmp_fname = tempfile.mkstemp(dir=dir, prefix='.tmp.')
+    with os.fdopen(fd, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_fname, fname)
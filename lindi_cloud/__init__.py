@@ -1,5 +1,14 @@
 from .lindi_cloud_consolidate_chunks import lindi_cloud_consolidate_chunks  # noqa: F401
 from .lindi_cloud_cleanup import lindi_cloud_cleanup  # noqa: F401
+from .lindi_cloud_compact_staging import lindi_cloud_compact_staging  # noqa: F401
 from .lindi_cloud_create import lindi_cloud_create  # noqa: F401
+from .lindi_cloud_gc import lindi_cloud_gc  # noqa: F401
 from .lindi_cloud_load import lindi_cloud_load  # noqa: F401
 from .lindi_cloud_upload import lindi_cloud_upload  # noqa: F401
+from .lindi_cloud_write_array import lindi_cloud_write_array  # noqa: F401
+from .lindi_cloud_write_stream import lindi_cloud_write_stream  # noqa: F401
+from .InlinePolicy import InlinePolicy  # noqa: F401
+from .PackingPlanner import PackingPlanner  # noqa: F401
+from .ChunkReader import ChunkReader  # noqa: F401
+from .Metrics import Metrics  # noqa: F401
+from .OpenTelemetryExporter import OpenTelemetryExporter  # noqa: F401
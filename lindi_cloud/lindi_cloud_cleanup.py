@@ -9,5 +9,6 @@ def lindi_cloud_cleanup(client: lindi.LindiH5pyFile):
     if not isinstance(store, LindiCloudStore):
         raise ValueError("The zarr store for this client is not a LindiCloudStore")
     if store._staging_subdir is not None:
+        store._seal_segments()
         if os.path.exists(store._staging_subdir):
             shutil.rmtree(store._staging_subdir)
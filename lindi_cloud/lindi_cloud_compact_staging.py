@@ -0,0 +1,9 @@
+import lindi
+from .LindiCloudStore import LindiCloudStore
+
+
+def lindi_cloud_compact_staging(client: lindi.LindiH5pyFile, min_dead_fraction: float = 0.25) -> int:
+    store = client._zarr_store
+    if not isinstance(store, LindiCloudStore):
+        raise ValueError("The zarr store for this client is not a LindiCloudStore")
+    return store.compact_staging(min_dead_fraction=min_dead_fraction)
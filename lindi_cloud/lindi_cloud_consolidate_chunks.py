@@ -1,9 +1,11 @@
+from typing import Union
 import lindi
 from .LindiCloudStore import LindiCloudStore
+from .PackingPlanner import PackingPlanner
 
 
-def lindi_cloud_consolidate_chunks(client: lindi.LindiH5pyFile):
+def lindi_cloud_consolidate_chunks(client: lindi.LindiH5pyFile, packing_planner: Union[PackingPlanner, None] = None):
     store = client._zarr_store
     if not isinstance(store, LindiCloudStore):
         raise ValueError("The zarr store for this client is not a LindiCloudStore")
-    store.consolidate_chunks()
+    store.consolidate_chunks(packing_planner=packing_planner)
@@ -1,14 +1,37 @@
-from typing import Union
+from typing import Union, Literal
 import os
 import zarr
 import lindi
 from .LindiCloudStore import LindiCloudStore
+from .InlinePolicy import InlinePolicy
+from .ChunkReader import ChunkReader
 
 
-def lindi_cloud_create(staging_dir: Union[str, None]):
+def lindi_cloud_create(
+    staging_dir: Union[str, None],
+    staging_mode: Literal['files', 'segments'] = 'files',
+    max_segment_size: int = 1024 * 1024 * 1024,
+    write_behind: bool = False,
+    write_behind_max_bytes: int = 256 * 1024 * 1024,
+    compact_refs: bool = False,
+    inline_policy: Union[InlinePolicy, None] = None,
+    chunk_reader: Union[ChunkReader, None] = None,
+    staging_quota_bytes: Union[int, None] = None
+):
     if staging_dir is not None:
         staging_dir = os.path.abspath(staging_dir)
     rfs = {'refs': {}}  # empty reference file system
-    store = LindiCloudStore(rfs=rfs, staging_dir=staging_dir)
+    store = LindiCloudStore(
+        rfs=rfs,
+        staging_dir=staging_dir,
+        staging_mode=staging_mode,
+        max_segment_size=max_segment_size,
+        write_behind=write_behind,
+        write_behind_max_bytes=write_behind_max_bytes,
+        compact_refs=compact_refs,
+        inline_policy=inline_policy,
+        chunk_reader=chunk_reader,
+        staging_quota_bytes=staging_quota_bytes
+    )
     zarr.group(store)  # create root group
     return lindi.LindiH5pyFile.from_zarr_store(store, mode='r+')
\ No newline at end of file
@@ -0,0 +1,383 @@
+from typing import Any, Iterable, Iterator, List, Tuple, Union
+import io
+import re
+import gzip
+import time
+import tempfile
+import numpy as np
+from .ChunkIndex import ChunkIndex
+from .rfs_json import iterparse_rfs_json, open_decoded_stream
+
+
+# the content-addressed blob urls written by lindi_cloud_upload:
+# <zone>/sha1/aa/bb/cc/aabbcc...
+_blob_url_regex = re.compile(r'/sha1/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{40})')
+_sha1_regex = re.compile(r'^[0-9a-f]{40}$')
+
+# When an upload reuses an existing blob, the upload api writes an empty
+# marker object <blob key>.refreshed next to it rather than copying the blob
+# to update its LastModified. It comes right after the blob in a listing.
+_refresh_marker_suffix = '.refreshed'
+
+# the maximum for ListObjectsV2 and DeleteObjects
+_max_keys_per_request = 1000
+
+# LastModified has a resolution of one second and comes from the clock of the
+# storage service rather than ours, so the .zarr.json files are parsed again if
+# they were modified shortly before the scan started too
+_rescan_margin_sec = 10 * 60
+
+
+def lindi_cloud_gc(
+    zone_url: str,
+    *,
+    reference_zone_urls: Union[List[str], None] = None,
+    grace_period_sec: float = 7 * 24 * 60 * 60,
+    dry_run: bool = True,
+    bucket: str = 'neurosift-lindi',
+    endpoint_url: Union[str, None] = None,
+    s3_client: Any = None,
+    report_file: Union[str, None] = None
+) -> dict:
+    """
+    Find (and unless dry_run, delete) the blobs of a zone that no .zarr.json
+    file refers to.
+
+    All the .zarr.json files under f/ in the zones of reference_zone_urls are
+    parsed as streams, and the SHA-1 of every blob they refer to is collected
+    in a compact sorted array. The blobs under sha1/ in the zone are then
+    listed page by page, and those that are not referred to and are older
+    than the grace period are unreachable.
+
+    The grace period protects uploads in progress, as long as they take less
+    time than the grace period: an upload writes its .zarr.json after the
+    blobs it uploads, and the existing blobs that it reuses instead (found
+    through the chunk index or because they have the same content) are
+    refreshed by the upload api, which writes a <blob>.refreshed marker
+    object next to each (a blob counts as modified when its marker was).
+    Before deleting, the unreachable blobs are dropped from the zone's chunk
+    index so that later uploads do not deduplicate against them, the
+    .zarr.json files modified since the scan started are parsed again, and
+    each batch of blobs is listed again just before it is deleted (together
+    with its markers), so that blobs that were refreshed in the meantime are
+    kept. Only a blob that is reused between that listing and the deletion
+    of its batch can still be lost.
+
+    Memory use depends on the number of distinct referenced blobs, not on
+    the number of objects in the zone.
+
+    The bucket is accessed directly with boto3 (credentials from the usual
+    AWS environment variables or config files).
+
+    Parameters
+    ----------
+    zone_url : str
+        The zone to collect, e.g., https://lindi.neurosift.org/zones/<gh-user>/<zone-name>
+    reference_zone_urls : list of str or None
+        The zones whose .zarr.json files count as references. Defaults to
+        [zone_url]. Files in other zones may refer to the blobs of this zone,
+        so pass those zones too (or the url of all the zones,
+        https://lindi.neurosift.org/zones) to keep what they refer to.
+    grace_period_sec : float
+        Blobs modified more recently than this are never deleted.
+    dry_run : bool
+        If True (the default), only report what would be deleted.
+    bucket : str
+        The S3 bucket that serves the zones.
+    endpoint_url : str or None
+        The S3 endpoint, for S3-compatible storage or a local stand-in.
+    s3_client : object or None
+        A boto3 S3 client to use instead of creating one.
+    report_file : str or None
+        If given, the unreachable blobs are written to this file (one
+        "<url> <size>" line each).
+
+    Returns
+    -------
+    dict
+        Counts and byte totals of the referenced, unreachable and deleted
+        blobs, and the number of unreachable blobs that were kept because
+        they were refreshed during the collection.
+    """
+    if s3_client is None:
+        s3_client = _create_s3_client(endpoint_url)
+    if reference_zone_urls is None:
+        reference_zone_urls = [zone_url]
+    zone_url = zone_url.rstrip('/')
+    url_base = _url_base(zone_url)
+    zone_key = _url_to_key(zone_url)
+    if not zone_key:
+        raise ValueError(f'Invalid zone url: {zone_url}')
+
+    # mark
+    scan_start_time = time.time()
+    referenced = _DigestSet()
+    num_zarr_json_files = 0
+    for url in reference_zone_urls:
+        for obj in _list_zarr_json_files(s3_client, bucket, _url_to_key(url.rstrip('/'))):
+            _add_references(s3_client, bucket, obj['Key'], referenced)
+            num_zarr_json_files += 1
+    print(f'Found {len(referenced)} referenced blobs in {num_zarr_json_files} .zarr.json files')
+
+    # sweep: the unreachable blobs go to a temporary file rather than memory
+    num_blobs = 0
+    num_recent = 0
+    num_unreachable = 0
+    bytes_unreachable = 0
+    with tempfile.TemporaryFile('w+') as candidates_f:
+        for blobs in _batches(_list_blobs(s3_client, bucket, f'{zone_key}/sha1/'), _max_keys_per_request):
+            num_blobs += len(blobs)
+            is_referenced = referenced.contains([obj['Key'].split('/')[-1] for obj, _, _ in blobs])
+            for (obj, last_modified, _), r in zip(blobs, is_referenced):
+                if r:
+                    continue
+                if last_modified > scan_start_time - grace_period_sec:
+                    num_recent += 1
+                    continue
+                candidates_f.write(f"{obj['Key']} {obj['Size']}\n")
+                num_unreachable += 1
+                bytes_unreachable += obj['Size']
+        print(f'{num_unreachable} of {num_blobs} blobs ({bytes_unreachable} bytes) are unreachable; {num_recent} more are within the grace period')
+
+        num_deleted = 0
+        bytes_deleted = 0
+        num_refreshed = 0
+        if not dry_run and num_unreachable > 0:
+            candidates_f.seek(0)
+            _remove_from_chunk_index(
+                s3_client, bucket, zone_key,
+                blob_urls=(f'{url_base}/{line.split(" ")[0]}' for line in candidates_f)
+            )
+            # files written while we were scanning may refer to blobs that
+            # were unreachable (e.g., through the chunk index)
+            for url in reference_zone_urls:
+                for obj in _list_zarr_json_files(s3_client, bucket, _url_to_key(url.rstrip('/'))):
+                    if obj['LastModified'].timestamp() >= scan_start_time - _rescan_margin_sec:
+                        _add_references(s3_client, bucket, obj['Key'], referenced)
+        candidates_f.seek(0)
+        # the candidates are in listing order, so they can be matched against
+        # a second listing as the batches are deleted
+        listing = _SortedListing(s3_client, bucket, f'{zone_key}/sha1/')
+        report_f = open(report_file, 'w') if report_file is not None else None
+        try:
+            for batch in _batches((line.rstrip('\n') for line in candidates_f), _max_keys_per_request):
+                keys = [line.split(' ')[0] for line in batch]
+                sizes = [int(line.split(' ')[1]) for line in batch]
+                still_unreachable = ~referenced.contains([key.split('/')[-1] for key in keys])
+                keys = [k for k, u in zip(keys, still_unreachable) if u]
+                sizes = [s for s, u in zip(sizes, still_unreachable) if u]
+                markers: List[str] = []
+                if not dry_run and len(keys) > 0:
+                    # uploads refresh the blobs they reuse, so a blob that was
+                    # modified since it was first listed may be about to be
+                    # referred to (a blob that is gone needs no deleting)
+                    listed = listing.get(keys)
+                    is_old = [x is not None and x[0] <= scan_start_time - grace_period_sec for x in listed]
+                    num_refreshed += sum(1 for x, old in zip(listed, is_old) if x is not None and not old)
+                    markers = [k + _refresh_marker_suffix for k, x, old in zip(keys, listed, is_old) if old and x is not None and x[1]]
+                    keys = [k for k, old in zip(keys, is_old) if old]
+                    sizes = [s for s, old in zip(sizes, is_old) if old]
+                if report_f is not None:
+                    for key, size in zip(keys, sizes):
+                        report_f.write(f'{url_base}/{key} {size}\n')
+                if dry_run or len(keys) == 0:
+                    continue
+                # the markers of the deleted blobs go too
+                for keys_to_delete in _batches(keys + markers, _max_keys_per_request):
+                    _delete_objects(s3_client, bucket, keys_to_delete)
+                num_deleted += len(keys)
+                bytes_deleted += sum(sizes)
+                print(f'Deleted {num_deleted} of {num_unreachable} unreachable blobs')
+        finally:
+            if report_f is not None:
+                report_f.close()
+    if num_refreshed > 0:
+        print(f'Kept {num_refreshed} unreachable blobs that were refreshed by uploads during the collection')
+    if dry_run:
+        print('Dry run: nothing was deleted')
+    return {
+        'dry_run': dry_run,
+        'num_zarr_json_files': num_zarr_json_files,
+        'num_referenced_blobs': len(referenced),
+        'num_blobs': num_blobs,
+        'num_within_grace_period': num_recent,
+        'num_unreachable': num_unreachable,
+        'bytes_unreachable': bytes_unreachable,
+        'num_deleted': num_deleted,
+        'bytes_deleted': bytes_deleted,
+        'num_refreshed': num_refreshed
+    }
+
+
+class _DigestSet:
+    # A set of SHA-1 digests, kept as a sorted numpy array of 20-byte values
+    # (about 20 bytes per digest rather than ~100 for a set of hex strings).
+    # New digests are buffered and merged in batches.
+    def __init__(self):
+        self._sorted = np.zeros(0, dtype='S20')
+        self._pending: set = set()
+
+    def add(self, sha1: str):
+        self._pending.add(bytes.fromhex(sha1))
+        if len(self._pending) >= 1000000:
+            self._merge()
+
+    def contains(self, sha1s: List[str]) -> np.ndarray:
+        self._merge()
+        x = np.array([bytes.fromhex(s) for s in sha1s], dtype='S20')
+        inds = np.searchsorted(self._sorted, x)
+        inds[inds == len(self._sorted)] = 0
+        return (self._sorted[inds] == x) if len(self._sorted) > 0 else np.zeros(len(x), dtype=bool)
+
+    def __len__(self):
+        self._merge()
+        return len(self._sorted)
+
+    def _merge(self):
+        if self._pending:
+            new = np.array(list(self._pending), dtype='S20')
+            self._sorted = np.union1d(self._sorted, new)
+            self._pending = set()
+
+
+class _SortedListing:
+    # Walks a listing of the blobs under a prefix once, in key order, to look
+    # up the current (last modified, has refresh marker) of blob keys that
+    # are requested in increasing order.
+    def __init__(self, s3_client: Any, bucket: str, prefix: str):
+        self._blobs = _list_blobs(s3_client, bucket, prefix)
+        self._current: Union[Tuple[dict, float, bool], None] = next(self._blobs, None)
+
+    def get(self, keys: List[str]) -> List[Union[Tuple[float, bool], None]]:
+        # None for keys that no longer exist
+        ret: List[Union[Tuple[float, bool], None]] = []
+        for key in keys:
+            while self._current is not None and self._current[0]['Key'] < key:
+                self._current = next(self._blobs, None)
+            if self._current is not None and self._current[0]['Key'] == key:
+                ret.append((self._current[1], self._current[2]))
+            else:
+                ret.append(None)
+        return ret
+
+
+def _list_blobs(s3_client: Any, bucket: str, prefix: str) -> Iterator[Tuple[dict, float, bool]]:
+    # The sha1 blobs under a prefix, in key order, as (object, last modified,
+    # has refresh marker), where last modified is the later of that of the
+    # blob and that of its marker
+    current: Union[Tuple[dict, float, bool], None] = None
+    for page in _list_object_pages(s3_client, bucket, prefix):
+        for obj in page:
+            if current is not None and obj['Key'] == current[0]['Key'] + _refresh_marker_suffix:
+                current = (current[0], max(current[1], obj['LastModified'].timestamp()), True)
+                continue
+            if current is not None:
+                yield current
+                current = None
+            if _sha1_regex.match(obj['Key'].split('/')[-1]):
+                current = (obj, obj['LastModified'].timestamp(), False)
+    if current is not None:
+        yield current
+
+
+def _add_references(s3_client: Any, bucket: str, key: str, referenced: _DigestSet):
+    # adds the blobs referred to by a .zarr.json file (in refs or templates)
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    previous_url = None
+    for section, k, value in iterparse_rfs_json(body):
+        if section == 'refs':
+            if not isinstance(value, list) or len(value) == 0 or not isinstance(value[0], str):
+                continue
+            url = value[0]
+            # chunks of the same blob are usually listed together
+            if url == previous_url:
+                continue
+            previous_url = url
+            m = _blob_url_regex.search(url)
+            if m is not None:
+                referenced.add(m.group(1))
+        elif k == 'templates' and isinstance(value, dict):
+            for url in value.values():
+                m = _blob_url_regex.search(url) if isinstance(url, str) else None
+                if m is not None:
+                    referenced.add(m.group(1))
+
+
+def _remove_from_chunk_index(s3_client: Any, bucket: str, zone_key: str, *, blob_urls: Iterator[str]):
+    # The chunk index is only a hint (uploads check that a blob exists before
+    # referring to it), but an entry for a deleted blob is useless
+    key = f'{zone_key}/f/{ChunkIndex.index_path}'
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    except s3_client.exceptions.NoSuchKey:
+        return
+    chunk_index = ChunkIndex('')
+    chunk_index.read(open_decoded_stream(body))
+    for url in blob_urls:
+        chunk_index.remove_blob(url)
+    if not chunk_index.modified:
+        return
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gz, io.TextIOWrapper(gz, encoding='utf-8') as f:
+        chunk_index.write(f)
+    print(f'Removing unreachable blobs from the chunk index {key}')
+    s3_client.put_object(Bucket=bucket, Key=key, Body=buf.getvalue())
+
+
+def _list_zarr_json_files(s3_client: Any, bucket: str, key_prefix: str) -> Iterator[dict]:
+    # the .zarr.json files under f/ of a zone, or of all the zones under a prefix
+    for page in _list_object_pages(s3_client, bucket, f'{key_prefix}/' if key_prefix else ''):
+        for obj in page:
+            if obj['Key'].endswith('.zarr.json') and '/f/' in obj['Key']:
+                yield obj
+
+
+def _list_object_pages(s3_client: Any, bucket: str, prefix: str) -> Iterator[List[dict]]:
+    kwargs = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': _max_keys_per_request}
+    while True:
+        resp = s3_client.list_objects_v2(**kwargs)
+        yield resp.get('Contents', [])
+        if not resp.get('IsTruncated', False):
+            break
+        kwargs['ContinuationToken'] = resp['NextContinuationToken']
+
+
+def _delete_objects(s3_client: Any, bucket: str, keys: List[str]):
+    resp = s3_client.delete_objects(
+        Bucket=bucket,
+        Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+    )
+    errors = resp.get('Errors', [])
+    if errors:
+        raise Exception(f"Problem deleting {len(errors)} objects, e.g., {errors[0].get('Key')}: {errors[0].get('Message')}")
+
+
+def _batches(items: Iterable[Any], batch_size: int) -> Iterator[List[Any]]:
+    batch: List[Any] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _url_base(url: str) -> str:
+    # e.g., https://lindi.neurosift.org
+    return '/'.join(url.split('/')[:3])
+
+
+def _url_to_key(url: str) -> str:
+    # The object key is the path of the url (as in the listDir api), e.g.,
+    # zones/<gh-user>/<zone-name>
+    return '/'.join(x for x in url.split('/')[3:] if x)
+
+
+def _create_s3_client(endpoint_url: Union[str, None]) -> Any:
+    try:
+        import boto3
+        from botocore.config import Config
+    except ImportError:
+        raise ImportError("The boto3 package is required for lindi_cloud_gc")
+    return boto3.client('s3', endpoint_url=endpoint_url, config=Config(s3={'addressing_style': 'path'}))
@@ -1,33 +1,157 @@
-import tempfile
-from typing import Union
-import json
+from typing import Union, Literal, Callable
 import os
+import time
 import urllib.request
+import urllib.error
 import lindi
 from .LindiCloudStore import LindiCloudStore
+from .InlinePolicy import InlinePolicy
+from .ChunkReader import ChunkReader
+from .ZarrJsonCache import ZarrJsonCache
+from .rfs_json import load_rfs_json, open_decoded_stream, supported_content_encodings
 
 
-def lindi_cloud_load(url: str, staging_dir: Union[str, None]):
+def lindi_cloud_load(
+    url: str,
+    staging_dir: Union[str, None],
+    staging_mode: Literal['files', 'segments'] = 'files',
+    max_segment_size: int = 1024 * 1024 * 1024,
+    write_behind: bool = False,
+    write_behind_max_bytes: int = 256 * 1024 * 1024,
+    compact_refs: bool = False,
+    inline_policy: Union[InlinePolicy, None] = None,
+    chunk_reader: Union[ChunkReader, None] = None,
+    staging_quota_bytes: Union[int, None] = None,
+    on_progress: Union[Callable[[int, Union[int, None]], None], None] = None,
+    cache_dir: Union[str, None] = None,
+    cache_max_bytes: int = 10 * 1024 * 1024 * 1024,
+    offline: bool = False
+):
+    """
+    Load a .zarr.json file from a URL or local path.
+
+    The file is parsed as it is downloaded (no temporary file), and may be
+    gzip or zstd compressed. on_progress, if given, is called with the number
+    of bytes received so far and the total (or None if unknown). By default
+    progress is printed for slow downloads.
+
+    If cache_dir is given, remote files are cached there (see ZarrJsonCache)
+    and a repeat load only makes a conditional request, or no request at all
+    if offline is True.
+    """
     if staging_dir is not None:
         staging_dir = os.path.abspath(staging_dir)
     if url.startswith("http") or url.startswith("https"):
-        with tempfile.TemporaryDirectory() as tmpdir:
-            filename = f"{tmpdir}/temp.zarr.json"
-            _download_file(url, filename)
-            with open(filename, "r") as f:
-                rfs = json.load(f)
+        cache = ZarrJsonCache(cache_dir, max_bytes=cache_max_bytes) if cache_dir is not None else None
+        if offline and cache is None:
+            raise ValueError("offline mode requires a cache_dir")
+        rfs = _download_and_parse_rfs(url, on_progress=on_progress, cache=cache, offline=offline, compact_refs=compact_refs)
     else:
-        with open(url, "r") as f:
-            rfs = json.load(f)
-    store = LindiCloudStore(rfs=rfs, staging_dir=staging_dir)
+        with open(url, "rb") as f:
+            rfs = load_rfs_json(f, compact_refs=compact_refs)
+    store = LindiCloudStore(
+        rfs=rfs,
+        staging_dir=staging_dir,
+        staging_mode=staging_mode,
+        max_segment_size=max_segment_size,
+        write_behind=write_behind,
+        write_behind_max_bytes=write_behind_max_bytes,
+        compact_refs=compact_refs,
+        inline_policy=inline_policy,
+        chunk_reader=chunk_reader,
+        staging_quota_bytes=staging_quota_bytes
+    )
     return lindi.LindiH5pyFile.from_zarr_store(store, mode='r+')
 
 
-def _download_file(url: str, filename: str) -> None:
+def _download_and_parse_rfs(
+    url: str,
+    on_progress: Union[Callable[[int, Union[int, None]], None], None] = None,
+    cache: Union[ZarrJsonCache, None] = None,
+    offline: bool = False,
+    compact_refs: bool = False
+) -> dict:
+    entry = cache.lookup(url) if cache is not None else None
+    if offline:
+        if entry is None:
+            raise Exception(f"File is not in the cache (offline mode): {url}")
+        rfs = _parse_cached_rfs(cache, entry, compact_refs=compact_refs)
+        if rfs is None:
+            raise Exception(f"File was evicted from the cache (offline mode): {url}")
+        return rfs
     headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3",
+        "Accept-Encoding": ", ".join(supported_content_encodings())
     }
+    if entry is not None:
+        # revalidate the cached copy
+        if entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
     req = urllib.request.Request(url, headers=headers)
-    with urllib.request.urlopen(req) as response:
-        with open(filename, "wb") as f:
-            f.write(response.read())
+    try:
+        response = urllib.request.urlopen(req)
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and entry is not None:
+            rfs = _parse_cached_rfs(cache, entry, compact_refs=compact_refs)
+            if rfs is not None:
+                return rfs
+            # evicted in the meantime by another process
+            return _download_and_parse_rfs(url, on_progress=on_progress, cache=cache, compact_refs=compact_refs)
+        raise
+    with response:
+        content_length = response.headers.get("Content-Length", None)
+        total = int(content_length) if content_length is not None else None
+        stream = _ProgressReader(response, total=total, on_progress=on_progress or _print_progress(url))
+        content_encoding = response.headers.get("Content-Encoding", None)
+        if cache is None:
+            return load_rfs_json(open_decoded_stream(stream, content_encoding), compact_refs=compact_refs)
+        writer = cache.begin_download(url, stream, response.headers)
+        try:
+            rfs = load_rfs_json(open_decoded_stream(writer, content_encoding), compact_refs=compact_refs)
+            writer.finish()
+        except BaseException:
+            writer.abort()
+            raise
+        return rfs
+
+
+def _parse_cached_rfs(cache: Union[ZarrJsonCache, None], entry: dict, *, compact_refs: bool) -> Union[dict, None]:
+    assert cache is not None
+    try:
+        f = cache.open_blob(entry)
+    except FileNotFoundError:
+        return None
+    with f:
+        return load_rfs_json(open_decoded_stream(f, entry['content_encoding']), compact_refs=compact_refs)
+
+
+class _ProgressReader:
+    def __init__(self, f, *, total: Union[int, None], on_progress: Callable[[int, Union[int, None]], None]):
+        self._f = f
+        self._total = total
+        self._on_progress = on_progress
+        self._num_bytes_read = 0
+
+    def read(self, n: int = -1) -> bytes:
+        data = self._f.read(n)
+        self._num_bytes_read += len(data)
+        self._on_progress(self._num_bytes_read, self._total)
+        return data
+
+
+def _print_progress(url: str) -> Callable[[int, Union[int, None]], None]:
+    # prints at most every few seconds, so nothing is printed for small files
+    timer = time.time()
+
+    def on_progress(num_bytes: int, total: Union[int, None]):
+        nonlocal timer
+        elapsed = time.time() - timer
+        if elapsed > 3:
+            if total is not None:
+                print(f'Downloaded {num_bytes} of {total} bytes of {url}')
+            else:
+                print(f'Downloaded {num_bytes} bytes of {url}')
+            timer = time.time()
+    return on_progress
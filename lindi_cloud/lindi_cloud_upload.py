@@ -1,30 +1,69 @@
-from typing import Union
+from typing import Any, Union, Dict, List, Tuple
 import tempfile
+import gzip
+import io
 import json
 import os
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 import requests
 import lindi
 from .LindiCloudStore import LindiCloudStore
+from .StagingManifest import StagingManifest
+from .ChunkIndex import ChunkIndex
+from .PackingPlanner import PackingPlanner
+from .rfs_json import open_decoded_stream, write_rfs_json
+from .Metrics import _span, _count, _in_current_context
 
 
 def lindi_cloud_upload(
     client: lindi.LindiH5pyFile,
     url: str,
     consolidate_chunks: bool = True,
-    use_kachery: bool = False
+    use_kachery: bool = False,
+    num_parallel_uploads: int = 8,
+    max_connections_per_host: int = 4,
+    use_batch_api: bool = True,
+    dedup_chunks: bool = False,
+    packing_planner: Union[PackingPlanner, None] = None,
+    compact_json: bool = False,
+    json_compression: Union[str, None] = None
 ):
+    """
+    Upload the staged chunks and the .zarr.json to a zone (or to kachery).
+
+    If dedup_chunks is True, each staged chunk is hashed and looked up in the
+    zone's chunk index (see ChunkIndex); chunks that are already stored in
+    the zone are referenced at their existing location instead of being
+    uploaded again. The index is then updated with the newly uploaded chunks.
+
+    packing_planner (see PackingPlanner) controls how the chunks are packed
+    into consolidated files when consolidate_chunks is True.
+
+    The .zarr.json is written with sorted keys, so its content is
+    deterministic. With compact_json=True it has no indentation or spaces,
+    which makes it much smaller and faster to write and parse. With
+    json_compression='gzip' or 'zstd' it is also compressed (and uploaded
+    with the corresponding Content-Encoding); lindi_cloud_load reads either,
+    but other readers may only support gzip.
+    """
+    if json_compression not in [None, 'gzip', 'zstd']:
+        raise ValueError(f"Unsupported json_compression: {json_compression}")
     if not use_kachery:
-        if not url.startswith('https://lindi.neurosift.org/zones/'):
-            raise ValueError("url must start with 'https://lindi.neurosift.org/zones/'")
-        url_parts = url.split('/')
-        if len(url_parts) < 8:
+        zones_url = _get_zones_url()
+        if not url.startswith(f'{zones_url}/'):
+            raise ValueError(f"url must start with '{zones_url}/'")
+        url_parts = url[len(zones_url) + 1:].split('/')
+        if len(url_parts) < 4:
             raise ValueError("Invalid url")
-        zone_user = url_parts[4]
-        zone_name = url_parts[5]
-        aa = url_parts[6]
+        zone_user = url_parts[0]
+        zone_name = url_parts[1]
+        aa = url_parts[2]
         if aa != 'f':
-            raise Exception(f'url expected to start with https://lindi.neurosift.org/zones/{zone_user}/{zone_name}/f')
-        base_zone_url = f'https://lindi.neurosift.org/zones/{zone_user}/{zone_name}'
+            raise Exception(f'url expected to start with {zones_url}/{zone_user}/{zone_name}/f')
+        base_zone_url = f'{zones_url}/{zone_user}/{zone_name}'
         # make sure github access token is available
         github_access_token = _get_github_access_token()
     else:
@@ -33,40 +72,173 @@ def lindi_cloud_upload(
     store = client._zarr_store
     if not isinstance(store, LindiCloudStore):
         raise ValueError("The zarr store for this client is not a LindiCloudStore")
+    # each upload has its own limit, so that concurrent uploads do not interfere
+    limiter = _HostConnectionLimiter(max_connections_per_host)
+    store.flush()
+    chunk_index: Union[ChunkIndex, None] = None
+    chunk_hashes: Dict[str, str] = {}
+    if dedup_chunks:
+        if use_kachery:
+            raise ValueError("dedup_chunks is not supported with use_kachery")
+        assert base_zone_url is not None
+        if store._staging_subdir is not None:
+            with _span('upload.dedup'):
+                chunk_index = _load_chunk_index(base_zone_url, limiter=limiter)
+                chunk_hashes = store._hash_staged_chunks()
+                new_refs = _find_duplicate_chunks(
+                    store._rfs['refs'], chunk_hashes, chunk_index, github_access_token,
+                    limiter=limiter,
+                    use_batch_api=use_batch_api
+                )
+            print(f'{len(new_refs)} of {len(chunk_hashes)} chunks are already stored (or duplicated)')
+            if new_refs:
+                store._replace_staged_refs(new_refs)
     if consolidate_chunks:
-        store.consolidate_chunks()
+        # kachery computes its own hashes, so there is no need to hash while
+        # consolidating, and the copy can then be done inside the kernel
+        store.consolidate_chunks(compute_sha1=not use_kachery, packing_planner=packing_planner)
+    else:
+        store._seal_segments()
     staging_subdir = store._staging_subdir
     if staging_subdir is not None:
         staging_subdir_is_empty = not os.path.exists(staging_subdir) or len(os.listdir(staging_subdir)) == 0
         if not staging_subdir_is_empty:
-            blob_mapping = _upload_directory_of_blobs(staging_subdir, base_zone_url=base_zone_url, github_access_token=github_access_token, use_kachery=use_kachery)
-            for k, v in store._rfs['refs'].items():
+            with _span('upload.blobs'):
+                blob_mapping = _upload_directory_of_blobs(
+                    staging_subdir,
+                    base_zone_url=base_zone_url,
+                    github_access_token=github_access_token,
+                    use_kachery=use_kachery,
+                    num_parallel_uploads=num_parallel_uploads,
+                    limiter=limiter,
+                    use_batch_api=use_batch_api,
+                    manifest=store._manifest,
+                    # in the staging dir rather than in the subdir of this
+                    # store, so that an interrupted upload can be resumed by
+                    # another process
+                    journal_dir=f"{store._staging_dir}/.multipart_uploads"
+                )
+            # only the keys that changed since the last upload can refer to
+            # the staging directory
+            refs = store._rfs['refs']
+            for k in store._changed_keys:
+                v = refs.get(k, None)
                 if isinstance(v, list) and len(v) == 3:
                     url1 = v[0]
                     if url1.startswith(staging_subdir):
                         url2 = blob_mapping.get(url1, None)
                         if url2 is None:
                             raise ValueError(f"Could not find url in blob mapping: {url1}")
-                        store._rfs['refs'][k][0] = url2
+                        # assign a new list, since the refs may be a CompactRefs table
+                        store._rfs['refs'][k] = [url2, v[1], v[2]]
+    if chunk_index is not None:
+        assert github_access_token is not None
+        refs = store._rfs['refs']
+        for key, chunk_sha1 in chunk_hashes.items():
+            v = refs.get(key, None)
+            if isinstance(v, list) and len(v) == 3:
+                chunk_index.add(chunk_sha1, v)
+        if chunk_index.modified:
+            _save_chunk_index(chunk_index, github_access_token, limiter=limiter)
+    json_indent = None if compact_json else 2
     if url.startswith('http://') or url.startswith('https://'):
         if use_kachery:
             raise ValueError("Cannot upload to http or https url when use_kachery is True")
         assert github_access_token is not None
-        with tempfile.TemporaryDirectory() as tmpdir:
-            rfs_fname = f'{tmpdir}/rfs.json'
-            with open(rfs_fname, "w") as f:
-                json.dump(store._rfs, f, indent=2, sort_keys=True)
-            print(f'Uploading to {url}')
-            _upload_file(fname=rfs_fname, url=url, github_access_token=github_access_token)
+        buf = io.BytesIO()
+        with _span('upload.write_zarr_json') as span:
+            write_rfs_json(store._rfs, buf, indent=json_indent, compression=json_compression)
+            span.set(bytes=buf.tell())
+        print(f'Uploading to {url}')
+        _upload_bytes(data=buf.getbuffer(), url=url, github_access_token=github_access_token, content_encoding=json_compression, limiter=limiter)
     else:
-        with open(url, "w") as f:
-            json.dump(store._rfs, f, indent=2, sort_keys=True)
+        with open(url, "wb") as f, _span('upload.write_zarr_json'):
+            write_rfs_json(store._rfs, f, indent=json_indent, compression=json_compression)
+    if store._manifest is not None:
+        print(f'{len(store._changed_keys)} rfs keys changed since the last upload')
+        store._manifest.record_upload(url, list(store._changed_keys))
+        store._manifest.save()
+    store._changed_keys = set()
+    # the staged files are now only needed to skip them in a later upload
+    store._recount_staging_usage()
     print('Done')
 
 
+def _load_chunk_index(base_zone_url: str, *, limiter: '_HostConnectionLimiter') -> ChunkIndex:
+    chunk_index = ChunkIndex(base_zone_url)
+    with limiter.slot(chunk_index.url):
+        resp = _get_session().get(chunk_index.url)
+    if resp.status_code == 404:
+        return chunk_index
+    if resp.status_code != 200:
+        raise Exception(f"Problem loading chunk index: {resp.text}")
+    chunk_index.read(open_decoded_stream(io.BytesIO(resp.content)))
+    return chunk_index
+
+
+def _save_chunk_index(chunk_index: ChunkIndex, github_access_token: str, *, limiter: '_HostConnectionLimiter') -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = f'{tmpdir}/chunk_index.json.gz'
+        with gzip.open(fname, "wt") as f:
+            chunk_index.write(f)
+        print(f'Uploading chunk index to {chunk_index.url}')
+        _upload_file(fname=fname, url=chunk_index.url, github_access_token=github_access_token, limiter=limiter)
+
+
+def _find_duplicate_chunks(
+    refs: Any,
+    chunk_hashes: Dict[str, str],
+    chunk_index: ChunkIndex,
+    github_access_token: str,
+    *,
+    limiter: '_HostConnectionLimiter',
+    use_batch_api: bool = True
+) -> Dict[str, list]:
+    # Returns the new reference for each staged chunk that does not need to be
+    # uploaded, either because it is already stored in the zone or because an
+    # identical chunk is staged under another key.
+    candidates: Dict[str, list] = {}
+    for key, chunk_sha1 in chunk_hashes.items():
+        ref = chunk_index.lookup(chunk_sha1, refs[key][2])
+        if ref is not None:
+            candidates[key] = ref
+    # the index is only a hint, so check that the blobs still exist (this
+    # also refreshes them, see _refresh_blobs)
+    blob_urls = sorted(set(ref[0] for ref in candidates.values()))
+    blob_exists = dict(zip(blob_urls, _refresh_blobs(blob_urls, github_access_token, limiter=limiter, use_batch_api=use_batch_api)))
+    for blob_url, exists in blob_exists.items():
+        if not exists:
+            chunk_index.remove_blob(blob_url)
+    new_refs = {key: ref for key, ref in candidates.items() if blob_exists[ref[0]]}
+    first_key_for_hash: Dict[str, str] = {}
+    for key, chunk_sha1 in chunk_hashes.items():
+        if key in new_refs:
+            continue
+        first_key = first_key_for_hash.setdefault(chunk_sha1, key)
+        if first_key != key:
+            new_refs[key] = list(refs[first_key])
+    return new_refs
+
+
+def _get_zones_url() -> str:
+    # The zones and the upload api can be overridden, e.g., to run against a
+    # local stand-in (see benchmarks/local_zone_server.py)
+    return os.environ.get('LINDI_CLOUD_ZONES_URL', 'https://lindi.neurosift.org/zones')
+
+
+def _get_api_url(endpoint: str) -> str:
+    # api_url = f'http://localhost:3000/api/{endpoint}'
+    api_url = os.environ.get('LINDI_CLOUD_API_URL', 'https://lindi-cloud.vercel.app/api')
+    return f'{api_url}/{endpoint}'
+
+
 def _get_github_access_token():
-    # look for the github access token in ~/.lindi-cloud/github_access_token
+    # look for the github access token in the LINDI_CLOUD_GITHUB_ACCESS_TOKEN
+    # environment variable or in ~/.lindi-cloud/github_access_token
     # if not there, raise an exception
+    github_access_token = os.environ.get('LINDI_CLOUD_GITHUB_ACCESS_TOKEN', None)
+    if github_access_token:
+        return github_access_token
     home = os.path.expanduser("~")
     github_access_token_file = f"{home}/.lindi-cloud/github_access_token"
     if not os.path.exists(github_access_token_file):
@@ -75,68 +247,495 @@ def _get_github_access_token():
         return f.read().strip()
 
 
-def _upload_file(*, fname: str, url: str, github_access_token: str, skip_if_exists: bool = False) -> None:
+def _upload_file(
+    *,
+    fname: str,
+    url: str,
+    github_access_token: str,
+    limiter: '_HostConnectionLimiter',
+    skip_if_exists: bool = False,
+    journal_dir: Union[str, None] = None
+) -> None:
     if skip_if_exists:
-        exists = _check_file_exists_with_head_request(url)
+        # this also refreshes an existing blob (see _refresh_blobs)
+        exists = _refresh_blob_if_exists(url, github_access_token, limiter=limiter)
         if exists:
             print('Already exists.')
             return
-    signed_upload_url = _get_signed_upload_url(url, github_access_token)
+    if journal_dir is not None and os.path.getsize(fname) >= _multipart_threshold:
+        _upload_file_multipart(fname=fname, url=url, github_access_token=github_access_token, journal_dir=journal_dir, limiter=limiter)
+        return
+    signed_upload_url = _get_signed_upload_url(url, github_access_token, limiter=limiter)
+    resp_upload = _put_file(fname, signed_upload_url, limiter=limiter)
+    if resp_upload.status_code != 200:
+        raise Exception(f"Problem uploading file: {resp_upload.text}")
+
+
+def _upload_bytes(
+    *,
+    data: Any,
+    url: str,
+    github_access_token: str,
+    limiter: '_HostConnectionLimiter',
+    content_encoding: Union[str, None] = None
+) -> None:
+    signed_upload_url = _get_signed_upload_url(url, github_access_token, limiter=limiter)
+    headers = {'Content-Encoding': content_encoding} if content_encoding is not None else {}
+    with limiter.slot(signed_upload_url), _span('upload.put', bytes=len(data)):
+        resp_upload = _get_session().put(signed_upload_url, data=data, headers=headers, timeout=60 * 60)
+    if resp_upload.status_code != 200:
+        raise Exception(f"Problem uploading file: {resp_upload.text}")
+
+
+def _put_file(fname: str, signed_upload_url: str, *, limiter: '_HostConnectionLimiter') -> requests.Response:
     # make a put request and stream the file
     with open(fname, "rb") as f:
-        resp_upload = requests.put(signed_upload_url, data=f, timeout=60 * 60 * 24 * 7)
-        if resp_upload.status_code != 200:
-            raise Exception(f"Problem uploading file: {resp_upload.text}")
+        with limiter.slot(signed_upload_url), _span('upload.put', bytes=os.fstat(f.fileno()).st_size):
+            return _get_session().put(signed_upload_url, data=f, timeout=60 * 60 * 24 * 7)
 
 
-def _check_file_exists_with_head_request(url: str) -> bool:
-    resp = requests.head(url)
-    if resp.status_code == 200:
-        return True
-    elif resp.status_code == 404:
-        return False
-    else:
-        raise Exception(f"Problem checking if file exists: {resp.text}")
+# Blobs at least this large are uploaded in parts, so that an interrupted
+# upload can be resumed from the last completed part (S3 requires parts of at
+# least 5 MB, except for the last one, and at most 10000 parts).
+_multipart_threshold = 64 * 1024 * 1024
+_multipart_part_size = 16 * 1024 * 1024
+_multipart_num_parallel_parts = 4
+_multipart_num_attempts_per_part = 3
+
+
+def _upload_file_multipart(
+    *,
+    fname: str,
+    url: str,
+    github_access_token: str,
+    journal_dir: str,
+    limiter: '_HostConnectionLimiter'
+) -> None:
+    # The upload id and the ETags of the completed parts are recorded in a
+    # journal file, so that if the upload is interrupted, the next call
+    # continues with the remaining parts. The journal is named after the blob
+    # url, which is content addressed, so that it is found even if the blob
+    # is staged again from scratch by another process (consolidation is
+    # deterministic), and its content is known to be the same.
+    size = os.path.getsize(fname)
+    part_size = _multipart_part_size
+    num_parts = max(1, (size + part_size - 1) // part_size)
+    journal_fname = f"{journal_dir}/{hashlib.sha1(url.encode('utf-8')).hexdigest()}.json"
+    journal = _load_json_file(journal_fname)
+    completed_parts: Dict[int, str] = {}
+    if journal is not None:
+        if journal['url'] == url and journal['size'] == size and journal['part_size'] == part_size:
+            uploaded_parts = _multipart_upload_request(
+                {"type": "listUploadedParts", "url": url, "uploadId": journal['upload_id']},
+                github_access_token,
+                limiter=limiter,
+                allow_not_found=True
+            )
+            if uploaded_parts is not None:
+                # only trust parts that we recorded and that the server has
+                for p in uploaded_parts['parts']:
+                    if journal['parts'].get(str(p['partNumber']), None) == p['etag']:
+                        completed_parts[p['partNumber']] = p['etag']
+                print(f'Resuming upload of {url} ({len(completed_parts)} of {num_parts} parts already uploaded)')
+            else:
+                # the upload was completed, aborted or has expired
+                journal = None
+        else:
+            # the file has changed, so the parts uploaded so far are useless
+            _multipart_upload_request(
+                {"type": "abortMultipartUpload", "url": journal['url'], "uploadId": journal['upload_id']},
+                github_access_token,
+                limiter=limiter,
+                allow_not_found=True
+            )
+            journal = None
+    if journal is None:
+        upload_id = _multipart_upload_request({"type": "initiateMultipartUpload", "url": url}, github_access_token, limiter=limiter)['uploadId']
+        journal = {
+            'url': url,
+            'upload_id': upload_id,
+            'size': size,
+            'part_size': part_size,
+            'parts': {}
+        }
+        os.makedirs(journal_dir, exist_ok=True)
+        _write_json_file(journal_fname, journal)
+    upload_id = journal['upload_id']
+    journal['parts'] = {str(n): etag for n, etag in completed_parts.items()}
+    journal_lock = threading.Lock()
+
+    remaining_part_numbers = [n for n in range(1, num_parts + 1) if n not in completed_parts]
+    signed_part_urls: Dict[int, str] = {}
+    for i in range(0, len(remaining_part_numbers), 1000):
+        part_numbers = remaining_part_numbers[i:i + 1000]
+        resp = _multipart_upload_request(
+            {"type": "getUploadPartUrls", "url": url, "uploadId": upload_id, "partNumbers": part_numbers},
+            github_access_token,
+            limiter=limiter
+        )
+        signed_part_urls.update(zip(part_numbers, resp['signedUrls']))
+
+    def upload_part(n: int):
+        offset = (n - 1) * part_size
+        length = min(part_size, size - offset)
+        signed_part_url = signed_part_urls[n]
+        for attempt in range(_multipart_num_attempts_per_part):
+            try:
+                resp = _put_file_range(fname, offset, length, signed_part_url, limiter=limiter)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt + 1 == _multipart_num_attempts_per_part:
+                    raise
+                _count('upload.retries')
+                continue
+            if resp.status_code == 403:
+                # the signed url may have expired
+                _count('upload.retries')
+                signed_part_url = _multipart_upload_request(
+                    {"type": "getUploadPartUrls", "url": url, "uploadId": upload_id, "partNumbers": [n]},
+                    github_access_token,
+                    limiter=limiter
+                )['signedUrls'][0]
+                continue
+            if resp.status_code != 200:
+                raise Exception(f"Problem uploading part {n} of {url}: {resp.text}")
+            with journal_lock:
+                completed_parts[n] = resp.headers['ETag']
+                journal['parts'][str(n)] = resp.headers['ETag']
+                _write_json_file(journal_fname, journal)
+            return
+        raise Exception(f"Problem uploading part {n} of {url}")
+
+    with ThreadPoolExecutor(max_workers=_multipart_num_parallel_parts) as executor:
+        for future in [executor.submit(_in_current_context(upload_part), n) for n in remaining_part_numbers]:
+            future.result()
+
+    _multipart_upload_request(
+        {
+            "type": "completeMultipartUpload",
+            "url": url,
+            "uploadId": upload_id,
+            "parts": [{"partNumber": n, "etag": completed_parts[n]} for n in range(1, num_parts + 1)]
+        },
+        github_access_token,
+        limiter=limiter
+    )
+    os.remove(journal_fname)
+
+
+def _put_file_range(
+    fname: str,
+    offset: int,
+    length: int,
+    signed_upload_url: str,
+    *,
+    limiter: '_HostConnectionLimiter'
+) -> requests.Response:
+    with open(fname, "rb") as f:
+        with limiter.slot(signed_upload_url), _span('upload.put_part', bytes=length):
+            return _get_session().put(signed_upload_url, data=_FileRange(f, offset, length), timeout=60 * 60)
+
+
+class _FileRange:
+    # a file-like view of part of a file, so that a part can be streamed
+    # without reading it into memory (requests uses len() for Content-Length)
+    def __init__(self, f, offset: int, length: int):
+        f.seek(offset)
+        self._f = f
+        self._length = length
+        self._remaining = length
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0 or n > self._remaining:
+            n = self._remaining
+        data = self._f.read(n)
+        self._remaining -= len(data)
+        return data
+
+    def __len__(self):
+        return self._length
+
+
+def _multipart_upload_request(
+    payload: dict,
+    github_access_token: str,
+    *,
+    limiter: '_HostConnectionLimiter',
+    allow_not_found: bool = False
+) -> Any:
+    headers = {
+        'Authorization': f'token {github_access_token}'
+    }
+    api_url = _get_api_url('multipartUpload')
+    with limiter.slot(api_url), _span(f"upload.{payload['type']}"):
+        resp = _get_session().post(api_url, headers=headers, json=payload)
+    if resp.status_code == 404 and allow_not_found:
+        return None
+    if resp.status_code != 200:
+        raise Exception(f"Problem with multipart upload request ({payload['type']}): {resp.text}")
+    return resp.json()
+
+
+def _load_json_file(fname: str) -> Any:
+    try:
+        with open(fname, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_json_file(fname: str, obj: Any) -> None:
+    tmp_fname = f"{fname}.tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_fname, fname)
 
 
 def _upload_directory_of_blobs(
     staging_dir: str,
     base_zone_url: Union[str, None],
     github_access_token: Union[str, None],
-    use_kachery: bool = False
+    use_kachery: bool = False,
+    num_parallel_uploads: int = 8,
+    limiter: Union['_HostConnectionLimiter', None] = None,
+    use_batch_api: bool = True,
+    manifest: Union[StagingManifest, None] = None,
+    journal_dir: Union[str, None] = None
 ) -> dict:
     if not use_kachery:
         if base_zone_url is None:
             raise ValueError('base_zone_url must be provided when not using kachery')
         if github_access_token is None:
             raise ValueError('github_access_token must be provided when not using kachery')
+    if num_parallel_uploads < 1:
+        raise ValueError('num_parallel_uploads must be at least 1')
+    if limiter is None:
+        limiter = _HostConnectionLimiter(4)
+    if manifest is None:
+        manifest = StagingManifest(staging_dir)
+    if journal_dir is None:
+        journal_dir = f"{staging_dir}/.multipart_uploads"
     all_files = []
     for root, dirs, files in os.walk(staging_dir):
+        # hidden directories hold bookkeeping such as the multipart journals
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
         for fname in files:
+            if fname.startswith('.'):
+                # sidecar files such as the staging manifest are not blobs
+                continue
             full_fname = f"{root}/{fname}"
             all_files.append(full_fname)
     blob_mapping = {}
-    for i, full_fname in enumerate(all_files):
+    # Files that were uploaded before (and not modified since) are skipped
+    # without hashing them or checking whether the blob exists
+    uploaded_prefix = 'sha1://' if use_kachery else f'{base_zone_url}/sha1/'
+    files_to_upload = []
+    for full_fname in all_files:
+        blob_url = manifest.get_uploaded_url(full_fname, prefix=uploaded_prefix)
+        if blob_url is not None:
+            blob_mapping[full_fname] = blob_url
+        else:
+            files_to_upload.append(full_fname)
+    if len(blob_mapping) > 0:
+        print(f'Skipping {len(blob_mapping)} blobs that were already uploaded')
+    blob_mapping.update(_upload_blobs(
+        files_to_upload,
+        staging_dir=staging_dir,
+        base_zone_url=base_zone_url,
+        github_access_token=github_access_token,
+        manifest=manifest,
+        use_kachery=use_kachery,
+        num_parallel_uploads=num_parallel_uploads,
+        limiter=limiter,
+        use_batch_api=use_batch_api,
+        journal_dir=journal_dir
+    ))
+    for full_fname in files_to_upload:
+        manifest.set_uploaded_url(full_fname, blob_mapping[full_fname])
+    manifest.save()
+    return blob_mapping
+
+
+def _upload_blobs(
+    all_files: List[str],
+    *,
+    staging_dir: str,
+    base_zone_url: Union[str, None],
+    github_access_token: Union[str, None],
+    manifest: StagingManifest,
+    use_kachery: bool,
+    num_parallel_uploads: int,
+    limiter: '_HostConnectionLimiter',
+    use_batch_api: bool,
+    journal_dir: str
+) -> dict:
+    blob_mapping = {}
+    if use_kachery:
+        for i, full_fname in enumerate(all_files):
+            relative_fname = full_fname[len(staging_dir):]
+            size_bytes = os.path.getsize(full_fname)
+            print(f'Uploading blob {i + 1} of {len(all_files)} {relative_fname} ({_format_size_bytes(size_bytes)})')
+            import kachery_cloud as kcl
+            uri = kcl.store_file(full_fname)
+            blob_mapping[full_fname] = uri
+        return blob_mapping
+
+    assert base_zone_url is not None
+    assert github_access_token is not None
+
+    def get_blob_url(full_fname: str) -> str:
+        assert base_zone_url is not None
+        sh = manifest.get_sha1(full_fname)
+        if sh is None:
+            sh = _compute_sha1_of_file(full_fname)
+            manifest.set_sha1(full_fname, sh)
+        return f"{base_zone_url}/sha1/{sh[0]}{sh[1]}/{sh[2]}{sh[3]}/{sh[4]}{sh[5]}/{sh}"
+
+    if use_batch_api:
+        with ThreadPoolExecutor(max_workers=num_parallel_uploads) as executor:
+            blob_urls = list(executor.map(_in_current_context(get_blob_url), all_files))
+            _upload_blobs_with_batch_api(
+                list(zip(all_files, blob_urls)),
+                staging_dir=staging_dir,
+                github_access_token=github_access_token,
+                executor=executor,
+                limiter=limiter,
+                journal_dir=journal_dir
+            )
+        for full_fname, blob_url in zip(all_files, blob_urls):
+            blob_mapping[full_fname] = blob_url
+        return blob_mapping
+
+    def upload_blob(i: int, full_fname: str) -> str:
+        # Each worker runs the whole hash -> HEAD -> signed url -> PUT pipeline
+        # for one blob, so these stages overlap across blobs.
+        assert base_zone_url is not None
+        assert github_access_token is not None
         relative_fname = full_fname[len(staging_dir):]
         size_bytes = os.path.getsize(full_fname)
         print(f'Uploading blob {i + 1} of {len(all_files)} {relative_fname} ({_format_size_bytes(size_bytes)})')
-        if not use_kachery:
-            assert base_zone_url is not None
-            assert github_access_token is not None
-            sh = _compute_sha1_of_file(full_fname)
-            blob_url = f"{base_zone_url}/sha1/{sh[0]}{sh[1]}/{sh[2]}{sh[3]}/{sh[4]}{sh[5]}/{sh}"
-            _upload_file(
+        blob_url = get_blob_url(full_fname)
+        _upload_file(
+            fname=full_fname,
+            url=blob_url,
+            github_access_token=github_access_token,
+            skip_if_exists=True,
+            journal_dir=journal_dir,
+            limiter=limiter
+        )
+        return blob_url
+
+    with ThreadPoolExecutor(max_workers=num_parallel_uploads) as executor:
+        futures = [
+            executor.submit(_in_current_context(upload_blob), i, full_fname)
+            for i, full_fname in enumerate(all_files)
+        ]
+        # collect in submission order so the mapping does not depend on timing
+        for full_fname, future in zip(all_files, futures):
+            blob_mapping[full_fname] = future.result()
+    return blob_mapping
+
+
+# the maximum number of urls per getUploadUrls request (the API allows 1000,
+# but the signed urls expire after 30 minutes, so we ask for a few at a time)
+_upload_urls_batch_size = 100
+
+
+def _upload_blobs_with_batch_api(
+    blobs: List[Tuple[str, str]],
+    *,
+    staging_dir: str,
+    github_access_token: str,
+    executor: ThreadPoolExecutor,
+    limiter: '_HostConnectionLimiter',
+    journal_dir: str
+) -> None:
+    # blobs is a list of (file name, blob url). A single getUploadUrls request
+    # tells us which of a batch of blobs already exist (and refreshes them,
+    # see _refresh_blobs) and gives signed urls for the others, replacing a
+    # HEAD request and a getUploadUrl request per blob.
+    fname_for_blob_url: Dict[str, str] = {}
+    for full_fname, blob_url in blobs:
+        # files with identical content only need to be uploaded once
+        fname_for_blob_url.setdefault(blob_url, full_fname)
+    blob_urls = list(fname_for_blob_url.keys())
+    num_existing = 0
+    num_uploaded = 0
+    num_to_upload_total = len(blob_urls)
+
+    def put_blob(full_fname: str, blob_url: str, signed_upload_url: str):
+        if os.path.getsize(full_fname) >= _multipart_threshold:
+            _upload_file_multipart(
                 fname=full_fname,
                 url=blob_url,
                 github_access_token=github_access_token,
-                skip_if_exists=True
+                journal_dir=journal_dir,
+                limiter=limiter
             )
-            blob_mapping[full_fname] = blob_url
-        else:
-            import kachery_cloud as kcl
-            uri = kcl.store_file(full_fname)
-            blob_mapping[full_fname] = uri
-    return blob_mapping
+            return
+        resp = _put_file(full_fname, signed_upload_url, limiter=limiter)
+        if resp.status_code == 403:
+            # the signed url may have expired while waiting in the queue
+            _count('upload.retries')
+            resp = _put_file(full_fname, _get_signed_upload_url(blob_url, github_access_token, limiter=limiter), limiter=limiter)
+        if resp.status_code != 200:
+            raise Exception(f"Problem uploading file: {resp.text}")
+
+    previous_futures: list = []
+    for i in range(0, len(blob_urls), _upload_urls_batch_size):
+        results = _get_signed_upload_urls(blob_urls[i:i + _upload_urls_batch_size], github_access_token, limiter=limiter)
+        futures = []
+        for r in results:
+            if r['exists']:
+                num_existing += 1
+                continue
+            full_fname = fname_for_blob_url[r['url']]
+            num_uploaded += 1
+            relative_fname = full_fname[len(staging_dir):]
+            size_bytes = os.path.getsize(full_fname)
+            print(f'Uploading blob {num_uploaded} {relative_fname} ({_format_size_bytes(size_bytes)})')
+            futures.append(executor.submit(_in_current_context(put_blob), full_fname, r['url'], r['signedUrl']))
+        # Keep the next batch queued behind the current one, but do not get
+        # too far ahead, so that the signed urls do not expire.
+        for future in previous_futures:
+            future.result()
+        previous_futures = futures
+    for future in previous_futures:
+        future.result()
+    print(f'Uploaded {num_uploaded} of {num_to_upload_total} blobs ({num_existing} already existed)')
+
+
+_thread_local = threading.local()
+
+
+def _get_session() -> requests.Session:
+    # requests.Session is not guaranteed to be thread safe, so each worker
+    # thread gets its own session (and its own keep-alive connection pool).
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        _thread_local.session = session
+    return session
+
+
+class _HostConnectionLimiter:
+    # Limits the number of simultaneous requests to any one host, regardless
+    # of how many upload workers there are. Each upload has its own, and
+    # passes it down to the workers.
+    def __init__(self, max_connections_per_host: int):
+        if max_connections_per_host < 1:
+            raise ValueError('max_connections_per_host must be at least 1')
+        self._max_connections_per_host = max_connections_per_host
+        self._semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self._lock:
+            sem = self._semaphores.get(host, None)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self._max_connections_per_host)
+                self._semaphores[host] = sem
+        return sem
 
 
 def _format_size_bytes(size_bytes: int) -> str:
@@ -151,9 +750,8 @@ def _format_size_bytes(size_bytes: int) -> str:
 
 
 def _compute_sha1_of_file(fname: str) -> str:
-    import hashlib
     sha1 = hashlib.sha1()
-    with open(fname, "rb") as f:
+    with open(fname, "rb") as f, _span('hash.file', bytes=os.fstat(f.fileno()).st_size):
         while True:
             data = f.read(65536)
             if not data:
@@ -162,16 +760,89 @@ def _compute_sha1_of_file(fname: str) -> str:
     return sha1.hexdigest()
 
 
-def _get_signed_upload_url(url: str, github_access_token: str) -> str:
+def _get_signed_upload_urls(urls: List[str], github_access_token: str, *, limiter: '_HostConnectionLimiter') -> List[dict]:
+    # Returns [{'url', 'exists', 'signedUrl'}] in the same order as urls;
+    # signedUrl is only present for urls that do not exist yet
+    headers = {
+        'Authorization': f'token {github_access_token}'
+    }
+    api_url = _get_api_url('getUploadUrls')
+    with limiter.slot(api_url), _span('upload.get_signed_urls', urls=len(urls)):
+        resp = _get_session().post(api_url, headers=headers, json={
+            "type": "getUploadUrls",
+            "urls": urls
+        })
+    if resp.status_code != 200:
+        raise Exception(f"Problem getting signed upload urls: {resp.text}")
+    results = resp.json()['results']
+    if [r['url'] for r in results] != urls:
+        raise Exception("Unexpected response from getUploadUrls")
+    return results
+
+
+def _refresh_blobs(
+    urls: List[str],
+    github_access_token: str,
+    *,
+    limiter: '_HostConnectionLimiter',
+    use_batch_api: bool = True
+) -> List[bool]:
+    # Returns whether each blob exists. The getUploadUrls api refreshes the
+    # blobs that exist (writes a marker next to each), so that lindi_cloud_gc
+    # does not delete a blob that this upload is going to refer to. Without
+    # the batch api, each blob is checked with a HEAD request and refreshed
+    # with the refreshBlob api.
+    if not use_batch_api:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            return list(executor.map(_in_current_context(lambda url: _refresh_blob_if_exists(url, github_access_token, limiter=limiter)), urls))
+    batches = [urls[i:i + _upload_urls_batch_size] for i in range(0, len(urls), _upload_urls_batch_size)]
+    exists: List[bool] = []
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for results in executor.map(_in_current_context(lambda batch: _get_signed_upload_urls(batch, github_access_token, limiter=limiter)), batches):
+            exists.extend(r['exists'] for r in results)
+    return exists
+
+
+def _refresh_blob_if_exists(url: str, github_access_token: str, *, limiter: '_HostConnectionLimiter') -> bool:
+    # the HEAD request is public and cheap; only a blob that exists needs the
+    # api (which reports whether it still exists)
+    if not _check_file_exists_with_head_request(url, limiter=limiter):
+        return False
+    headers = {
+        'Authorization': f'token {github_access_token}'
+    }
+    api_url = _get_api_url('refreshBlob')
+    with limiter.slot(api_url), _span('upload.refresh_blob'):
+        resp = _get_session().post(api_url, headers=headers, json={
+            "type": "refreshBlob",
+            "url": url
+        })
+    if resp.status_code != 200:
+        raise Exception(f"Problem refreshing blob: {resp.text}")
+    return resp.json()['exists']
+
+
+def _check_file_exists_with_head_request(url: str, *, limiter: '_HostConnectionLimiter') -> bool:
+    with limiter.slot(url), _span('upload.head'):
+        resp = _get_session().head(url)
+    if resp.status_code == 200:
+        return True
+    elif resp.status_code == 404:
+        return False
+    else:
+        raise Exception(f"Problem checking if file exists: {resp.text}")
+
+
+def _get_signed_upload_url(url: str, github_access_token: str, *, limiter: '_HostConnectionLimiter') -> str:
     headers = {
         'Authorization': f'token {github_access_token}'
     }
-    # api_url = 'http://localhost:3000/api/getUploadUrl'
-    api_url = 'https://lindi-cloud.vercel.app/api/getUploadUrl'
-    resp = requests.post(api_url, headers=headers, json={
-        "type": "getUploadUrl",
-        "url": url
-    })
+    api_url = _get_api_url('getUploadUrl')
+    with limiter.slot(api_url), _span('upload.get_signed_url'):
+        resp = _get_session().post(api_url, headers=headers, json={
+            "type": "getUploadUrl",
+            "url": url
+        })
     if resp.status_code != 200:
         raise Exception(f"Problem getting signed upload url: {resp.text}")
     return resp.json()['signedUrl']
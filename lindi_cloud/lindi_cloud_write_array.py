@@ -0,0 +1,150 @@
+from typing import Union, Any, Tuple
+import os
+import itertools
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+import numpy as np
+import zarr
+from numcodecs.abc import Codec
+from numcodecs.compat import ensure_bytes, ensure_ndarray_like
+import lindi
+from .LindiCloudStore import LindiCloudStore
+
+
+def lindi_cloud_write_array(
+    client: lindi.LindiH5pyFile,
+    name: str,
+    data: Any,
+    *,
+    chunks: Tuple[int, ...],
+    compressor: Union[Codec, None] = None,
+    filters: Union[list, None] = None,
+    fill_value: Any = 0,
+    num_workers: Union[int, None] = None,
+    use_processes: bool = False,
+    max_chunks_in_flight: Union[int, None] = None
+):
+    """
+    Create a dataset and write its chunks, encoding them in parallel.
+
+    Writing a large array through the h5py-like interface encodes one chunk
+    at a time. Here the chunks are encoded (filters + compressor) across a
+    pool of threads or processes and the encoded bytes are stored in the
+    staging area in the same order, and with the same bytes, as a serial
+    write would produce.
+
+    Parameters
+    ----------
+    client : lindi.LindiH5pyFile
+        A client whose zarr store is a LindiCloudStore.
+    name : str
+        The path of the new dataset within the file.
+    data : array-like
+        The data to write. Anything with shape and dtype attributes that
+        supports numpy-style slicing (e.g., a numpy array, a memmap, or an
+        h5py dataset). Only one chunk's worth of data is read at a time.
+    chunks : tuple of int
+        The chunk shape.
+    compressor : numcodecs.abc.Codec or None
+        The compressor for the dataset.
+    filters : list of numcodecs.abc.Codec or None
+        The filters for the dataset.
+    fill_value : Any
+        The fill value for the dataset.
+    num_workers : int or None
+        The number of workers used to encode chunks. Defaults to the number of
+        CPUs.
+    use_processes : bool
+        If True, use a process pool instead of a thread pool. This helps for
+        codecs that hold the GIL while encoding.
+    max_chunks_in_flight : int or None
+        The maximum number of chunks that are held in memory (read but not
+        yet stored). Defaults to twice the number of workers.
+
+    Returns
+    -------
+    The new h5py-like dataset.
+    """
+    store = client._zarr_store
+    if not isinstance(store, LindiCloudStore):
+        raise ValueError("The zarr store for this client is not a LindiCloudStore")
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if max_chunks_in_flight is None:
+        max_chunks_in_flight = 2 * num_workers
+    if num_workers < 1 or max_chunks_in_flight < 1:
+        raise ValueError("num_workers and max_chunks_in_flight must be at least 1")
+    shape = tuple(data.shape)
+    if len(chunks) != len(shape):
+        raise ValueError(f"chunks {chunks} does not match the shape {shape}")
+    arr = zarr.create(
+        store=store,
+        path=name,
+        shape=shape,
+        chunks=chunks,
+        dtype=data.dtype,
+        compressor=compressor,
+        filters=filters,
+        fill_value=fill_value
+    )
+    executor: Executor = ProcessPoolExecutor(max_workers=num_workers) if use_processes else ThreadPoolExecutor(max_workers=num_workers)
+    in_flight: deque = deque()
+    with executor:
+        for chunk_coords in _iterate_chunk_coords(arr.shape, arr.chunks):
+            # Data is read on this thread (h5py datasets are not thread safe)
+            # and only the encoding is done by the workers.
+            chunk = _get_chunk_data(arr, data, chunk_coords)
+            future = executor.submit(_encode_chunk, chunk, arr.filters, arr.compressor)
+            in_flight.append((arr._chunk_key(chunk_coords), future))
+            if len(in_flight) >= max_chunks_in_flight:
+                _store_encoded_chunk(store, *in_flight.popleft())
+        while in_flight:
+            _store_encoded_chunk(store, *in_flight.popleft())
+    return client[name]
+
+
+def _iterate_chunk_coords(shape: Tuple[int, ...], chunks: Tuple[int, ...]):
+    # row-major order, the same order that zarr uses for a full-array write
+    grid = [(s + c - 1) // c for s, c in zip(shape, chunks)]
+    return itertools.product(*[range(n) for n in grid])
+
+
+def _get_chunk_data(arr: zarr.Array, data: Any, chunk_coords: Tuple[int, ...]) -> np.ndarray:
+    selection = tuple(
+        slice(i * c, min((i + 1) * c, s))
+        for i, c, s in zip(chunk_coords, arr.chunks, arr.shape)
+    )
+    values = np.asarray(data[selection], dtype=arr.dtype)
+    return _pad_chunk(arr, values)
+
+
+def _pad_chunk(arr: zarr.Array, values: np.ndarray) -> np.ndarray:
+    if values.shape == tuple(arr.chunks):
+        return np.ascontiguousarray(values)
+    # Edge chunks are padded with the fill value to the full chunk shape, as
+    # zarr does
+    if arr.fill_value is not None:
+        chunk = np.full(arr.chunks, arr.fill_value, dtype=arr.dtype)
+    else:
+        chunk = np.zeros(arr.chunks, dtype=arr.dtype)
+    chunk[tuple(slice(0, n) for n in values.shape)] = values
+    return chunk
+
+
+def _encode_chunk(chunk: np.ndarray, filters: Union[list, None], compressor: Union[Codec, None]) -> bytes:
+    # This mirrors zarr.Array._encode_chunk, but is a module-level function so
+    # that it can run in a process pool.
+    if filters:
+        for f in filters:
+            chunk = f.encode(chunk)
+    if ensure_ndarray_like(chunk).dtype == object:
+        raise RuntimeError("cannot write object array without object codec")
+    if compressor:
+        cdata = compressor.encode(chunk)
+    else:
+        cdata = chunk
+    return ensure_bytes(cdata)
+
+
+def _store_encoded_chunk(store: LindiCloudStore, key: str, future: Future):
+    store[key] = future.result()
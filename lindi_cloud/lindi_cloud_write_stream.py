@@ -0,0 +1,160 @@
+from typing import Union, Any, Iterable, Tuple
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+import numpy as np
+import zarr
+from numcodecs.abc import Codec
+import lindi
+from .LindiCloudStore import LindiCloudStore
+from .lindi_cloud_write_array import _iterate_chunk_coords, _pad_chunk, _encode_chunk, _store_encoded_chunk
+
+
+def lindi_cloud_write_stream(
+    client: lindi.LindiH5pyFile,
+    name: str,
+    blocks: Iterable[Any],
+    *,
+    chunks: Tuple[Union[int, None], ...],
+    dtype: Any = None,
+    length: Union[int, None] = None,
+    compressor: Union[Codec, None] = None,
+    filters: Union[list, None] = None,
+    fill_value: Any = 0,
+    num_workers: Union[int, None] = None,
+    use_processes: bool = False,
+    max_chunks_in_flight: Union[int, None] = None
+):
+    """
+    Create a dataset from a stream of blocks along the first axis and write
+    its chunks as the blocks arrive.
+
+    This is like lindi_cloud_write_array, but the data does not need to be
+    available up front (or to fit in memory): blocks (e.g., frames of a video
+    or blocks of samples of a recording) are taken from an iterator one at a
+    time and only one row of chunks (chunks[0] entries along the first axis)
+    is buffered, besides the chunks that are being encoded. So memory use
+    does not depend on the length of the stream.
+
+    The dataset is created when the first block arrives (shape[1:] is taken
+    from it) and is resized to the number of entries received when the
+    stream ends, so the final length does not need to be known in advance.
+
+    Parameters
+    ----------
+    client : lindi.LindiH5pyFile
+        A client whose zarr store is a LindiCloudStore.
+    name : str
+        The path of the new dataset within the file.
+    blocks : iterable of array-like
+        The blocks to write, in order. Each block has shape (n, *shape[1:])
+        for any n (which may differ from block to block).
+    chunks : tuple of int or None
+        The chunk shape. None in any but the first dimension stands for the
+        full extent of that dimension (taken from the first block).
+    dtype : numpy dtype or None
+        The data type of the dataset. Defaults to the dtype of the first
+        block.
+    length : int or None
+        The expected number of entries along the first axis, if known. This
+        is only used as the initial shape of the dataset.
+    compressor : numcodecs.abc.Codec or None
+        The compressor for the dataset.
+    filters : list of numcodecs.abc.Codec or None
+        The filters for the dataset.
+    fill_value : Any
+        The fill value for the dataset.
+    num_workers : int or None
+        The number of workers used to encode chunks. Defaults to the number of
+        CPUs.
+    use_processes : bool
+        If True, use a process pool instead of a thread pool.
+    max_chunks_in_flight : int or None
+        The maximum number of chunks that are being encoded at a time.
+        Defaults to twice the number of workers.
+
+    Returns
+    -------
+    The new h5py-like dataset.
+    """
+    store = client._zarr_store
+    if not isinstance(store, LindiCloudStore):
+        raise ValueError("The zarr store for this client is not a LindiCloudStore")
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if max_chunks_in_flight is None:
+        max_chunks_in_flight = 2 * num_workers
+    if num_workers < 1 or max_chunks_in_flight < 1:
+        raise ValueError("num_workers and max_chunks_in_flight must be at least 1")
+    if len(chunks) < 1 or chunks[0] is None:
+        raise ValueError("chunks must have at least one dimension, and chunks[0] must be given")
+    arr: Union[zarr.Array, None] = None
+    row: Union[np.ndarray, None] = None
+    num_rows_in_buffer = 0
+    num_rows_written = 0
+    row_index = 0
+    executor: Executor = ProcessPoolExecutor(max_workers=num_workers) if use_processes else ThreadPoolExecutor(max_workers=num_workers)
+    in_flight: deque = deque()
+
+    def write_row(values: np.ndarray):
+        # Encode and store the chunks of one row of chunks along the first
+        # axis. The chunks of a row are submitted in row-major order, so the
+        # overall order is the same as for lindi_cloud_write_array.
+        assert arr is not None
+        for trailing_coords in _iterate_chunk_coords(arr.shape[1:], arr.chunks[1:]):
+            selection = (slice(None),) + tuple(
+                slice(i * c, min((i + 1) * c, s))
+                for i, c, s in zip(trailing_coords, arr.chunks[1:], arr.shape[1:])
+            )
+            chunk = _pad_chunk(arr, values[selection])
+            if np.may_share_memory(chunk, values):
+                # the row buffer is reused for the next row
+                chunk = chunk.copy()
+            future = executor.submit(_encode_chunk, chunk, arr.filters, arr.compressor)
+            in_flight.append((arr._chunk_key((row_index,) + tuple(trailing_coords)), future))
+            if len(in_flight) >= max_chunks_in_flight:
+                _store_encoded_chunk(store, *in_flight.popleft())
+
+    with executor:
+        for block in blocks:
+            block = np.asarray(block, dtype=dtype)
+            if arr is None:
+                if block.ndim != len(chunks):
+                    raise ValueError(f"chunks {chunks} does not match the shape of the blocks {block.shape}")
+                dtype = block.dtype
+                arr = zarr.create(
+                    store=store,
+                    path=name,
+                    shape=(length or 0,) + block.shape[1:],
+                    chunks=tuple(c if c is not None else n for c, n in zip(chunks, block.shape)),
+                    dtype=dtype,
+                    compressor=compressor,
+                    filters=filters,
+                    fill_value=fill_value
+                )
+                row = np.empty((arr.chunks[0],) + arr.shape[1:], dtype=arr.dtype)
+            if block.shape[1:] != arr.shape[1:]:
+                raise ValueError(f"Block shape {block.shape} does not match the dataset shape {arr.shape}")
+            assert row is not None
+            i = 0
+            while i < block.shape[0]:
+                n = min(block.shape[0] - i, row.shape[0] - num_rows_in_buffer)
+                row[num_rows_in_buffer:num_rows_in_buffer + n] = block[i:i + n]
+                num_rows_in_buffer += n
+                i += n
+                if num_rows_in_buffer == row.shape[0]:
+                    write_row(row)
+                    num_rows_written += num_rows_in_buffer
+                    num_rows_in_buffer = 0
+                    row_index += 1
+        if arr is None:
+            raise ValueError("The stream did not contain any blocks")
+        if num_rows_in_buffer > 0:
+            assert row is not None
+            write_row(row[:num_rows_in_buffer])
+            num_rows_written += num_rows_in_buffer
+        while in_flight:
+            _store_encoded_chunk(store, *in_flight.popleft())
+    if arr.shape[0] != num_rows_written:
+        arr.resize((num_rows_written,) + arr.shape[1:])
+    return client[name]
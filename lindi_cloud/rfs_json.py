@@ -0,0 +1,339 @@
+from typing import Any, Dict, Iterator, List, Tuple, Union
+import codecs
+import gzip
+import json
+import re
+from json.encoder import encode_basestring_ascii  # type: ignore
+from .CompactRefs import CompactRefs
+
+
+# The reference file system (.zarr.json) files can be hundreds of MB, so
+# rather than reading the whole file into memory and then parsing it, we parse
+# it incrementally from a stream. Only the refs entries are parsed one by one;
+# each individual value is small and is decoded by the (fast) json module.
+
+
+_read_size = 1024 * 1024
+_whitespace = ' \t\n\r'
+_key_separator_regex = re.compile(r'[ \t\n\r]*:[ \t\n\r]*')
+_item_separator_regex = re.compile(r'[ \t\n\r]*([,}])[ \t\n\r]*')
+
+
+def load_rfs_json(f: Any, *, compact_refs: bool = False) -> dict:
+    """
+    Parse a reference file system from a binary stream.
+
+    The stream may be gzip or zstd compressed (detected from the content). If
+    compact_refs is True, the refs are loaded directly into a CompactRefs
+    table so that the plain dict is never built.
+    """
+    rfs: dict = {}
+    for section, key, value in iterparse_rfs_json(f):
+        if section == 'refs':
+            rfs['refs'][key] = value
+        elif key == 'refs':
+            # filled in entry by entry
+            rfs['refs'] = CompactRefs() if compact_refs else {}
+        else:
+            rfs[key] = value
+    return rfs
+
+
+def iterparse_rfs_json(f: Any) -> Iterator[Tuple[Union[str, None], str, Any]]:
+    """
+    Incrementally parse a reference file system from a binary stream.
+
+    Yields (None, key, value) for each top-level key other than 'refs', and
+    (None, 'refs', {}) followed by ('refs', key, value) for each reference.
+    The stream may be gzip or zstd compressed (detected from the content).
+    """
+    parser = _StreamingJsonParser(open_decoded_stream(f))
+    parser.expect('{')
+    if parser.peek() == '}':
+        return
+    while True:
+        top_key = parser.decode_value()
+        parser.expect(':')
+        if top_key == 'refs' and parser.peek() == '{':
+            yield (None, 'refs', {})
+            parser.expect('{')
+            if parser.peek() == '}':
+                parser.expect('}')
+            else:
+                while True:
+                    k, v, c = parser.decode_item()
+                    yield ('refs', k, v)
+                    if c == '}':
+                        break
+        else:
+            yield (None, top_key, parser.decode_value())
+        if parser.next_char() == '}':
+            break
+
+
+def write_rfs_json(rfs: dict, f: Any, *, indent: Union[int, None] = None, compression: Union[str, None] = None):
+    """
+    Serialize a reference file system to a binary stream.
+
+    The output is the same as json.dump(rfs, f, sort_keys=True, indent=indent)
+    (with compact separators when indent is None), but it is written
+    incrementally, so the whole string is never built, and the refs (which
+    may be a CompactRefs table) are formatted with a fast path for the common
+    [url, offset, size] references.
+
+    compression may be 'gzip' or 'zstd' (see open_decoded_stream for
+    reading it back). The output is deterministic either way.
+    """
+    if compression is not None:
+        writer = _open_encoded_stream(f, compression)
+        try:
+            write_rfs_json(rfs, writer, indent=indent)
+        finally:
+            # finishes the compressed stream without closing f
+            writer.close()
+        return
+    if indent is None:
+        item_separator, key_separator = ',', ':'
+        newline0 = newline1 = newline2 = ''
+    else:
+        item_separator, key_separator = ',', ': '
+        newline0 = '\n'
+        newline1 = '\n' + ' ' * indent
+        newline2 = '\n' + ' ' * (2 * indent)
+    buf: List[str] = []
+    buf_size = 0
+
+    def write(x: str):
+        nonlocal buf_size
+        buf.append(x)
+        buf_size += len(x)
+        if buf_size > _write_buffer_size:
+            flush()
+
+    def flush():
+        nonlocal buf_size
+        f.write(''.join(buf).encode('utf-8'))
+        buf.clear()
+        buf_size = 0
+
+    write('{')
+    for i, top_key in enumerate(sorted(rfs.keys())):
+        write((item_separator if i > 0 else '') + newline1 + _encode_string(top_key) + key_separator)
+        value = rfs[top_key]
+        if top_key != 'refs' or len(value) == 0:
+            write(_encode_value(value, indent, level=1))
+            continue
+        write('{')
+        encoded_urls: Dict[str, str] = {}
+        if indent is None:
+            ref_format = '{}{}' + key_separator + '[{},{},{}]'
+        else:
+            inner = '\n' + ' ' * (3 * indent)
+            ref_format = '{}{}' + key_separator + '[' + inner + '{},' + inner + '{},' + inner + '{}' + newline2 + ']'
+        separator = newline2
+        parts: List[str] = []
+        for key in sorted(value.keys()):
+            v = value[key]
+            if _is_simple_reference(v):
+                url = v[0]
+                encoded_url = encoded_urls.get(url, None)
+                if encoded_url is None:
+                    encoded_url = _encode_string(url)
+                    encoded_urls[url] = encoded_url
+                parts.append(ref_format.format(separator, _encode_string(key), encoded_url, v[1], v[2]))
+            else:
+                parts.append(separator + _encode_string(key) + key_separator + _encode_value(v, indent, level=2))
+            separator = item_separator + newline2
+            if len(parts) >= _refs_per_write:
+                write(''.join(parts))
+                parts.clear()
+        write(''.join(parts))
+        write(newline1 + '}')
+    write((newline0 if len(rfs) > 0 else '') + '}')
+    flush()
+
+
+def open_decoded_stream(f: Any, content_encoding: Union[str, None] = None) -> Any:
+    """
+    Wrap a binary stream so that gzip or zstd compressed content is
+    decompressed on the fly.
+
+    If content_encoding is not given (or is 'identity'), the compression is
+    detected from the first bytes of the stream.
+    """
+    if content_encoding in [None, '', 'identity']:
+        magic = _read_exactly(f, 4)
+        f = _PrefixedStream(magic, f)
+        if magic[:2] == b'\x1f\x8b':
+            content_encoding = 'gzip'
+        elif magic == b'\x28\xb5\x2f\xfd':
+            content_encoding = 'zstd'
+        else:
+            return f
+    if content_encoding == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    elif content_encoding == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("The zstandard package is required to read zstd compressed content")
+        return zstandard.ZstdDecompressor().stream_reader(f)
+    else:
+        raise ValueError(f"Unsupported content encoding: {content_encoding}")
+
+
+def supported_content_encodings() -> list:
+    ret = ['gzip']
+    try:
+        import zstandard  # noqa: F401
+        ret.append('zstd')
+    except ImportError:
+        pass
+    return ret
+
+
+def _open_encoded_stream(f: Any, content_encoding: str) -> Any:
+    if content_encoding == 'gzip':
+        # mtime=0 so that the same content gives the same bytes
+        return gzip.GzipFile(fileobj=f, mode='wb', mtime=0)
+    elif content_encoding == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("The zstandard package is required to write zstd compressed content")
+        return zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+    else:
+        raise ValueError(f"Unsupported content encoding: {content_encoding}")
+
+
+_write_buffer_size = 1024 * 1024
+_refs_per_write = 10000
+_encode_string = encode_basestring_ascii
+
+
+def _encode_value(value: Any, indent: Union[int, None], *, level: int) -> str:
+    if indent is None:
+        return json.dumps(value, sort_keys=True, separators=(',', ':'))
+    # indent the continuation lines to the nesting level of the value
+    return json.dumps(value, sort_keys=True, indent=indent).replace('\n', '\n' + ' ' * (level * indent))
+
+
+def _is_simple_reference(value: Any) -> bool:
+    return (
+        type(value) is list and len(value) == 3 and type(value[0]) is str and type(value[1]) is int and type(value[2]) is int
+    )
+
+
+class _StreamingJsonParser:
+    def __init__(self, f: Any):
+        self._f = f
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        # returns False if there is no more data
+        if self._eof:
+            return False
+        data = self._f.read(_read_size)
+        if not data:
+            self._eof = True
+            self._buf = self._buf[self._pos:] + self._text_decoder.decode(b'', final=True)
+        else:
+            self._buf = self._buf[self._pos:] + self._text_decoder.decode(data)
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        # the next non-whitespace character, without consuming it
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _whitespace:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON stream")
+
+    def next_char(self) -> str:
+        c = self.peek()
+        self._pos += 1
+        return c
+
+    def expect(self, c: str):
+        c2 = self.next_char()
+        if c2 != c:
+            raise ValueError(f"Unexpected character in JSON stream: expected {c} but got {c2}")
+
+    def decode_value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                # scan_once is what raw_decode uses, but it fails cheaply
+                # (raw_decode computes line numbers for the error message)
+                value, end = self._json_decoder.scan_once(self._buf, self._pos)
+            except (StopIteration, json.JSONDecodeError):
+                if self._fill():
+                    continue
+                raise ValueError(f"Invalid JSON value in stream: {self._buf[self._pos:self._pos + 100]}")
+            # A number that ends exactly at the end of the buffer may
+            # continue in the next read
+            if end == len(self._buf) and not self._eof:
+                self._fill()
+                continue
+            self._pos = end
+            return value
+
+    def decode_item(self) -> Tuple[Any, Any, str]:
+        # Decodes `key: value` followed by `,` or `}` (which is returned). This
+        # is the hot loop for large refs, so there is a fast path for the
+        # case where the whole item is already in the buffer.
+        self.peek()
+        buf = self._buf
+        scan_once = self._json_decoder.scan_once
+        try:
+            key, end = scan_once(buf, self._pos)
+            m = _key_separator_regex.match(buf, end)
+            if m is not None:
+                value, end = scan_once(buf, m.end())
+                m = _item_separator_regex.match(buf, end)
+                if m is not None and m.end() < len(buf):
+                    self._pos = m.end()
+                    return key, value, m.group(1)
+        except (StopIteration, json.JSONDecodeError):
+            pass
+        key = self.decode_value()
+        self.expect(':')
+        value = self.decode_value()
+        return key, value, self.next_char()
+
+
+class _PrefixedStream:
+    # a binary stream with some bytes (already read) put back at the front
+    def __init__(self, prefix: bytes, f: Any):
+        self._prefix = prefix
+        self._f = f
+
+    def read(self, n: int = -1) -> bytes:
+        if not self._prefix:
+            return self._f.read(n)
+        if n is None or n < 0:
+            ret = self._prefix + self._f.read()
+            self._prefix = b''
+            return ret
+        ret = self._prefix[:n]
+        self._prefix = self._prefix[n:]
+        if len(ret) < n:
+            ret += self._f.read(n - len(ret))
+        return ret
+
+
+def _read_exactly(f: Any, n: int) -> bytes:
+    ret = b''
+    while len(ret) < n:
+        data = f.read(n - len(ret))
+        if not data:
+            break
+        ret += data
+    return ret